@@ -6,6 +6,24 @@ import os
 import signal
 import json
 import subprocess
+import hashlib
+import time
+import math
+import queue
+import socketserver
+import concurrent.futures
+import struct
+import tempfile
+import shutil
+import atexit
+
+from civic_protocol import (
+    ConnectionClosed,
+    FramedConnection,
+    MessageType,
+    ProtocolError,
+    recv_exact,
+)
 
 logging.basicConfig(level=logging.DEBUG)
 
@@ -14,8 +32,43 @@ CIVIC_SERVER_PORT = ""
 
 CLIENT_UUID = None
 
+# Port of the peer server sharing cached binaries with other citizens (0 picks a free
+# port); peer sharing is disabled when unset. CIVIC_PEER_HOST overrides the address
+# advertised to other citizens, which defaults to the one the server sees.
+CIVIC_PEER_PORT = None
+CIVIC_PEER_HOST = None
+# Number of duties run at the same time (CIVIC_SLOTS, by default the CPUs available)
+SLOTS = 1
+# Number of duties queued at the citizen on top of the running ones, so a slot can
+# start its next duty without waiting on the server
+PREFETCH = int(os.getenv("CIVIC_PREFETCH", "1"))
+# Size of the buffer model binaries are received into, and seconds between progress logs
+DOWNLOAD_BUFFER_SIZE = 1024 * 1024
+DOWNLOAD_PROGRESS_SECONDS = 2
+# Number of chunks fetched from peers at the same time during a swarm download
+SWARM_WORKERS = int(os.getenv("CIVIC_SWARM_WORKERS", "4"))
+# Seconds to wait on a peer before trying the next one for a chunk
+SWARM_PEER_TIMEOUT = 30
+# Directory for duty input and output files (CIVIC_SCRATCH_DIR, by default /dev/shm when
+# available, so duty I/O stays in memory). Payloads bigger than SCRATCH_MAX_BYTES, or
+# that would not fit in the scratch filesystem, go to temp/ on disk instead.
+SCRATCH_DIR = None
+SCRATCH_MAX_BYTES = int(os.getenv("CIVIC_SCRATCH_MAX_BYTES", str(16 * 1024 * 1024)))
+# Seconds between scratch usage reports
+SCRATCH_REPORT_SECONDS = 60
+# Seconds a model binary may spend on one split before it is killed and the split
+# fails (CIVIC_DUTY_TIMEOUT, 0 for no limit)
+DUTY_TIMEOUT = float(os.getenv("CIVIC_DUTY_TIMEOUT", "3600"))
+
 s = None
+conn = None
 listener_thread = None
+peer_server = None
+duty_pool = None
+scratch = None
+result_queue = queue.Queue()
+# Resident model processes of the current duty slot: {binary path: ResidentWorker}
+resident_workers = threading.local()
 
 
 # main()
@@ -31,9 +84,17 @@ def main():
 # Configures the citizen by loading environment variables and creating necessary directories.
 # It also loads the citizen's UUID from a file if it exists.
 def configure():
-    global CIVIC_SERVER_IP, CIVIC_SERVER_PORT
+    global CIVIC_SERVER_IP, CIVIC_SERVER_PORT, CIVIC_PEER_PORT, CIVIC_PEER_HOST
     CIVIC_SERVER_IP = os.getenv("CIVIC_SERVER_IP")
     CIVIC_SERVER_PORT = os.getenv("CIVIC_SERVER_PORT")
+    CIVIC_PEER_PORT = os.getenv("CIVIC_PEER_PORT")
+    CIVIC_PEER_HOST = os.getenv("CIVIC_PEER_HOST")
+
+    # Run up to SLOTS duties at once, each in its own model subprocess
+    global SLOTS, duty_pool
+    SLOTS = int(os.getenv("CIVIC_SLOTS", "0")) or detect_slots()
+    duty_pool = concurrent.futures.ThreadPoolExecutor(max_workers=SLOTS)
+    logging.info(f"Running up to {SLOTS} duties at a time.")
     if not os.getenv("CIVIC_SERVER_IP") or not os.getenv("CIVIC_SERVER_PORT"):
         logging.fatal("CIVIC_SERVER_IP and CIVIC_SERVER_PORT must be set.")
         sys.exit(1)
@@ -49,13 +110,85 @@ def configure():
     os.makedirs("download", exist_ok=True)
     os.makedirs("temp", exist_ok=True)
 
+    # Set up the scratch space for duty files
+    global SCRATCH_DIR, scratch
+    SCRATCH_DIR = os.getenv("CIVIC_SCRATCH_DIR")
+    if SCRATCH_DIR is None and os.access("/dev/shm", os.W_OK):
+        SCRATCH_DIR = "/dev/shm"
+    scratch = Scratch(SCRATCH_DIR, "temp")
+    atexit.register(scratch.close)
+
+
+# detect_slots()
+# Returns the number of CPUs this citizen may use: the CPUs it is allowed to run on,
+# further limited by the container's cgroup CPU quota if there is one.
+def detect_slots():
+    try:
+        cpus = len(os.sched_getaffinity(0))
+    except AttributeError:
+        cpus = os.cpu_count() or 1
+
+    quota = None
+    try:
+        # cgroup v2: "<quota> <period>" or "max <period>"
+        with open("/sys/fs/cgroup/cpu.max", "r") as cpu_max:
+            limit, period = cpu_max.read().split()
+            if limit != "max":
+                quota = int(limit) / int(period)
+    except (OSError, ValueError):
+        try:
+            # cgroup v1: a quota of -1 means unlimited
+            with open("/sys/fs/cgroup/cpu/cpu.cfs_quota_us", "r") as quota_file:
+                limit = int(quota_file.read())
+            with open("/sys/fs/cgroup/cpu/cpu.cfs_period_us", "r") as period_file:
+                period = int(period_file.read())
+            if limit > 0:
+                quota = limit / period
+        except (OSError, ValueError):
+            pass
+
+    if quota is not None:
+        cpus = min(cpus, math.ceil(quota))
+    return max(1, cpus)
+
+
+# detect_memory()
+# Returns the memory this citizen may use in bytes: the machine's memory, further
+# limited by the container's cgroup memory limit if there is one.
+# Returns None if it cannot be determined.
+def detect_memory():
+    memory = None
+    try:
+        with open("/proc/meminfo", "r") as meminfo:
+            for line in meminfo:
+                if line.startswith("MemTotal:"):
+                    memory = int(line.split()[1]) * 1024
+                    break
+    except (OSError, ValueError):
+        pass
+
+    # cgroup v2 ("max" means unlimited), then cgroup v1
+    for limit_path in (
+        "/sys/fs/cgroup/memory.max",
+        "/sys/fs/cgroup/memory/memory.limit_in_bytes",
+    ):
+        try:
+            with open(limit_path, "r") as limit_file:
+                limit = int(limit_file.read())
+        except (OSError, ValueError):
+            continue
+        if memory is None or limit < memory:
+            memory = limit
+        break
+    return memory
+
 
 # connect_to_server()
 # Connects to the CIVIC server using the provided IP and port.
 # It sends the UUID if it exists or requests a new one from the server.
 # It also starts a thread to listen for messages from the server.
 def connect_to_server():
-    global s, listener_thread
+    global s, conn, listener_thread
 
     logging.info(f"Connecting to server at {CIVIC_SERVER_IP}:{CIVIC_SERVER_PORT}...")
 
@@ -64,52 +197,100 @@ def connect_to_server():
 
     try:
         s.connect((CIVIC_SERVER_IP, int(CIVIC_SERVER_PORT)))
+        conn = FramedConnection(s)
         logging.info("Successfully connected to the server.")
 
         if CLIENT_UUID:
             logging.info(f"Sending pre-established UUID to server: {CLIENT_UUID}")
-            s.sendall(f"UUID {CLIENT_UUID}".encode("utf-8"))
         else:
             logging.info("Requesting a new UUID from the server...")
-            s.sendall("UUID -1".encode("utf-8"))
+        # Report the cached model binaries so the server can skip sending them again,
+        # and where other citizens can fetch them from
+        conn.send(
+            MessageType.UUID,
+            {
+                "uuid": CLIENT_UUID,
+                "models": cached_models(),
+                "peer_port": start_peer_server(),
+                "peer_host": CIVIC_PEER_HOST,
+                "slots": SLOTS,
+                "prefetch": PREFETCH,
+                "cpus": detect_slots(),
+                "memory": detect_memory(),
+            },
+        )
 
         # Start a thread to listen for messages from the server
         listener_thread = threading.Thread(target=listen_for_messages, daemon=True)
         listener_thread.start()
+        threading.Thread(target=send_results, daemon=True).start()
 
     except socket.error as e:
         logging.error(f"Socket error: {e}")
 
 
+# cached_models()
+# Returns the model binaries in the download directory as {model_id: sha256}.
+# A binary's digest is kept next to it in download/model_<id>.sha256, which is only
+# written once the binary itself has been saved.
+def cached_models():
+    models = {}
+    for file_name in os.listdir("download"):
+        if not (file_name.startswith("model_") and file_name.endswith(".sha256")):
+            continue
+        model_id = file_name[len("model_") : -len(".sha256")]
+        if not os.path.exists(os.path.join("download", f"model_{model_id}.bin")):
+            continue
+        with open(os.path.join("download", file_name), "r") as digest_file:
+            models[model_id] = digest_file.read().strip()
+    return models
+
+
 # listen_for_messages()
 # Listens for messages from the server and handles them accordingly.
 # Spawned by connect_to_server() in a separate thread.
 # It handles messages for UUID, model binary download, execution of binaries, duties, and server shutdown.
 def listen_for_messages():
-    global s
+    global conn
     while True:
         try:
-            response = s.recv(1024)
-
-            if response:
-                message = response.decode()
-                logging.info(f"Received response from server: {message}")
-                if message.startswith("UUID "):
-                    client_uuid = message.split(" ")[1]
-                    logging.info(f"Client UUID: {client_uuid}")
-                    with open("citizen_uuid", "w") as uuid_file:
-                        uuid_file.write(client_uuid)
-                if message.startswith("MODEL_BIN"):
-                    download_binary(message)
-                if message.startswith("EXECUTE"):
-                    execute_binary(message)
-                if message.startswith("DUTY"):
-                    execute_duty(message)
-                if message == "Server is shutting down":
-                    safe_exit()
-
-            else:
+            msg_type, meta, body_len = conn.recv_header()
+            logging.info(
+                f"Received {msg_type.name} from server: "
+                f"{ {key: value for key, value in meta.items() if key not in ('chunks', 'assignments')} }"
+            )
+
+            # Model binaries are streamed to disk; every other body is read whole
+            if msg_type == MessageType.MODEL_BIN:
+                download_binary(meta, body_len)
+                continue
+            body = recv_exact(conn.sock, body_len) if body_len else b""
+
+            if msg_type == MessageType.SWARM:
+                # Swarm downloads run alongside duties
+                threading.Thread(target=swarm_download, args=(meta,), daemon=True).start()
+            elif msg_type == MessageType.UUID:
+                client_uuid = meta["uuid"]
+                logging.info(f"Client UUID: {client_uuid}")
+                with open("citizen_uuid", "w") as uuid_file:
+                    uuid_file.write(client_uuid)
+            elif msg_type == MessageType.EXECUTE:
+                execute_binary(meta)
+            elif msg_type == MessageType.DUTY:
+                # Duties run in the slot pool so the listener keeps reading;
+                # prefetched duties wait in the pool's queue for a free slot
+                duty_pool.submit(execute_duty, meta, body).add_done_callback(
+                    log_duty_failure
+                )
+            elif msg_type == MessageType.ERROR:
+                logging.error(f"Server error: {meta.get('error')}")
+            elif msg_type == MessageType.SHUTDOWN:
                 safe_exit()
+        except ConnectionClosed:
+            safe_exit()
+        except ProtocolError as e:
+            logging.error(f"Protocol error: {e}")
+            safe_exit()
         except socket.error as e:
             logging.error(f"Socket error: {e}")
             break
@@ -117,45 +298,247 @@ def listen_for_messages():
 
 # download_binary()
 # Downloads the model binary from the server.
-def download_binary(message):
-    global s
-
-    logging.info("Downloading model binary from the server...")
-    model_id, binary_size = message.split(" ")[1:3]
-    binary_size = int(binary_size)
-    model_data = b""
+# The binary is the body of the MODEL_BIN frame, `binary_size` bytes long. It is received
+# into a reusable buffer and written straight to a temporary file while its digest is
+# computed, so memory use does not grow with the binary. Verified binaries then replace
+# the cached one atomically, and the server is told the outcome (MODEL_ACK).
+def download_binary(meta, binary_size):
+    global conn
+
+    logging.info(f"Downloading model binary from the server ({binary_size} bytes)...")
+    model_id = meta["model_id"]
+    file_path = os.path.join("download", f"model_{model_id}.bin")
+    temp_path = file_path + ".part"
 
+    digest = hashlib.sha256()
+    buffer = bytearray(DOWNLOAD_BUFFER_SIZE)
+    view = memoryview(buffer)
+    start_time = time.monotonic()
+    last_report = start_time
     received_size = 0
-    while received_size < binary_size:
-        chunk = s.recv(8192)
-        if not chunk:
-            logging.error("Connection lost while downloading binary.")
-            return
-        model_data += chunk
-        received_size += len(chunk)
-        logging.debug(f"Received {received_size}/{binary_size} bytes")
+    with open(temp_path, "wb") as model_file:
+        # Reserve the disk space up front where the filesystem supports it
+        try:
+            os.posix_fallocate(model_file.fileno(), 0, binary_size)
+        except (AttributeError, OSError):
+            pass
+        while received_size < binary_size:
+            n = conn.sock.recv_into(
+                view, min(DOWNLOAD_BUFFER_SIZE, binary_size - received_size)
+            )
+            if n == 0:
+                model_file.close()
+                os.remove(temp_path)
+                raise ConnectionClosed("Connection lost while downloading binary")
+            model_file.write(view[:n])
+            digest.update(view[:n])
+            received_size += n
+
+            now = time.monotonic()
+            if now - last_report >= DOWNLOAD_PROGRESS_SECONDS:
+                last_report = now
+                logging.info(
+                    f"Received {received_size}/{binary_size} bytes "
+                    f"({received_size / (now - start_time) / 2**20:.1f} MiB/s)"
+                )
+
+    # Check the binary against the digest sent by the server
+    digest = digest.hexdigest()
+    if meta.get("sha256") and digest != meta["sha256"]:
+        os.remove(temp_path)
+        logging.error(f"Model {model_id} binary failed its checksum.")
+        report_failed_download(model_id)
+        return
+
+    install_binary(model_id, temp_path, digest)
+    logging.info(
+        f"Model {model_id} binary received from the server and saved to {file_path} "
+        f"in {time.monotonic() - start_time:.1f}s"
+    )
+    conn.send(MessageType.MODEL_ACK, {"model_id": model_id, "sha256": digest})
 
-    # Save the received model binary to a file
+
+# install_binary()
+# Moves a verified, fully written binary into place as download/model_<id>.bin, followed
+# by its digest. The rename is atomic, so a duty starting meanwhile runs either the old
+# binary or the new one, never a partial file.
+def install_binary(model_id, temp_path, digest):
     file_path = os.path.join("download", f"model_{model_id}.bin")
-    with open(file_path, "wb") as model_file:
-        model_file.write(model_data)
+    digest_path = os.path.join("download", f"model_{model_id}.sha256")
+    if os.path.exists(digest_path):
+        os.remove(digest_path)
 
     # Make the file executable
-    os.chmod(file_path, 0o755)
+    os.chmod(temp_path, 0o755)
+    os.replace(temp_path, file_path)
+
+    with open(digest_path, "w") as digest_file:
+        digest_file.write(digest)
+
+
+# report_failed_download()
+# Tells the server a download of a model binary failed (MODEL_ACK without a digest),
+# along with the digest of the binary still installed for the model, if any. A failed
+# download never touches the installed binary.
+def report_failed_download(model_id):
+    conn.send(
+        MessageType.MODEL_ACK,
+        {
+            "model_id": model_id,
+            "sha256": None,
+            "installed": cached_models().get(str(model_id)),
+        },
+    )
 
+
+# cached_binary_path()
+# Returns the path of the cached model binary with the given digest, or None.
+def cached_binary_path(digest):
+    for model_id, model_digest in cached_models().items():
+        if model_digest == digest:
+            return os.path.join("download", f"model_{model_id}.bin")
+    return None
+
+
+# start_peer_server()
+# Starts the peer server if CIVIC_PEER_PORT is set, and returns the port it listens on.
+def start_peer_server():
+    global peer_server
+    if CIVIC_PEER_PORT is None:
+        return None
+    if peer_server is None:
+        peer_server = socketserver.ThreadingTCPServer(
+            ("0.0.0.0", int(CIVIC_PEER_PORT)), PeerHandler
+        )
+        peer_server.daemon_threads = True
+        threading.Thread(target=peer_server.serve_forever, daemon=True).start()
+        logging.info(f"Sharing model binaries on port {peer_server.server_address[1]}")
+    return peer_server.server_address[1]
+
+
+# PeerHandler
+# Serves chunks of cached model binaries to other citizens during a swarm download.
+# A peer connection carries any number of CHUNK_REQUEST/CHUNK exchanges.
+class PeerHandler(socketserver.BaseRequestHandler):
+    def handle(self):
+        peer = FramedConnection(self.request)
+        try:
+            while True:
+                msg_type, meta, _ = peer.recv()
+                if msg_type != MessageType.CHUNK_REQUEST:
+                    raise ProtocolError(f"Unexpected {msg_type.name} from peer")
+                file_path = cached_binary_path(meta["sha256"])
+                if file_path is None:
+                    peer.send(MessageType.ERROR, {"error": "Binary not cached"})
+                    continue
+                with open(file_path, "rb") as model_file:
+                    peer.send_file(
+                        MessageType.CHUNK,
+                        {"sha256": meta["sha256"], "offset": meta["offset"]},
+                        model_file,
+                        meta["length"],
+                        meta["offset"],
+                    )
+        except (ProtocolError, OSError, KeyError):
+            pass
+        finally:
+            peer.close()
+
+
+# swarm_download()
+# Downloads a model binary from other citizens, as coordinated by the server's SWARM
+# message. Each chunk is fetched from its assigned peer (or the next peers if that one
+# fails), verified against its digest, and written at its offset in a temporary file
+# that replaces the binary once it is complete. The server is told the outcome with
+# MODEL_ACK, and sends the binary itself if the swarm download failed.
+def swarm_download(meta):
+    model_id = meta["model_id"]
+    digest = meta["sha256"]
+    size = meta["size"]
+    chunk_size = meta["chunk_size"]
+    chunks = meta["chunks"]
+    peers = meta["peers"]
     logging.info(
-        f"Model {model_id} binary received from the server and saved to {file_path}"
+        f"Downloading model {model_id} binary ({size} bytes, {len(chunks)} chunks) from {len(peers)} peers..."
     )
 
+    file_path = os.path.join("download", f"model_{model_id}.bin")
+    temp_path = file_path + ".swarm"
+    fd = os.open(temp_path, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0o755)
+    indexes = queue.Queue()
+    for index in range(len(chunks)):
+        indexes.put(index)
+    failed = []
+
+    # fetch_chunks()
+    # Worker thread: fetches chunks until none are left, keeping one connection per peer.
+    def fetch_chunks():
+        connections = {}
+        while not failed:
+            try:
+                index = indexes.get_nowait()
+            except queue.Empty:
+                break
+            offset = index * chunk_size
+            length = min(chunk_size, size - offset)
+            first = meta["assignments"][index]
+            for peer in peers[first:] + peers[:first]:
+                try:
+                    if peer not in connections:
+                        host, port = peer.rsplit(":", 1)
+                        connections[peer] = FramedConnection(
+                            socket.create_connection(
+                                (host, int(port)), timeout=SWARM_PEER_TIMEOUT
+                            )
+                        )
+                    connections[peer].send(
+                        MessageType.CHUNK_REQUEST,
+                        {"sha256": digest, "offset": offset, "length": length},
+                    )
+                    msg_type, _, data = connections[peer].recv()
+                    if msg_type != MessageType.CHUNK or len(data) != length:
+                        raise ProtocolError(f"Unexpected {msg_type.name} from peer")
+                    if hashlib.sha256(data).hexdigest() != chunks[index]:
+                        raise ProtocolError("Chunk failed its checksum")
+                    os.pwrite(fd, data, offset)
+                    break
+                except (ProtocolError, OSError) as e:
+                    logging.warning(f"Chunk {index} from peer {peer} failed: {e}")
+                    if peer in connections:
+                        connections.pop(peer).close()
+            else:
+                failed.append(index)
+        for peer_conn in connections.values():
+            peer_conn.close()
+
+    workers = [
+        threading.Thread(target=fetch_chunks, daemon=True)
+        for _ in range(min(SWARM_WORKERS, len(chunks)))
+    ]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    os.close(fd)
+
+    if failed:
+        os.remove(temp_path)
+        logging.error(f"Swarm download of model {model_id} failed (chunk {failed[0]}).")
+        report_failed_download(model_id)
+        return
+
+    install_binary(model_id, temp_path, digest)
+
+    logging.info(f"Model {model_id} binary downloaded from peers and saved to {file_path}")
+    conn.send(MessageType.MODEL_ACK, {"model_id": model_id, "sha256": digest})
+
 
 # execute_binary()
 # Executes the model binary received from the server.
 # Primarily used for testing purposes.
-def execute_binary(message):
-    global s
-
+def execute_binary(meta):
     logging.info("Executing model binary...")
-    model_id = message.split(" ")[1]
+    model_id = meta["model_id"]
     file_path = os.path.join("download", f"model_{model_id}.bin")
 
     # Execute the model binary
@@ -174,67 +557,422 @@ def execute_binary(message):
 # and sends the results back to the server.
 # It also handles the case where the model binary does not exist.
 # The duty is expected to be in JSON format.
-# Runs when an "EXECUTE" message is received from the server.
-def execute_duty(message):
-    global s
+# Runs in one of the citizen's duty slots when a "DUTY" message is received from the server.
+# The duty's input data arrives as the frame body and is written to the input file as-is.
+# A batched duty carries several splits, which are run one after another in this slot
+# and answered with a single compound result.
+# Any unexpected error fails the whole duty, so the server still gets its results and
+# a READY and does not wait on the slot forever.
+def execute_duty(meta, data):
+    try:
+        run_duty(meta, data)
+    except Exception as e:
+        logging.error(f"Duty failed: {e!r}")
+        report_failure(meta)
+
 
+# run_duty()
+# Runs a duty for execute_duty() and queues its result.
+def run_duty(meta, data):
     logging.info("Executing duty...")
-    duty_raw = message.split(" ", 1)[1]
-    duty = json.loads(duty_raw)
+    duty = meta
 
-    #   Example duty
+    #   Example duty (metadata)
     #   {
     #     "id": 1,
     #     "model_id": 2,
-    #     "split_id": 0,
-    #     "data": [
-    #       {
-    #         "letter": "a"
-    #       }
-    #     ],
-    #     "created_at": "2025-03-24 20:40:39.299980"
+    #     "created_at": "2025-03-24 20:40:39.299980",
+    #     "mode": "file"
     #   }
+    #   Example duty (body)
+    #   [{"letter": "a"}]
+    #
+    #   Example batched duty (metadata)
+    #   {"model_id": 2, "mode": "file", "batch": [{"id": 1, ...}, {"id": 2, ...}]}
+    #   Example batched duty (body)
+    #   [[{"letter": "a"}], [{"letter": "b"}]]
 
     # Check if the model binary for the duty exists
     model_id = duty["model_id"]
     file_path = os.path.join("download", f"model_{model_id}.bin")
     if not os.path.exists(file_path):
         logging.error(f"Model {model_id} binary does not exist.")
+        report_failure(duty)
         return
 
-    # Save the "data" field to a input file in the temp directory
-    input_file_path = os.path.join("temp", f"duty_{duty['id']}")
-    with open(input_file_path, "w") as input_file:
-        json.dump(duty["data"], input_file)
-
-    # Execute the model binary with the input file
-    output_file_path = os.path.join("temp", f"duty_{duty['id']}_output")
+    mode = duty.get("mode", "file")
+    start_time = time.monotonic()
+    if "batch" not in duty:
+        output_data = run_split(file_path, model_id, duty["id"], data, mode)
+        if output_data is None:
+            report_failure(duty)
+            return
+        result_meta = {"id": duty["id"], "model_id": model_id}
+    else:
+        outputs = []
+        for split, split_data in zip(duty["batch"], json.loads(data)):
+            output_data = run_split(
+                file_path,
+                model_id,
+                split["id"],
+                json.dumps(split_data).encode("utf-8"),
+                mode,
+            )
+            try:
+                outputs.append(json.loads(output_data) if output_data else None)
+            except ValueError:
+                logging.error(f"Duty {split['id']} output is not valid JSON.")
+                outputs.append(None)
+        output_data = json.dumps(outputs).encode("utf-8")
+        result_meta = {
+            "model_id": model_id,
+            "batch": [split["id"] for split in duty["batch"]],
+        }
+    result_meta["seconds"] = time.monotonic() - start_time
+
+    # Hand the result to the sender thread so this slot can start its next duty
+    result_queue.put((result_meta, output_data))
+
+
+# report_failure()
+# Reports every split of a duty as failed (an empty output), so the server can hand
+# them out again and this slot is sent new work.
+def report_failure(duty):
+    if "batch" in duty:
+        result_meta = {
+            "model_id": duty["model_id"],
+            "batch": [split["id"] for split in duty["batch"]],
+        }
+        output_data = json.dumps([None] * len(duty["batch"])).encode("utf-8")
+    else:
+        result_meta = {"id": duty["id"], "model_id": duty["model_id"]}
+        output_data = b"null"
+    result_queue.put((result_meta, output_data))
+
+
+# Scratch
+# Hands out the files duties are run with. Files are created in a private directory of
+# the memory-backed scratch filesystem when the payload fits, or of temp/ otherwise,
+# and are removed once the duty's result has been sent to the server. Leftovers of
+# earlier runs in temp/ and in the memory-backed filesystem are removed when the
+# citizen starts. The memory-backed filesystem may be shared by several citizens on a
+# host, so its directories are named after the citizen's working directory and only
+# this citizen's are swept.
+class Scratch:
+    def __init__(self, memory_dir, disk_dir):
+        self.lock = threading.Lock()
+        self.files = {}  # {(model_id, duty_id): [paths]}
+        self.fallbacks = 0  # duties that did not fit in memory
+        self.last_report = time.monotonic()
+
+        self.sweep(disk_dir, ("duty_", "civic-"))
+        self.disk_dir = tempfile.mkdtemp(prefix="civic-", dir=disk_dir)
+
+        self.memory_dir = None
+        if memory_dir:
+            owner = hashlib.sha256(os.path.abspath(disk_dir).encode("utf-8")).hexdigest()
+            prefix = f"civic-{owner[:12]}-"
+            try:
+                self.sweep(memory_dir, (prefix,))
+                self.memory_dir = tempfile.mkdtemp(prefix=prefix, dir=memory_dir)
+            except OSError as e:
+                logging.warning(f"Cannot use {memory_dir} for scratch space: {e}")
+        logging.info(f"Duty scratch space: {self.memory_dir or self.disk_dir}")
+
+    # sweep()
+    # Removes the files and directories in `directory` whose names start with one of
+    # `prefixes`, left behind by an earlier run that did not exit cleanly.
+    def sweep(self, directory, prefixes):
+        for name in os.listdir(directory):
+            if name.startswith(prefixes):
+                path = os.path.join(directory, name)
+                if os.path.isdir(path):
+                    shutil.rmtree(path, ignore_errors=True)
+                else:
+                    try:
+                        os.remove(path)
+                    except FileNotFoundError:
+                        pass
+
+    # fits_in_memory()
+    # Whether a payload of `size` bytes, and an output of about the same size, fit in
+    # the memory-backed scratch filesystem.
+    def fits_in_memory(self, size):
+        if self.memory_dir is None or size > SCRATCH_MAX_BYTES:
+            return False
+        try:
+            stat = os.statvfs(self.memory_dir)
+        except OSError:
+            return False
+        return stat.f_bavail * stat.f_frsize > 2 * size
+
+    # paths()
+    # Returns the input and output file paths for a duty with a payload of `size` bytes.
+    def paths(self, model_id, duty_id, size):
+        if self.fits_in_memory(size):
+            directory = self.memory_dir
+        else:
+            directory = self.disk_dir
+            if self.memory_dir is not None:
+                self.fallbacks += 1
+        paths = [
+            os.path.join(directory, f"duty_{model_id}_{duty_id}"),
+            os.path.join(directory, f"duty_{model_id}_{duty_id}_output"),
+        ]
+        with self.lock:
+            self.files.setdefault((model_id, duty_id), []).extend(paths)
+        return paths
+
+    # release()
+    # Removes the files of the given duties of a model.
+    def release(self, model_id, duty_ids):
+        with self.lock:
+            paths = [
+                path
+                for duty_id in duty_ids
+                for path in self.files.pop((model_id, duty_id), [])
+            ]
+        for path in paths:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+        self.report()
+
+    # usage()
+    # Returns the number of duty files and the bytes they take up.
+    def usage(self):
+        with self.lock:
+            paths = [path for duty_paths in self.files.values() for path in duty_paths]
+        used = 0
+        for path in paths:
+            try:
+                used += os.path.getsize(path)
+            except OSError:
+                pass
+        return len(paths), used
+
+    # report()
+    # Logs the scratch usage every SCRATCH_REPORT_SECONDS.
+    def report(self):
+        if time.monotonic() - self.last_report < SCRATCH_REPORT_SECONDS:
+            return
+        self.last_report = time.monotonic()
+        files, used = self.usage()
+        directory = self.memory_dir or self.disk_dir
+        stat = os.statvfs(directory)
+        logging.info(
+            f"Scratch usage: {files} files, {used} bytes in {directory} "
+            f"({stat.f_bavail * stat.f_frsize} bytes free), "
+            f"{self.fallbacks} duties spilled to disk"
+        )
+
+    # close()
+    # Removes the scratch directories.
+    def close(self):
+        for directory in (self.memory_dir, self.disk_dir):
+            if directory:
+                shutil.rmtree(directory, ignore_errors=True)
+
+
+# run_split()
+# Runs the model binary on a single dataset split and returns its output,
+# or None if the model failed.
+# The split's files live in the scratch space until its result has been sent. In pipe
+# mode the input data is fed to the binary on stdin (as the /dev/stdin input file)
+# instead of being written to a file.
+def run_split(file_path, model_id, duty_id, data, mode="file"):
+    if mode == "resident":
+        return run_resident_split(file_path, duty_id, data)
+
+    input_file_path, output_file_path = scratch.paths(model_id, duty_id, len(data))
     try:
-        subprocess.run([file_path, input_file_path, output_file_path], check=True)
-    except subprocess.CalledProcessError as e:
+        timeout = DUTY_TIMEOUT or None
+        if mode == "pipe":
+            subprocess.run(
+                [file_path, "/dev/stdin", output_file_path],
+                input=data,
+                check=True,
+                timeout=timeout,
+            )
+        else:
+            # Save the "data" field to the input file
+            with open(input_file_path, "wb") as input_file:
+                input_file.write(data)
+            # Execute the model binary with the input file
+            subprocess.run(
+                [file_path, input_file_path, output_file_path],
+                check=True,
+                timeout=timeout,
+            )
+            os.remove(input_file_path)
+    except (subprocess.CalledProcessError, subprocess.TimeoutExpired, OSError) as e:
         logging.error(f"Error executing model binary: {e}")
-        return
+        scratch.release(model_id, [duty_id])
+        return None
+
+    logging.info(f"Duty {duty_id} executed.")
 
-    logging.info(f"Duty {duty['id']} executed.")
+    # Read the output file
+    try:
+        with open(output_file_path, "rb") as output_file:
+            output_data = output_file.read()
+    except OSError as e:
+        logging.error(f"Error reading duty {duty_id} output: {e}")
+        scratch.release(model_id, [duty_id])
+        return None
+    logging.info(f"Output data: {len(output_data)} bytes")
+    return output_data
+
+
+# run_resident_split()
+# Runs a dataset split on the slot's resident process of the model binary, starting
+# it if needed. A process that crashes or misbehaves is stopped, failing the split,
+# and a fresh one is started for the next duty.
+def run_resident_split(file_path, duty_id, data):
+    workers = getattr(resident_workers, "workers", None)
+    if workers is None:
+        workers = resident_workers.workers = {}
+
+    worker = workers.get(file_path)
+    if worker is not None and not worker.alive():
+        worker.stop()
+        worker = None
+    if worker is None:
+        try:
+            worker = workers[file_path] = ResidentWorker(file_path)
+        except OSError as e:
+            logging.error(f"Error starting resident model binary: {e}")
+            return None
+
+    try:
+        output_data = worker.run(data, DUTY_TIMEOUT)
+    except (OSError, EOFError) as e:
+        logging.error(f"Resident model binary failed on duty {duty_id}: {e}")
+        worker.stop()
+        del workers[file_path]
+        return None
+
+    logging.info(f"Duty {duty_id} executed.")
+    logging.info(f"Output data: {len(output_data)} bytes")
+    return output_data
+
+
+# ResidentWorker
+# A long-running process of a model binary, started as `<binary> --resident`. Each
+# duty is written to its stdin as a 4-byte big-endian length followed by the input
+# data (JSON), and the output data is read back from its stdout in the same framing.
+# The process is replaced once the binary on disk changes.
+class ResidentWorker:
+    LENGTH = struct.Struct("!I")
+
+    def __init__(self, file_path):
+        self.file_path = file_path
+        self.binary = self.binary_stat()
+        self.expired = False
+        self.process = subprocess.Popen(
+            [file_path, "--resident"], stdin=subprocess.PIPE, stdout=subprocess.PIPE
+        )
+        logging.info(
+            f"Started resident model binary {file_path} (pid {self.process.pid})"
+        )
+
+    def binary_stat(self):
+        stat = os.stat(self.file_path)
+        return (stat.st_ino, stat.st_mtime_ns)
+
+    def alive(self):
+        if self.process.poll() is not None:
+            logging.warning(
+                f"Resident model binary {self.file_path} exited with code {self.process.returncode}"
+            )
+            return False
+        try:
+            return self.binary_stat() == self.binary
+        except OSError:
+            return False
+
+    # run()
+    # Runs one split. A process that takes longer than `timeout` seconds is killed,
+    # which fails the split with a TimeoutError.
+    def run(self, data, timeout=0):
+        self.expired = False
+        timer = threading.Timer(timeout, self.expire) if timeout else None
+        if timer:
+            timer.start()
+        try:
+            self.process.stdin.write(self.LENGTH.pack(len(data)) + data)
+            self.process.stdin.flush()
+            (length,) = self.LENGTH.unpack(self.read(self.LENGTH.size))
+            return self.read(length)
+        except (OSError, EOFError):
+            if self.expired:
+                raise TimeoutError(f"No output after {timeout} seconds")
+            raise
+        finally:
+            if timer:
+                timer.cancel()
+
+    def expire(self):
+        self.expired = True
+        self.process.kill()
+
+    def read(self, size):
+        data = self.process.stdout.read(size)
+        if len(data) < size:
+            raise EOFError("Resident model binary closed its output")
+        return data
+
+    def stop(self):
+        for pipe in (self.process.stdin, self.process.stdout):
+            try:
+                pipe.close()
+            except OSError:
+                pass
+        try:
+            self.process.wait(timeout=5)
+        except subprocess.TimeoutExpired:
+            self.process.kill()
+            self.process.wait()
+
+
+# send_results()
+# Sends finished duties' results to the server, followed by one READY asking for as
+# many new duties as were finished. Runs in its own thread, so slots never wait on
+# the network between duties.
+def send_results():
+    while True:
+        results = [result_queue.get()]
+        while not result_queue.empty():
+            results.append(result_queue.get_nowait())
+        try:
+            for meta, output_data in results:
+                conn.send(MessageType.RESULTS, meta, output_data)
+                scratch.release(
+                    meta["model_id"], meta["batch"] if "batch" in meta else [meta["id"]]
+                )
+            conn.send(MessageType.READY, {"count": len(results)})
+        except socket.error as e:
+            logging.error(f"Socket error: {e}")
+            return
 
-    # Read the output file and send the result back to the server
-    with open(output_file_path, "r") as output_file:
-        output_data = output_file.read()
-        logging.info(f"Output data: {output_data}")
 
-    s.sendall(f"RESULTS {duty['id']} {duty['model_id']} {output_data}".encode("utf-8"))
-    s.sendall(f"READY".encode("utf-8"))
+# log_duty_failure()
+# Logs an unexpected error raised by a duty running in the slot pool.
+def log_duty_failure(future):
+    if future.exception() is not None:
+        logging.error(f"Duty failed: {future.exception()}")
 
 
 # safe_exit()
 # Safely exits the program and closes the socket connection.
 def safe_exit(*args):
-    global s
+    global conn
     logging.info("Closing connection...")
-    if s:
+    if conn:
         try:
-            s.sendall("EXIT".encode("utf-8"))
-            s.close()
+            conn.send(MessageType.EXIT)
+            conn.close()
         except socket.error as e:
             logging.error(f"Socket error: {e}")
     sys.exit(0)
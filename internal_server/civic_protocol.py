@@ -0,0 +1,274 @@
+"""
+CIVIC wire protocol.
+
+Every message exchanged between the internal server and a citizen is a frame:
+
+    +----------+--------------+--------------+-----------------+-------------+
+    | type (1) | meta_len (4) | body_len (8) | meta (meta_len) | body (body_len)
+    +----------+--------------+--------------+-----------------+-------------+
+
+All integers are unsigned and in network byte order. `meta` is a UTF-8 JSON
+object carrying the control fields of the message (model IDs, duty IDs, ...),
+and `body` is an optional raw payload (duty input, result output, model binary)
+that is sent as-is, without any re-encoding.
+
+This module is shared by both sides of the connection. The internal server and
+the citizen are built from separate Docker contexts, so a copy lives in both
+internal_server/ and internal_client/; keep the two files identical.
+
+Blocking-socket helpers (FramedConnection) are used by the threaded citizen, and
+asyncio stream helpers (StreamConnection) by the internal server's event loop.
+"""
+
+import asyncio
+import enum
+import json
+import socket
+import struct
+import threading
+
+HEADER = struct.Struct("!BIQ")
+
+# Upper bound for the JSON metadata of a single frame. Large payloads belong in
+# the body, so anything bigger than this is treated as a corrupt stream.
+MAX_META_SIZE = 1024 * 1024
+
+# Upper bound for the body of a frame that is read into memory whole. body_len
+# comes from the peer, so a corrupt or hostile header must not be able to make
+# the receiver allocate an arbitrary amount of memory. Model binaries are
+# streamed to disk (recv_header() + recv_into()) and are exempt.
+MAX_BODY_SIZE = 256 * 1024 * 1024
+
+# Size of the slices used when reading a body from the socket.
+CHUNK_SIZE = 64 * 1024
+
+
+class MessageType(enum.IntEnum):
+    # handshake: {"uuid": str | None, "models": {model_id: sha256} (cached binaries),
+    #             "peer_port": int | None, "peer_host": str | None, "slots": int, "prefetch": int,
+    #             "cpus": int, "memory": int | None (bytes)}
+    UUID = 1
+    READY = 2  # citizen is ready for more work: {"count": int} duties (default 1)
+    # meta: duty fields and "mode" (the model's execution mode: file, pipe or resident),
+    #       body: duty input data (JSON)
+    # batched: meta: {"model_id", "mode", "batch": [duty fields, ...]}, body: JSON list of input data
+    DUTY = 3
+    NONE = 4  # no duties are available
+    # meta: {"id", "model_id", "seconds"}, body: model output (null if failed)
+    # batched: meta: {"model_id", "batch": [id, ...], "seconds"}, body: JSON list of outputs (null if failed)
+    RESULTS = 5
+    MODEL_BIN = 6  # meta: {"model_id", "sha256"}, body: model binary
+    EXECUTE = 7  # meta: {"model_id"}
+    EXIT = 8  # citizen is disconnecting
+    SHUTDOWN = 9  # server is shutting down
+    ERROR = 10  # meta: {"error": str}
+    # meta: {"model_id", "sha256"}, binary saved; if it failed, sha256 is None and
+    # "installed" is the digest of the binary the citizen still has (None if none)
+    MODEL_ACK = 11
+    # meta: {"model_id", "sha256", "size", "chunk_size", "chunks": [sha256, ...],
+    #        "peers": ["host:port", ...], "assignments": [peer index for each chunk]}
+    SWARM = 12
+    CHUNK_REQUEST = 13  # citizen to citizen: {"sha256", "offset", "length"}
+    CHUNK = 14  # citizen to citizen: meta: {"sha256", "offset"}, body: chunk
+
+
+class ProtocolError(Exception):
+    pass
+
+
+class ConnectionClosed(ProtocolError):
+    pass
+
+
+# encode_header()
+# Builds the header and metadata of a frame. The body (if any) is sent separately
+# so large payloads never have to be copied into a single buffer.
+def encode_header(msg_type, meta=None, body_len=0):
+    meta_bytes = json.dumps(meta or {}, default=str).encode("utf-8")
+    if len(meta_bytes) > MAX_META_SIZE:
+        raise ProtocolError(f"Metadata too large ({len(meta_bytes)} bytes)")
+    return HEADER.pack(int(msg_type), len(meta_bytes), body_len) + meta_bytes
+
+
+# decode_header()
+# Unpacks a frame header into its message type, metadata length and body length.
+def decode_header(header):
+    type_value, meta_len, body_len = HEADER.unpack(header)
+    try:
+        msg_type = MessageType(type_value)
+    except ValueError:
+        raise ProtocolError(f"Unknown message type {type_value}")
+    if meta_len > MAX_META_SIZE:
+        raise ProtocolError(f"Metadata too large ({meta_len} bytes)")
+    if body_len > MAX_BODY_SIZE and msg_type != MessageType.MODEL_BIN:
+        raise ProtocolError(f"Body too large ({body_len} bytes)")
+    return msg_type, meta_len, body_len
+
+
+# decode_meta()
+# Decodes the JSON metadata of a frame.
+def decode_meta(meta_bytes):
+    if not meta_bytes:
+        return {}
+    try:
+        return json.loads(meta_bytes.decode("utf-8"))
+    except ValueError as e:
+        raise ProtocolError(f"Invalid metadata: {e}")
+
+
+# recv_exact()
+# Reads exactly `size` bytes from a blocking socket.
+def recv_exact(sock, size):
+    buffer = bytearray(size)
+    view = memoryview(buffer)
+    received = 0
+    while received < size:
+        n = sock.recv_into(view[received:], min(size - received, CHUNK_SIZE))
+        if n == 0:
+            raise ConnectionClosed("Connection closed by peer")
+        received += n
+    return bytes(buffer)
+
+
+# recv_header()
+# Reads the header and metadata of the next frame from a blocking socket.
+# The caller is responsible for consuming the `body_len` bytes of body that follow.
+def recv_header(sock):
+    msg_type, meta_len, body_len = decode_header(recv_exact(sock, HEADER.size))
+    meta = decode_meta(recv_exact(sock, meta_len))
+    return msg_type, meta, body_len
+
+
+# recv_message()
+# Reads a complete frame (header, metadata and body) from a blocking socket.
+def recv_message(sock):
+    msg_type, meta, body_len = recv_header(sock)
+    if body_len > MAX_BODY_SIZE:
+        raise ProtocolError(f"Body too large ({body_len} bytes)")
+    body = recv_exact(sock, body_len) if body_len else b""
+    return msg_type, meta, body
+
+
+# send_message()
+# Writes a complete frame to a blocking socket.
+def send_message(sock, msg_type, meta=None, body=b""):
+    sock.sendall(encode_header(msg_type, meta, len(body)))
+    if body:
+        sock.sendall(body)
+
+
+# FramedConnection
+# Wraps a blocking socket so that frames written from several threads never interleave.
+class FramedConnection:
+    def __init__(self, sock):
+        self.sock = sock
+        self.send_lock = threading.Lock()
+
+    def send(self, msg_type, meta=None, body=b""):
+        with self.send_lock:
+            send_message(self.sock, msg_type, meta, body)
+
+    # send_file()
+    # Sends a frame whose body is `size` bytes of a file opened in binary mode,
+    # starting at `offset`, using zero-copy sendfile() where available.
+    def send_file(self, msg_type, meta, file, size, offset=0):
+        with self.send_lock:
+            self.sock.sendall(encode_header(msg_type, meta, size))
+            sent = self.sock.sendfile(file, offset, size)
+            if sent != size:
+                raise ProtocolError(f"File ended after {sent} of {size} bytes")
+
+    def recv(self):
+        return recv_message(self.sock)
+
+    def recv_header(self):
+        return recv_header(self.sock)
+
+    def close(self):
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.sock.close()
+
+
+# read_exact()
+# Reads exactly `size` bytes from an asyncio StreamReader.
+async def read_exact(reader, size):
+    try:
+        return await reader.readexactly(size)
+    except asyncio.IncompleteReadError:
+        raise ConnectionClosed("Connection closed by peer")
+
+
+# read_header()
+# Reads the header and metadata of the next frame from an asyncio StreamReader.
+# The caller is responsible for consuming the `body_len` bytes of body that follow.
+async def read_header(reader):
+    msg_type, meta_len, body_len = decode_header(
+        await read_exact(reader, HEADER.size)
+    )
+    meta = decode_meta(await read_exact(reader, meta_len))
+    return msg_type, meta, body_len
+
+
+# read_message()
+# Reads a complete frame (header, metadata and body) from an asyncio StreamReader.
+async def read_message(reader):
+    msg_type, meta, body_len = await read_header(reader)
+    if body_len > MAX_BODY_SIZE:
+        raise ProtocolError(f"Body too large ({body_len} bytes)")
+    body = await read_exact(reader, body_len) if body_len else b""
+    return msg_type, meta, body
+
+
+# StreamConnection
+# Wraps an asyncio stream pair. Frames are sent under a lock, so frames sent by
+# concurrent tasks never interleave, even when a body is streamed from a file.
+class StreamConnection:
+    def __init__(self, reader, writer):
+        self.reader = reader
+        self.writer = writer
+        self.send_lock = asyncio.Lock()
+
+    async def send(self, msg_type, meta=None, body=b""):
+        async with self.send_lock:
+            self.writer.write(encode_header(msg_type, meta, len(body)))
+            if body:
+                self.writer.write(body)
+            await self.writer.drain()
+
+    # send_file()
+    # Sends a frame whose body is the first `size` bytes of a file opened in binary
+    # mode. The body goes out with zero-copy sendfile() where the transport supports
+    # it, in slices of `slice_size`; `progress(sent)` is called after every slice.
+    async def send_file(
+        self, msg_type, meta, file, size, progress=None, slice_size=8 * 1024 * 1024
+    ):
+        loop = asyncio.get_running_loop()
+        async with self.send_lock:
+            self.writer.write(encode_header(msg_type, meta, size))
+            await self.writer.drain()
+            sent = 0
+            while sent < size:
+                count = await loop.sendfile(
+                    self.writer.transport, file, sent, min(slice_size, size - sent)
+                )
+                if count == 0:
+                    raise ProtocolError(f"File ended after {sent} of {size} bytes")
+                sent += count
+                if progress:
+                    progress(sent)
+
+    async def recv(self):
+        return await read_message(self.reader)
+
+    async def recv_header(self):
+        return await read_header(self.reader)
+
+    async def close(self):
+        self.writer.close()
+        try:
+            await self.writer.wait_closed()
+        except (OSError, asyncio.CancelledError):
+            pass
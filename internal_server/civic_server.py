@@ -1,17 +1,77 @@
-import socket
+import asyncio
 import threading
 import logging
 import signal
 import curses
-import requests
+import aiohttp
 import time
 import os
 import json
 import prettytable
-import queue
+import collections
+import hashlib
+import random
+import math
+
+from civic_protocol import (
+    ConnectionClosed,
+    MessageType,
+    ProtocolError,
+    StreamConnection,
+)
+from scheduler import create_scheduler
 
 middleware_url = "http://civic-middleware:5000"
 
+# How long a citizen may hold a duty before the ledger hands it out again
+duty_lease_seconds = int(os.getenv("CIVIC_DUTY_LEASE_SECONDS", "300"))
+# Extra copies of an outstanding duty handed to idle citizens once the ledger
+# runs dry (0 disables speculative execution); the first result wins
+speculative_copies = int(os.getenv("CIVIC_SPECULATIVE_COPIES", "1"))
+# Duties queued at a citizen on top of one per slot, for citizens that do not say
+duty_prefetch = int(os.getenv("CIVIC_DUTY_PREFETCH", "1"))
+# Batch mode: splits are packed into dispatches that take about this many seconds on
+# the citizen (0 sends one split per dispatch), with at most duty_batch_max splits each
+duty_batch_seconds = float(os.getenv("CIVIC_DUTY_BATCH_SECONDS", "0"))
+duty_batch_max = int(os.getenv("CIVIC_DUTY_BATCH_MAX", "100"))
+# Number of finished duties remembered for discarding late speculative results
+completed_history_size = 100000
+# Results are uploaded to the middleware in batches of up to this many rows...
+result_batch_size = int(os.getenv("CIVIC_RESULT_BATCH_SIZE", "500"))
+# ...or once the oldest buffered result is this many seconds old
+result_batch_seconds = float(os.getenv("CIVIC_RESULT_BATCH_SECONDS", "1.0"))
+# Results buffered before citizens are made to wait for uploads to catch up
+result_buffer_size = int(os.getenv("CIVIC_RESULT_BUFFER_SIZE", "10000"))
+
+# Number of citizens a model binary is sent to at the same time
+distribution_concurrency = int(os.getenv("CIVIC_DISTRIBUTION_CONCURRENCY", "32"))
+# Seconds a single citizen may take to receive a model binary
+distribution_timeout = float(os.getenv("CIVIC_DISTRIBUTION_TIMEOUT", "600"))
+# Seconds between progress reports for each citizen receiving a model binary
+distribution_progress_seconds = 5
+# Swarm distribution: chunk size of the per-chunk hashes, clients sent the binary
+# directly while there are no seeds, clients each seed serves at once, and seeds
+# a single client downloads from
+swarm_chunk_size = int(os.getenv("CIVIC_SWARM_CHUNK_SIZE", str(4 * 1024 * 1024)))
+swarm_seed_count = int(os.getenv("CIVIC_SWARM_SEEDS", "4"))
+swarm_uploads_per_peer = int(os.getenv("CIVIC_SWARM_UPLOADS_PER_PEER", "4"))
+swarm_peers_per_client = 8
+# Size of the slices used when downloading and hashing model binaries
+binary_chunk_size = 1024 * 1024
+
+
+# file_sha256()
+# Computes the hex SHA-256 digest of a file, reading it in slices.
+def file_sha256(file_path):
+    digest = hashlib.sha256()
+    with open(file_path, "rb") as f:
+        while True:
+            chunk = f.read(binary_chunk_size)
+            if not chunk:
+                break
+            digest.update(chunk)
+    return digest.hexdigest()
+
 
 # CursesLoggerHandler
 # Custom logging handler to display logs in a curses window
@@ -41,8 +101,157 @@ class CursesLoggerHandler(logging.Handler):
             self.handleError(record)
 
 
+# ResultUploader
+# Buffers results received from citizens and uploads them to the middleware in
+# batches, flushing when a batch is full or its oldest result is too old.
+# The buffer is bounded: when the middleware falls behind, put() waits, which in
+# turn stops reading from the citizen until there is room again.
+# `on_upload` is awaited with the model id and the middleware's summary of every
+# uploaded batch, and `on_drop` awaited with the model id and the results of a batch
+# that could not be uploaded.
+class ResultUploader:
+    def __init__(
+        self,
+        http,
+        batch_size,
+        batch_seconds,
+        buffer_size,
+        retries=5,
+        on_upload=None,
+        on_drop=None,
+    ):
+        self.http = http
+        self.on_upload = on_upload
+        self.on_drop = on_drop
+        self.batch_size = batch_size
+        self.batch_seconds = batch_seconds
+        self.retries = retries
+        self.buffer = asyncio.Queue(maxsize=buffer_size)
+        self.task = None
+
+    def start(self):
+        self.task = asyncio.create_task(self.run())
+
+    # put()
+    # Adds a result ({"client_uuid", "id", "model_id", "data", "claimant"}) to the
+    # buffer. "claimant" is the client holding the duty's lease in the ledger, which
+    # differs from "client_uuid" when a speculative copy finished first.
+    async def put(self, result):
+        await self.buffer.put(result)
+
+    # run()
+    # Collects results into batches and uploads them until cancelled.
+    async def run(self):
+        while True:
+            batch = [await self.buffer.get()]
+            deadline = time.monotonic() + self.batch_seconds
+            while len(batch) < self.batch_size:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self.buffer.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+            # A failed batch must not stop the uploader, or put() blocks for good
+            try:
+                await self.upload(batch)
+            except Exception as e:
+                logging.error(f"Failed to upload a batch of {len(batch)} results: {e}")
+
+    # upload()
+    # Uploads a batch, one request per model.
+    async def upload(self, batch):
+        by_model = {}
+        for result in batch:
+            by_model.setdefault(result["model_id"], []).append(result)
+
+        for model_id, results in by_model.items():
+            await self.upload_model_results(model_id, results)
+
+    # upload_model_results()
+    # Uploads results of one model, retrying with backoff while the middleware cannot
+    # be reached or fails. Results the middleware rejects (4xx) are not retried; the
+    # batch is split in half until the bad results are isolated. Results that still
+    # fail are dropped and handed to `on_drop`, so their duties can be run again.
+    async def upload_model_results(self, model_id, results):
+        rejected = None
+        for attempt in range(self.retries):
+            try:
+                async with self.http.post(
+                    f"{middleware_url}/upload_results/{model_id}",
+                    json=[
+                        {
+                            "client_uuid": result["client_uuid"],
+                            "id": result["id"],
+                            "data": result["data"],
+                        }
+                        for result in results
+                    ],
+                ) as response:
+                    if 400 <= response.status < 500:
+                        rejected = f"{response.status} {await response.text()}"
+                        break
+                    response.raise_for_status()
+                    summary = await response.json()
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                logging.error(
+                    f"Failed to upload {len(results)} results for model {model_id} "
+                    f"(attempt {attempt + 1}/{self.retries}): {e!r}"
+                )
+                if attempt + 1 < self.retries:
+                    await asyncio.sleep(2**attempt)
+                continue
+
+            logging.debug(f"Uploaded {len(results)} results for model {model_id}")
+            if self.on_upload:
+                try:
+                    await self.on_upload(model_id, summary)
+                except Exception as e:
+                    logging.error(f"Failed to handle upload of model {model_id}: {e}")
+            return
+
+        if rejected is not None and len(results) > 1:
+            logging.warning(
+                f"Middleware rejected {len(results)} results for model {model_id} "
+                f"({rejected}); splitting the batch"
+            )
+            half = len(results) // 2
+            await self.upload_model_results(model_id, results[:half])
+            await self.upload_model_results(model_id, results[half:])
+            return
+
+        logging.error(
+            f"Dropping {len(results)} results for model {model_id}"
+            + (f", rejected by the middleware: {rejected}" if rejected else "")
+        )
+        if self.on_drop:
+            try:
+                await self.on_drop(model_id, results)
+            except Exception as e:
+                logging.error(f"Failed to handle dropped results of model {model_id}: {e}")
+
+    # close()
+    # Stops the background task and uploads whatever is still buffered.
+    async def close(self):
+        if self.task:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+        batch = []
+        while not self.buffer.empty():
+            batch.append(self.buffer.get_nowait())
+        if batch:
+            await self.upload(batch)
+
+
 # Define the CIVICServer class
 # This class handles the server-side operations, including client connections,
+# Citizen connections and middleware calls are all served from a single asyncio
+# event loop; the curses console runs in its own thread and hands its commands
+# to the loop.
 class CIVICServer:
     def __init__(self, stdscr, host="0.0.0.0", port=24842):
         self.stdscr = stdscr
@@ -51,16 +260,32 @@ class CIVICServer:
         self.port = port
         self.clients = {}
         self.logger_handler = None
-        self.server_socket = None
+        self.server = None
         self.server_command_thread = None
-        self.duties = queue.Queue()
+        self.loop = None
+        self.http = None
+        self.uploader = None
+        self.stopped = None
+        # Decides which models' duties each citizen is handed, and how many
+        self.scheduler = create_scheduler()
+        # Outstanding duties, keyed by (model_id, duty_id):
+        # {"duty": dict, "claimant": uuid, "holders": set of uuids, "expires_at": float | None}
+        self.leases = {}
+        # Recently finished duties, to recognise late copies of speculative duties
+        self.completed = collections.OrderedDict()
+        # Binaries cached by each connected citizen: {uuid: {model_id: sha256}}
+        self.client_models = {}
+        # Peer servers of the citizens that share binaries: {uuid: "host:port"}
+        self.client_peers = {}
+        # Futures waiting for a citizen's MODEL_ACK, keyed by (uuid, model_id)
+        self.model_acks = {}
 
         # Init. the server
         self.init_server()
 
     # init_server()
-    # Initializes the server by creating a "download" folder, setting up logging,
-    # and starting the server socket.
+    # Initializes the server by creating a "download" folder and setting up logging.
+    # The listening socket itself is opened by serve() once the event loop is running.
     def init_server(self):
         # Create a "download" folder if it doesn't exist
         if not os.path.exists("download"):
@@ -73,11 +298,6 @@ class CIVICServer:
 
         # Start the server
         self.server_running = True
-        # Make and open the server socket
-        self.server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.server_socket.bind((self.host, self.port))
-        self.server_socket.listen(5)
-        logging.info(f"Server started on {self.host}:{self.port}")
 
     # handle_server_commands()
     # Handles server commands entered by the user in the terminal.
@@ -131,6 +351,20 @@ class CIVICServer:
             except Exception as e:
                 logging.error(f"Error handling input: {e}")
 
+    # run_command()
+    # Runs a server command coroutine on the event loop from the console thread
+    # and waits for it to finish, so commands still execute one after another.
+    def run_command(self, coro):
+        if self.loop is None:
+            coro.close()
+            logging.warning("Server is still starting. Please try again.")
+            return
+        future = asyncio.run_coroutine_threadsafe(coro, self.loop)
+        try:
+            future.result()
+        except Exception as e:
+            logging.error(f"Command failed: {e}")
+
     # parse_server_command()
     # Parses the server command entered by the user and executes the corresponding function.
     # Receives input from the handle_server_commands() thread.
@@ -148,26 +382,35 @@ class CIVICServer:
             logging.info(
                 "  distribute <model_id> <range_start> <range_end> - Distribute a model binary to a range of clients."
             )
+            logging.info(
+                "  swarm <model_id> <range_start> <range_end> - Distribute a model binary to a range of clients, with citizens sharing it between themselves."
+            )
             logging.info(
                 "  execute <model_id> <range_start> <range_end> - Execute a model binary on a range of clients."
             )
             logging.info(
-                "  generate_duties <model_id> <range_start> <range_end> - Generate duties for a model and distribute them to clients."
+                "  generate_duties <model_id> <range_start> <range_end> [priority] - Generate duties for a model and distribute them to clients."
+            )
+            logging.info(
+                "  priority <model_id> <priority> - Change a model's share of duties while several models are run."
+            )
+            logging.info(
+                "  schedule - Show the models being run and the citizens' capacity."
             )
             logging.info("  shutdown - Shut down the server.")
             logging.info("  exit, quit, q - Detach from the server console.")
         elif cmd in ["exit", "quit", "q"]:
             logging.info("To detach from the server console, use Ctrl+D.")
         elif cmd in ["clients", "citizens", "lc"]:
-            self.list_clients()
+            self.run_command(self.list_clients())
         elif cmd in ["models", "lm"]:
-            self.list_models()
+            self.run_command(self.list_models())
         elif cmd == "download":
             if not cmd_args:
                 logging.info("Usage: download <model_id>")
             else:
                 model_id = cmd_args[0]
-                self.download_binary(model_id)
+                self.run_command(self.download_binary(model_id))
         elif cmd == "distribute":
             if len(cmd_args) < 3:
                 logging.info("Usage: distribute <model_id> <range_start> <range_end>")
@@ -175,7 +418,15 @@ class CIVICServer:
                 model_id = cmd_args[0]
                 range_start = int(cmd_args[1])
                 range_end = int(cmd_args[2])
-                self.distribute_binary(model_id, range_start, range_end)
+                self.run_command(self.distribute_binary(model_id, range_start, range_end))
+        elif cmd == "swarm":
+            if len(cmd_args) < 3:
+                logging.info("Usage: swarm <model_id> <range_start> <range_end>")
+            else:
+                model_id = cmd_args[0]
+                range_start = int(cmd_args[1])
+                range_end = int(cmd_args[2])
+                self.run_command(self.swarm_binary(model_id, range_start, range_end))
         elif cmd == "execute":
             if len(cmd_args) < 3:
                 logging.info("Usage: execute <model_id> <range_start> <range_end>")
@@ -183,17 +434,29 @@ class CIVICServer:
                 model_id = cmd_args[0]
                 range_start = int(cmd_args[1])
                 range_end = int(cmd_args[2])
-                self.execute_binary(model_id, range_start, range_end)
+                self.run_command(self.execute_binary(model_id, range_start, range_end))
         elif cmd == "generate_duties":
             if len(cmd_args) < 2:
                 logging.info(
-                    "Usage: generate_duties <model_id> <range_start> <range_end>"
+                    "Usage: generate_duties <model_id> <range_start> <range_end> [priority]"
                 )
             else:
                 model_id = cmd_args[0]
                 range_start = int(cmd_args[1])
                 range_end = int(cmd_args[2])
-                self.generate_duties(model_id, range_start, range_end)
+                priority = float(cmd_args[3]) if len(cmd_args) > 3 else 1
+                self.run_command(
+                    self.generate_duties(model_id, range_start, range_end, priority)
+                )
+        elif cmd == "priority":
+            if len(cmd_args) < 2:
+                logging.info("Usage: priority <model_id> <priority>")
+            else:
+                self.run_command(
+                    self.set_model_priority(cmd_args[0], float(cmd_args[1]))
+                )
+        elif cmd == "schedule":
+            self.run_command(self.show_schedule())
 
         elif cmd == "shutdown":
             os.kill(os.getpid(), signal.SIGINT)
@@ -204,93 +467,112 @@ class CIVICServer:
     # Handles a new client connection and manages communication with the client.
     # It receives messages from the client, updates the database with the client's connection status,
     # and sends duties to the client.
-    def handle_client(self, client_socket, address):
+    # Runs as one asyncio task per connection (see serve()).
+    async def handle_client(self, reader, writer):
         # Handle a new client connection
+        address = writer.get_extra_info("peername")
         logging.info(f"New connection from {address}")
+        conn = StreamConnection(reader, writer)
 
         # Handle the initial connection setup
-        while True:
+        try:
+            # Receive the client's startup message
+            msg_type, meta, _ = await conn.recv()
+            if msg_type != MessageType.UUID:
+                raise ProtocolError(f"Expected UUID, got {msg_type.name}")
+
+            if not meta.get("uuid"):
+                # New client--add to database
+                client_uuid = await self.db_update_client_connection(
+                    address[0], address[1], 1
+                )
+            else:
+                # Existing client--update database
+                client_uuid = await self.db_update_client_connection(
+                    address[0], address[1], 1, meta["uuid"]
+                )
+                if client_uuid == -1:
+                    raise Exception("UUID not found in database")
+
+            self.clients[client_uuid] = conn
+            # Remember which binaries the citizen already has
+            self.client_models[client_uuid] = {
+                int(model_id): digest
+                for model_id, digest in (meta.get("models") or {}).items()
+            }
+            # Duties kept at the citizen: one per slot, plus a prefetch backlog
+            self.scheduler.add_client(
+                client_uuid,
+                max(1, int(meta.get("slots") or 1)),
+                max(0, int(meta.get("prefetch", duty_prefetch))),
+                meta.get("cpus"),
+                meta.get("memory"),
+            )
+            if meta.get("peer_port"):
+                peer_host = meta.get("peer_host") or address[0]
+                self.client_peers[client_uuid] = f"{peer_host}:{meta['peer_port']}"
+            # Send uuid to client
+            await conn.send(MessageType.UUID, {"uuid": str(client_uuid)})
+        except Exception as e:
+            logging.error(f"Error receiving UUID from client: {e}")
             try:
-                # Receive the client's startup message
-                client_startup_message = client_socket.recv(1024).decode("utf-8")
+                await conn.send(MessageType.ERROR, {"error": "Invalid UUID"})
+            except OSError:
+                pass
+            await conn.close()
+            return
 
-                if client_startup_message.startswith("UUID -1"):
-                    # New client--add to database
-                    client_uuid = self.db_update_client_connection(
-                        address[0], address[1], 1
-                    )
-                    self.clients[client_uuid] = client_socket
-                    # Send uuid to client
-                    client_socket.send(("UUID " + str(client_uuid)).encode("utf-8"))
-                    break
-                elif client_startup_message.startswith("UUID "):
-                    # Existing client--update database
-                    client_uuid = client_startup_message.split(" ")[1]
-                    client_uuid = self.db_update_client_connection(
-                        address[0], address[1], 1, client_uuid
-                    )
-                    if client_uuid == -1:
-                        raise Exception("UUID not found in database")
-                    else:
-                        self.clients[client_uuid] = client_socket
-                        # Send uuid to client
-                        client_socket.send(
-                            # Existing client--update database
-                            ("UUID " + str(client_uuid)).encode("utf-8")
-                        )
-                        break
-            except Exception as e:
-                logging.error(f"Error receiving UUID from client: {e}")
-                client_socket.send("Invalid UUID".encode("utf-8"))
-                client_socket.close()
-                return
+        # A reconnecting citizen may already hold the binary of a model being run
+        if self.runnable_models(client_uuid):
+            await self.top_up_client(client_uuid)
 
         # Handle all other messages from the client
         while True:
             try:
-                message = client_socket.recv(1024).decode("utf-8")
-                if message:
-                    logging.debug(f"Received message from {address}: {message}")
-                    # Handle client responses here
-                    if message == "EXIT":
-                        logging.info(f"Connection from {address} closed")
-                        self.db_update_client_connection(
-                            address[0], address[1], 0, client_uuid=client_uuid
-                        )
-                        if client_uuid in self.clients:
-                            del self.clients[client_uuid]
-                        client_socket.close()
-                        break
-                    if message.startswith("RESULTS"):
-                        # Handle results from the client
-                        self.handle_results(client_uuid, message)
-                    if message == ("READY"):
-                        # Send the next duty to the client
-                        self.send_duty(client_socket)
-                else:
+                msg_type, meta, body = await conn.recv()
+                logging.debug(f"Received {msg_type.name} from {address}: {meta}")
+                # Handle client responses here
+                if msg_type == MessageType.EXIT:
+                    logging.info(f"Connection from {address} closed")
                     break
-            except ConnectionResetError:
+                elif msg_type == MessageType.RESULTS:
+                    # Handle results from the client
+                    await self.handle_results(client_uuid, meta, body)
+                elif msg_type == MessageType.READY:
+                    # Send the next duty (or duties) to the client
+                    await self.send_duty(client_uuid, conn, meta.get("count", 1))
+                elif msg_type == MessageType.MODEL_ACK:
+                    self.handle_model_ack(client_uuid, meta)
+            except (ConnectionClosed, ConnectionResetError):
                 logging.info(f"Connection from {address} lost")
-                if client_socket in self.clients:
-                    self.clients.remove(client_socket)
-                self.db_update_client_connection(
-                    address[0], address[1], 0, client_uuid=client_uuid
-                )
                 break
             except Exception as e:
                 logging.error(f"An error occurred with connection from {address}: {e}")
-                if client_socket in self.clients:
-                    self.clients.remove(client_socket)
-                self.db_update_client_connection(
-                    address[0], address[1], 0, client_uuid=client_uuid
-                )
                 break
 
+        if self.clients.get(client_uuid) is conn:
+            del self.clients[client_uuid]
+            self.client_models.pop(client_uuid, None)
+            self.client_peers.pop(client_uuid, None)
+            self.scheduler.remove_client(client_uuid)
+            for key in [key for key in self.model_acks if key[0] == client_uuid]:
+                future = self.model_acks.pop(key)
+                if not future.done():
+                    future.set_result(None)
+        await conn.close()
+        await self.release_client_leases(client_uuid)
+        try:
+            await self.db_update_client_connection(
+                address[0], address[1], 0, client_uuid=client_uuid
+            )
+        except aiohttp.ClientError:
+            pass
+
     # db_update_client_connection()
     # Updates the database with the client's connection information.
     # It handles both new and existing clients, as well as client disconnections.
-    # It uses the requests library to send HTTP requests to the middleware.
-    def db_update_client_connection(
+    # It uses the shared aiohttp session to send HTTP requests to the middleware.
+    async def db_update_client_connection(
         self,
         ip,
         port,
@@ -302,11 +584,13 @@ class CIVICServer:
             # New client
             client_data = {"ip": ip, "port": port, "status": 1}  # active
             try:
-                response = requests.post(f"{middleware_url}/clients", json=client_data)
-                response.raise_for_status()
-                client_uuid = response.json()[0].get("client_uuid")
+                async with self.http.post(
+                    f"{middleware_url}/clients", json=client_data
+                ) as response:
+                    response.raise_for_status()
+                    client_uuid = (await response.json())[0].get("client_uuid")
                 return client_uuid
-            except requests.RequestException as e:
+            except aiohttp.ClientError as e:
                 logging.error(
                     f"Failed to update client connection in the database: {e}"
                 )
@@ -315,12 +599,12 @@ class CIVICServer:
             # Existing client
             client_data = {"ip": ip, "port": port, "status": 1}
             try:
-                response = requests.put(
+                async with self.http.put(
                     f"{middleware_url}/clients/{client_uuid}/activate", json=client_data
-                )
-                response.raise_for_status()
+                ) as response:
+                    response.raise_for_status()
                 return client_uuid
-            except requests.RequestException as e:
+            except aiohttp.ClientError as e:
                 logging.error(
                     f"Failed to update client connection in the database: {e}"
                 )
@@ -328,11 +612,11 @@ class CIVICServer:
         else:
             # Disconnecting client
             try:
-                response = requests.put(
+                async with self.http.put(
                     f"{middleware_url}/clients/{client_uuid}/deactivate"
-                )
-                response.raise_for_status()
-            except requests.RequestException as e:
+                ) as response:
+                    response.raise_for_status()
+            except aiohttp.ClientError as e:
                 logging.error(
                     f"Failed to update client disconnection in the database: {e}"
                 )
@@ -340,34 +624,69 @@ class CIVICServer:
 
     # start()
     # Starts the server and listens for incoming connections.
-    # It spawns a new thread for each client connection and handles server commands.
-    # It also handles server shutdown and cleanup.
+    # It starts the console thread and then runs the event loop until shutdown.
     def start(self):
-        logging.info("Server is running and waiting for connections...")
         self.server_command_thread = threading.Thread(
             target=self.handle_server_commands, daemon=True
         )
         self.server_command_thread.start()
-        while True:
-            client_socket, address = self.server_socket.accept()
-            client_thread = threading.Thread(
-                target=self.handle_client, args=(client_socket, address)
-            )
-            client_thread.start()
+        asyncio.run(self.serve())
+
+    # serve()
+    # Opens the listening socket and the middleware session, then serves
+    # every citizen connection from the event loop until the server is shut down.
+    async def serve(self):
+        self.loop = asyncio.get_running_loop()
+        self.stopped = asyncio.Event()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            self.loop.add_signal_handler(sig, self.safe_exit)
+
+        self.http = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=100),
+            timeout=aiohttp.ClientTimeout(total=300),
+        )
+        self.uploader = ResultUploader(
+            self.http,
+            result_batch_size,
+            result_batch_seconds,
+            result_buffer_size,
+            on_upload=self.handle_upload_summary,
+            on_drop=self.handle_dropped_results,
+        )
+        self.uploader.start()
+        self.server = await asyncio.start_server(
+            self.handle_client, self.host, self.port, backlog=1024
+        )
+        logging.info(f"Server started on {self.host}:{self.port}")
+        logging.info("Server is running and waiting for connections...")
+        asyncio.create_task(self.reap_expired_leases())
+
+        try:
+            await self.stopped.wait()
+        finally:
+            await self.uploader.close()
+            await self.http.close()
 
     # safe_exit()
     # Handles server shutdown and cleanup.
-    # It closes all client connections, notifies clients of the shutdown,
-    # and closes the server socket.
-    # It also handles cleanup of the curses window.
+    # Called from the event loop when SIGINT/SIGTERM is received.
     def safe_exit(self, *_):
+        if self.server_running:
+            self.server_running = False
+            asyncio.ensure_future(self.shutdown())
+
+    # shutdown()
+    # It closes the server socket, notifies clients of the shutdown,
+    # and closes all client connections.
+    # Once done, serve() returns and curses.wrapper() restores the terminal.
+    async def shutdown(self):
         logging.info("Exiting server...")
-        self.server_running = False
+        self.server.close()
 
         # Notify all clients that the server is shutting down
-        for client_socket in self.clients.values():
+        for conn in list(self.clients.values()):
             try:
-                client_socket.send("Server is shutting down".encode("utf-8"))
+                await conn.send(MessageType.SHUTDOWN)
             except Exception as e:
                 logging.error(f"Error notifying client: {e}")
 
@@ -375,18 +694,14 @@ class CIVICServer:
         timeout = 30
         start_time = time.time()
         while self.clients and (time.time() - start_time) < timeout:
-            for client_socket in self.clients.values():
+            for conn in list(self.clients.values()):
                 try:
-                    client_socket.close()
+                    await conn.close()
                 except Exception as e:
                     logging.error(f"Error closing client connection: {e}")
-            time.sleep(1)
+            await asyncio.sleep(1)
 
-        # Close the server socket
-        self.server_socket.close()
-
-        curses.endwin()
-        exit(0)
+        self.stopped.set()
 
     # print_table()
     # Helper function to print a table using the prettytable library.
@@ -401,107 +716,428 @@ class CIVICServer:
 
     # list_clients()
     # Lists all connected clients and their status.
-    def list_clients(self, all_clients=True):
+    async def list_clients(self, all_clients=True):
         # TODO: Implement all_clients functionality--another endpoint?
         logging.info("Listing clients...")
-        response = requests.get(f"{middleware_url}/clients")
-        response.raise_for_status()
-        if response.json():
-            self.print_table(response.json())
+        async with self.http.get(f"{middleware_url}/clients") as response:
+            response.raise_for_status()
+            clients = await response.json()
+        if clients:
+            self.print_table(clients)
         else:
             logging.info("No clients found.")
 
     # list_models()
     # Lists all available models and their status.
-    def list_models(self, all_models=True):
+    async def list_models(self, all_models=True):
         logging.info("Listing models...")
-        response = requests.get(f"{middleware_url}/get_models")
-        response.raise_for_status()
-        if response.json():
-            self.print_table(response.json())
+        async with self.http.get(f"{middleware_url}/get_models") as response:
+            response.raise_for_status()
+            models = await response.json()
+        if models:
+            self.print_table(models)
         else:
             logging.info("No models found.")
 
+    # cached_binary()
+    # Looks up the cached binary of a model. The download folder is a content-addressed
+    # cache: binaries are stored as download/<sha256>.bin, and download/model_<id>.sha256
+    # holds the digest of the model's latest binary.
+    # Returns (digest, file_path), or (None, None) if the model has no cached binary.
+    def cached_binary(self, model_id):
+        try:
+            with open(os.path.join("download", f"model_{model_id}.sha256")) as f:
+                digest = f.read().strip()
+        except FileNotFoundError:
+            return None, None
+        file_path = os.path.join("download", f"{digest}.bin")
+        if not os.path.exists(file_path):
+            return None, None
+        return digest, file_path
+
+    # set_cached_binary()
+    # Points a model at a binary in the download cache.
+    def set_cached_binary(self, model_id, digest):
+        pointer_path = os.path.join("download", f"model_{model_id}.sha256")
+        with open(pointer_path + ".tmp", "w") as f:
+            f.write(digest)
+        os.replace(pointer_path + ".tmp", pointer_path)
+        # Duties of a running model are only routed to clients with the new binary
+        self.scheduler.set_model_binary(int(model_id), digest)
+
     # download_binary()
-    # Downloads the model binary from the middleware server.
-    def download_binary(self, model_id):
+    # Downloads the model binary from the middleware server into the download cache.
+    # The middleware's ETag is the binary's SHA-256, so a binary that is already cached
+    # (under any model) is not transferred again, and an interrupted download is
+    # resumed with a Range request.
+    async def download_binary(self, model_id):
+        url = f"{middleware_url}/download_binary/{model_id}"
         try:
-            response = requests.get(
-                f"{middleware_url}/download_binary/{model_id}", stream=True
-            )
-            response.raise_for_status()
+            async with self.http.head(url) as response:
+                response.raise_for_status()
+                etag = response.headers["ETag"]
+                size = int(response.headers["Content-Length"])
+            digest = etag.strip('"')
+
+            file_path = os.path.join("download", f"{digest}.bin")
+            if os.path.exists(file_path):
+                self.set_cached_binary(model_id, digest)
+                logging.info(f"Model {model_id} binary ({digest[:12]}) is already cached")
+                return
+
+            part_path = file_path + ".part"
+            offset = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+            if offset < size:
+                headers = {}
+                if offset > 0:
+                    headers = {"Range": f"bytes={offset}-", "If-Range": etag}
+                async with self.http.get(url, headers=headers) as response:
+                    response.raise_for_status()
+                    # The middleware answers 200 instead of 206 if the binary changed
+                    mode = "ab" if response.status == 206 else "wb"
+                    if response.status == 206:
+                        logging.info(f"Resuming model {model_id} download at {offset}/{size} bytes")
+                    with open(part_path, mode) as model_file:
+                        async for chunk in response.content.iter_chunked(binary_chunk_size):
+                            model_file.write(chunk)
 
-            # Save the model binary to a file
-            file_path = os.path.join("download", f"model_{model_id}.bin")
-            with open(file_path, "wb") as model_file:
-                for chunk in response.iter_content(chunk_size=8192):
-                    if chunk:
-                        model_file.write(chunk)
+            # Only verified binaries make it into the cache
+            if await asyncio.to_thread(file_sha256, part_path) != digest:
+                os.remove(part_path)
+                logging.error(f"Model {model_id} binary failed its checksum, please download it again")
+                return
+            os.replace(part_path, file_path)
+            self.set_cached_binary(model_id, digest)
 
             logging.info(f"Model {model_id} downloaded successfully to {file_path}")
-        except requests.RequestException as e:
+        except (aiohttp.ClientError, KeyError, ValueError) as e:
             logging.error(f"Failed to download model {model_id}: {e}")
 
+    # select_stale_clients()
+    # Picks the clients in a range that do not have the given binary cached yet.
+    # Returns None (after logging why) if the range is invalid.
+    def select_stale_clients(self, model_id, digest, range_start, range_end):
+        if not self.clients:
+            logging.warning("No clients connected to distribute the model to.")
+            return None
+
+        # Validate range
+        if range_start < 0 or range_end >= len(self.clients):
+            logging.warning("Invalid range. Please provide a valid range of clients.")
+            return None
+
+        # Get the list of clients within the specified range
+        client_list = list(self.clients.items())[range_start : range_end + 1]
+
+        # Citizens that already have this exact binary are skipped
+        stale_clients = [
+            (client_uuid, conn)
+            for client_uuid, conn in client_list
+            if self.client_models.get(client_uuid, {}).get(int(model_id)) != digest
+        ]
+        logging.info(
+            f"Model {model_id} binary ({digest[:12]}): {len(client_list) - len(stale_clients)} "
+            f"of {len(client_list)} clients already up to date"
+        )
+        return stale_clients
+
     # distribute_binary()
     # Distributes the model binary to a range of clients.
-    def distribute_binary(self, model_id, range_start, range_end):
+    async def distribute_binary(self, model_id, range_start, range_end):
         # Given a model ID and a range of clients, distribute the model binary to those clients
-        try:
-            # Check if the model binary exists
-            file_path = os.path.join("download", f"model_{model_id}.bin")
-            if not os.path.exists(file_path):
+        # Check if the model binary exists
+        digest, file_path = self.cached_binary(model_id)
+        if not file_path:
+            logging.warning(
+                f"Model binary for {model_id} not found. Please download it first."
+            )
+            return
+
+        stale_clients = self.select_stale_clients(
+            model_id, digest, range_start, range_end
+        )
+        if not stale_clients:
+            return
+
+        # Send to the stale clients in parallel, at most distribution_concurrency at a time
+        size = os.path.getsize(file_path)
+        semaphore = asyncio.Semaphore(distribution_concurrency)
+
+        async def send(client_uuid, conn):
+            async with semaphore:
+                return await self.send_binary(
+                    model_id, digest, file_path, size, client_uuid, conn
+                )
+
+        start_time = time.monotonic()
+        results = await asyncio.gather(
+            *(send(client_uuid, conn) for client_uuid, conn in stale_clients)
+        )
+        self.log_distribution(
+            model_id, size, len(stale_clients), results, time.monotonic() - start_time
+        )
+
+    # log_distribution()
+    # Summarises a distribution run: clients reached, aggregate throughput, failures
+    # and stragglers (clients that took more than twice the median time).
+    # `results` holds (client_uuid, seconds taken or None if the client failed).
+    def log_distribution(self, model_id, size, client_count, results, elapsed):
+        durations = sorted(
+            (seconds, client_uuid)
+            for client_uuid, seconds in results
+            if seconds is not None
+        )
+        failed = [client_uuid for client_uuid, seconds in results if seconds is None]
+        sent_bytes = size * len(durations)
+        logging.info(
+            f"Model {model_id} binary sent to {len(durations)} of {client_count} clients "
+            f"in {elapsed:.1f}s ({sent_bytes / max(elapsed, 1e-6) / 2**20:.1f} MiB/s)"
+        )
+        if failed:
+            logging.warning(f"Model {model_id} binary failed for clients: {', '.join(failed)}")
+        if durations:
+            median = durations[len(durations) // 2][0]
+            stragglers = [
+                f"{client_uuid} ({seconds:.1f}s)"
+                for seconds, client_uuid in reversed(durations)
+                if seconds > 2 * median and seconds > 1
+            ]
+            if stragglers:
                 logging.warning(
-                    f"Model binary for {model_id} not found. Please download it first."
+                    f"Stragglers (median {median:.1f}s): {', '.join(stragglers[:10])}"
                 )
-                return
 
-            if self.clients:
-                # Validate range
-                if range_start < 0 or range_end >= len(self.clients):
-                    logging.warning(
-                        "Invalid range. Please provide a valid range of clients."
+    # send_binary()
+    # Sends a model binary to one client as a single MODEL_BIN frame, streamed from the
+    # download cache with sendfile(). Progress is logged every distribution_progress_seconds.
+    # A client that fails or times out mid-frame is disconnected, as its stream is unusable.
+    # Returns (client_uuid, seconds taken), with None as the time if the send failed.
+    async def send_binary(self, model_id, digest, file_path, size, client_uuid, conn):
+        start_time = time.monotonic()
+        last_report = start_time
+
+        def progress(sent):
+            nonlocal last_report
+            now = time.monotonic()
+            if now - last_report >= distribution_progress_seconds and sent < size:
+                last_report = now
+                logging.info(
+                    f"Model {model_id} -> {client_uuid}: {sent * 100 // size}% "
+                    f"({sent / (now - start_time) / 2**20:.1f} MiB/s)"
+                )
+
+        try:
+            with open(file_path, "rb") as model_file:
+                await asyncio.wait_for(
+                    conn.send_file(
+                        MessageType.MODEL_BIN,
+                        {"model_id": model_id, "sha256": digest},
+                        model_file,
+                        size,
+                        progress,
+                    ),
+                    distribution_timeout,
+                )
+        except Exception as e:
+            logging.error(
+                f"Failed to send model {model_id} to client {client_uuid}: {e!r}"
+            )
+            await conn.close()
+            return client_uuid, None
+
+        seconds = time.monotonic() - start_time
+        logging.info(
+            f"Model {model_id} binary distributed to client {client_uuid} in {seconds:.1f}s"
+        )
+        return client_uuid, seconds
+
+    # swarm_binary()
+    # Distributes the model binary to a range of clients with the help of the clients
+    # themselves. Citizens that run a peer server (CIVIC_PEER_PORT) and hold the binary
+    # act as seeds: every other client gets a SWARM manifest assigning each chunk of the
+    # binary to one of the seeds, and downloads the chunks from them in parallel.
+    # While there are no seeds yet, the first swarm_seed_count clients are sent the
+    # binary directly. Every finished client becomes a seed in turn, so the number of
+    # clients served at once grows with the swarm instead of being capped by our uplink.
+    async def swarm_binary(self, model_id, range_start, range_end):
+        model_id = int(model_id)
+        digest, file_path = self.cached_binary(model_id)
+        if not file_path:
+            logging.warning(
+                f"Model binary for {model_id} not found. Please download it first."
+            )
+            return
+
+        stale_clients = self.select_stale_clients(
+            model_id, digest, range_start, range_end
+        )
+        if not stale_clients:
+            return
+
+        size = os.path.getsize(file_path)
+        chunks = await asyncio.to_thread(self.chunk_manifest, digest, file_path)
+        manifest = {
+            "model_id": model_id,
+            "sha256": digest,
+            "size": size,
+            "chunk_size": swarm_chunk_size,
+            "chunks": chunks,
+        }
+
+        pending = collections.deque(stale_clients)
+        active = set()
+        results = []
+        via_peers = 0
+        start_time = time.monotonic()
+        while pending or active:
+            seeds = self.binary_seeds(model_id, digest)
+            limit = max(swarm_seed_count, len(seeds) * swarm_uploads_per_peer)
+            while pending and len(active) < limit:
+                client_uuid, conn = pending.popleft()
+                active.add(
+                    asyncio.create_task(
+                        self.swarm_client(manifest, file_path, client_uuid, conn)
                     )
-                    return
-
-                # Get the list of clients within the specified range
-                client_list = list(self.clients.items())[range_start : range_end + 1]
-
-                # Read the model binary
-                with open(file_path, "rb") as model_file:
-                    model_data = model_file.read()
-
-                # Distribute the model binary to the selected clients
-                for client_uuid, client_socket in client_list:
-                    try:
-                        # Send the model ID and binary size first
-                        binary_size = len(model_data)
-                        client_socket.sendall(
-                            f"MODEL_BIN {model_id} {binary_size}".encode("utf-8")
-                        )
+                )
+            done, active = await asyncio.wait(
+                active, return_when=asyncio.FIRST_COMPLETED
+            )
+            for task in done:
+                client_uuid, seconds, from_peers = task.result()
+                results.append((client_uuid, seconds))
+                via_peers += from_peers
 
-                        # Send the binary data in chunks
-                        chunk_size = 8192
-                        for i in range(0, binary_size, chunk_size):
-                            client_socket.sendall(model_data[i : i + chunk_size])
+        self.log_distribution(
+            model_id, size, len(stale_clients), results, time.monotonic() - start_time
+        )
+        logging.info(
+            f"Model {model_id} binary: {via_peers} clients served by peers, "
+            f"{len(results) - via_peers} by the server"
+        )
 
-                        logging.info(
-                            f"Model {model_id} binary distributed to client {client_uuid}"
-                        )
-                    except Exception as e:
-                        logging.error(
-                            f"Failed to send model {model_id} to client {client_uuid}: {e}"
-                        )
-            else:
-                logging.warning("No clients connected to distribute the model to.")
-                return
+    # swarm_client()
+    # Brings a single client up to date during swarm_binary(): from the current seeds if
+    # there are any, falling back to a direct send if the swarm download fails.
+    # Returns (client_uuid, seconds taken or None, whether peers served the binary).
+    async def swarm_client(self, manifest, file_path, client_uuid, conn):
+        model_id, digest = manifest["model_id"], manifest["sha256"]
+        start_time = time.monotonic()
 
-        except requests.RequestException as e:
-            logging.error(f"Failed to distribute model {model_id}: {e}")
+        seeds = self.binary_seeds(model_id, digest, exclude=client_uuid)
+        if seeds:
+            # Spread the load: every client gets the seeds in a different order, and
+            # chunk i is assigned to the i-th of them (round robin)
+            random.shuffle(seeds)
+            peers = seeds[:swarm_peers_per_client]
+            ack = self.expect_model_ack(client_uuid, model_id)
+            try:
+                await conn.send(
+                    MessageType.SWARM,
+                    dict(
+                        manifest,
+                        peers=peers,
+                        assignments=[i % len(peers) for i in range(len(manifest["chunks"]))],
+                    ),
+                )
+                if await asyncio.wait_for(ack, distribution_timeout) == digest:
+                    seconds = time.monotonic() - start_time
+                    logging.info(
+                        f"Model {model_id} binary fetched by client {client_uuid} "
+                        f"from {len(peers)} peers in {seconds:.1f}s"
+                    )
+                    return client_uuid, seconds, True
+            except (asyncio.TimeoutError, OSError, ProtocolError):
+                pass
+            logging.warning(
+                f"Swarm download failed for client {client_uuid}, sending the binary directly"
+            )
+            if client_uuid not in self.clients:
+                return client_uuid, None, False
+
+        ack = self.expect_model_ack(client_uuid, model_id)
+        _, seconds = await self.send_binary(
+            model_id, digest, file_path, manifest["size"], client_uuid, conn
+        )
+        if seconds is None:
+            return client_uuid, None, False
+        # Wait until the client has saved the binary, so it can serve as a seed
+        try:
+            if await asyncio.wait_for(ack, distribution_timeout) != digest:
+                return client_uuid, None, False
+        except asyncio.TimeoutError:
+            return client_uuid, None, False
+        return client_uuid, time.monotonic() - start_time, False
+
+    # binary_seeds()
+    # Returns the peer addresses ("host:port") of the connected clients that hold the
+    # given binary and serve it to other clients.
+    def binary_seeds(self, model_id, digest, exclude=None):
+        return [
+            peer
+            for client_uuid, peer in self.client_peers.items()
+            if client_uuid != exclude
+            and self.client_models.get(client_uuid, {}).get(model_id) == digest
+        ]
+
+    # chunk_manifest()
+    # Returns the SHA-256 digests of the swarm_chunk_size chunks of a cached binary.
+    # The list is computed once and kept next to the binary in the download cache.
+    def chunk_manifest(self, digest, file_path):
+        manifest_path = os.path.join(
+            "download", f"{digest}.chunks.{swarm_chunk_size}.json"
+        )
+        if os.path.exists(manifest_path):
+            with open(manifest_path) as f:
+                return json.load(f)
+        chunks = []
+        with open(file_path, "rb") as f:
+            while True:
+                chunk = f.read(swarm_chunk_size)
+                if not chunk:
+                    break
+                chunks.append(hashlib.sha256(chunk).hexdigest())
+        with open(manifest_path + ".tmp", "w") as f:
+            json.dump(chunks, f)
+        os.replace(manifest_path + ".tmp", manifest_path)
+        return chunks
+
+    # expect_model_ack()
+    # Returns a future resolved with the digest reported by the client's next
+    # MODEL_ACK for a model (None if it failed or the client disconnects).
+    def expect_model_ack(self, client_uuid, model_id):
+        future = self.loop.create_future()
+        self.model_acks[(client_uuid, int(model_id))] = future
+        return future
+
+    # handle_model_ack()
+    # Records that a citizen has saved (or failed to save) a model binary.
+    def handle_model_ack(self, client_uuid, meta):
+        model_id = int(meta["model_id"])
+        models = self.client_models.setdefault(client_uuid, {})
+        if meta.get("sha256"):
+            models[model_id] = meta["sha256"]
+            # Put the client to work on the model right away if its duties are running
+            if self.scheduler.has_work({model_id}) and self.holds_binary(
+                client_uuid, model_id
+            ):
+                asyncio.create_task(self.top_up_client(client_uuid))
+        else:
+            # The binary the client had before the failed download is still installed;
+            # forget it only once the client reports it is gone
+            if "installed" in meta:
+                if meta["installed"]:
+                    models[model_id] = meta["installed"]
+                else:
+                    models.pop(model_id, None)
+            logging.warning(f"Client {client_uuid} failed to save model {model_id} binary")
+        future = self.model_acks.pop((client_uuid, model_id), None)
+        if future and not future.done():
+            future.set_result(meta.get("sha256"))
 
     # execute_binary()
     # Executes the model binary on a range of clients.
     # Primarily used for testing purposes.
-    def execute_binary(self, model_id, range_start, range_end):
+    async def execute_binary(self, model_id, range_start, range_end):
         if self.clients:
             # Validate range
             if range_start < 0 or range_end >= len(self.clients):
@@ -514,9 +1150,9 @@ class CIVICServer:
             client_list = list(self.clients.items())[range_start : range_end + 1]
 
             # Execute the model binary on the selected clients
-            for client_uuid, client_socket in client_list:
+            for client_uuid, conn in client_list:
                 try:
-                    client_socket.sendall(f"EXECUTE {model_id}".encode("utf-8"))
+                    await conn.send(MessageType.EXECUTE, {"model_id": model_id})
                     logging.info(
                         f"Model {model_id} execution requested for client {client_uuid}"
                     )
@@ -526,9 +1162,13 @@ class CIVICServer:
                     )
 
     # generate_duties()
-    # Generates duties for a model and distributes them to clients.
+    # Starts handing out a model's duties and fills the free duty slots of each client
+    # in range, in the order the scheduler prefers.
+    # Duties live in the middleware's duty ledger (created along with the dataset),
+    # so nothing is lost if the internal server restarts mid-campaign.
+    # Several models can be run at once; their duties are shared out by priority.
     # Model expected to be download and distributed to clients first.
-    def generate_duties(self, model_id, range_start, range_end):
+    async def generate_duties(self, model_id, range_start, range_end, priority=1):
         if self.clients:
             # Validate range
             if range_start < 0 or range_end >= len(self.clients):
@@ -541,75 +1181,476 @@ class CIVICServer:
             client_list = list(self.clients.items())[range_start : range_end + 1]
 
             try:
-                # Get the dataset for the model specified
-                response = requests.get(f"{middleware_url}/dataset/{model_id}")
-                response.raise_for_status()
-                dataset = response.json()
-            except requests.RequestException as e:
-                logging.error(f"Failed to get dataset for model {model_id}: {e}")
+                # Get the state of the duty ledger for the model specified
+                async with self.http.get(
+                    f"{middleware_url}/duties/{model_id}"
+                ) as response:
+                    response.raise_for_status()
+                    ledger = (await response.json())[0]
+                # Get the execution mode of the model, passed to citizens with each duty
+                async with self.http.get(
+                    f"{middleware_url}/get_model/{model_id}"
+                ) as response:
+                    response.raise_for_status()
+                    model = (await response.json())[0]
+            except (aiohttp.ClientError, IndexError) as e:
+                logging.error(f"Failed to get duties for model {model_id}: {e}")
                 return
 
-            if dataset is None or []:
+            if not ledger["pending"] and not ledger["leased"]:
                 logging.error(
-                    f"No dataset found for model {model_id}. No duties were created."
+                    f"No open duties found for model {model_id}. Create a dataset first."
                 )
                 return
 
-            # Populate queue with dataset splits
-            for dataset_split in dataset:
-                self.duties.put(dataset_split)
+            logging.info(
+                f"Model {model_id} duties: {ledger['pending']} pending, {ledger['leased']} leased, "
+                f"{ledger['done']} done, {ledger['failed']} failed"
+            )
+            model_id = int(model_id)
+            self.scheduler.add_model(
+                model_id,
+                model.get("execution_mode", "file"),
+                priority,
+                ledger["pending"],
+                self.cached_binary(model_id)[0],
+            )
+
+            # Duties are only routed to clients that hold the model's binary
+            ready_clients = [
+                client_uuid
+                for client_uuid, _ in client_list
+                if self.holds_binary(client_uuid, model_id)
+            ]
+            if len(ready_clients) < len(client_list):
+                logging.warning(
+                    f"{len(client_list) - len(ready_clients)} of {len(client_list)} clients in range "
+                    f"do not have the model {model_id} binary; they are sent its duties once it is distributed to them"
+                )
 
-            # Send the first duty to each client
-            for client_uuid, client_socket in client_list:
-                self.send_duty(client_socket)
+            # Fill every free duty slot of each client, plus its prefetch backlog
+            for client_uuid in self.scheduler.order(ready_clients):
+                await self.top_up_client(client_uuid)
 
-    # send_duty()
-    # Sends a duty to the client if available.
-    # If no duties are available, sends a "NONE" message.
-    def send_duty(self, client_socket):
-        if not self.duties.empty():
-            logging.debug("Remaining duties: %d", self.duties.qsize())
-            duty = self.duties.get()
-            duty_payload = json.dumps(duty)
-            client_socket.sendall(f"DUTY {duty_payload}".encode("utf-8"))
+    # top_up_client()
+    # Sends a client as many dispatches as it has free duty slots for.
+    async def top_up_client(self, client_uuid):
+        conn = self.clients.get(client_uuid)
+        if conn is None:
+            return
+        count = self.scheduler.free_dispatches(client_uuid, self.batch_size(client_uuid))
+        if count > 0:
+            await self.send_duty(client_uuid, conn, count)
+
+    # holds_binary()
+    # Whether a client has the binary a model's duties are run with. Any binary of the
+    # model will do when the server has not downloaded the model itself.
+    def holds_binary(self, client_uuid, model_id):
+        digest = self.client_models.get(client_uuid, {}).get(model_id)
+        wanted = self.scheduler.model_binary(model_id)
+        return digest is not None and (wanted is None or digest == wanted)
+
+    # runnable_models()
+    # Returns the running models whose duties a client can be sent.
+    def runnable_models(self, client_uuid):
+        return {
+            model_id
+            for model_id in self.scheduler.models
+            if self.holds_binary(client_uuid, model_id)
+        }
+
+    # set_model_priority()
+    # Changes the share of duties a model gets while several models are being run.
+    async def set_model_priority(self, model_id, priority):
+        if int(model_id) not in self.scheduler.models:
+            logging.error(f"Duties of model {model_id} are not being handed out.")
+            return
+        self.scheduler.set_priority(int(model_id), priority)
+        logging.info(f"Model {model_id} priority set to {priority}")
+
+    # show_schedule()
+    # Lists the models whose duties are being handed out and the connected citizens,
+    # as seen by the scheduler.
+    async def show_schedule(self):
+        models = [
+            {
+                "model_id": model_id,
+                "mode": model["mode"],
+                "priority": model["priority"],
+                "remaining": model["remaining"],
+                "dispatched": model["dispatched"],
+                "drained": model["drained"],
+            }
+            for model_id, model in self.scheduler.models.items()
+        ]
+        if models:
+            self.print_table(models)
         else:
-            client_socket.sendall(f"NONE".encode("utf-8"))
+            logging.info("No duties are being handed out.")
+
+        clients = [
+            {
+                "client_uuid": client_uuid,
+                "slots": client["slots"],
+                "cpus": client["cpus"],
+                "memory": client["memory"],
+                "seconds": round(client["seconds"], 3) if client["seconds"] else None,
+                "throughput": round(self.scheduler.throughput(client_uuid), 3),
+                "outstanding": client["outstanding"],
+            }
+            for client_uuid, client in self.scheduler.clients.items()
+        ]
+        if clients:
+            self.print_table(clients)
+
+    # claim_duties()
+    # Leases up to `count` duties of a model to a client from the middleware's duty ledger.
+    # Returns the leased duties, the number of replicas of them the middleware created
+    # for other clients to check, and the number of duties left pending in the ledger.
+    async def claim_duties(self, model_id, client_uuid, count=1):
+        claim = {
+            "client_uuid": client_uuid,
+            "count": count,
+            "lease_seconds": duty_lease_seconds,
+        }
+        async with self.http.post(
+            f"{middleware_url}/duties/{model_id}/claim", json=claim
+        ) as response:
+            response.raise_for_status()
+            replicated = int(response.headers.get("X-Replicated-Duties", 0))
+            pending = response.headers.get("X-Pending-Duties")
+            pending = int(pending) if pending is not None else None
+            return await response.json(), replicated, pending
+
+    # release_duties()
+    # Returns duties leased to a client to the pending state in the duty ledger, and
+    # puts them back into the model's queue. Duties that used up their attempts are
+    # failed by the ledger instead. Returns the number of duties re-queued.
+    async def release_duties(self, model_id, client_uuid, duty_ids):
+        release = {"client_uuid": client_uuid, "ids": duty_ids}
+        async with self.http.put(
+            f"{middleware_url}/duties/{model_id}/release", json=release
+        ) as response:
+            response.raise_for_status()
+            released = await response.json()
+
+        requeued = sum(1 for duty in released if duty["state"] == 0)
+        failed = len(released) - requeued
+        if failed:
+            logging.warning(
+                f"{failed} duties of model {model_id} used up their attempts and failed"
+            )
+        if requeued:
+            await self.requeue_duties(model_id, requeued)
+        return requeued
+
+    # track_lease()
+    # Records a duty as outstanding on a client.
+    # `claimed` is True when the duty was leased from the ledger, False for a speculative copy.
+    def track_lease(self, client_uuid, duty, claimed=True):
+        key = (duty["model_id"], duty["id"])
+        lease = self.leases.setdefault(
+            key, {"duty": duty, "claimant": None, "holders": set(), "expires_at": None}
+        )
+        if client_uuid not in lease["holders"]:
+            lease["holders"].add(client_uuid)
+            self.scheduler.hold(client_uuid)
+        if claimed:
+            lease["claimant"] = client_uuid
+            lease["expires_at"] = time.monotonic() + duty_lease_seconds
+
+    # release_client_leases()
+    # Drops a disconnected client from every duty it held. Duties nobody else is
+    # working on are released in the ledger so they get re-dispatched right away.
+    async def release_client_leases(self, client_uuid):
+        orphaned = {}
+        for key, lease in list(self.leases.items()):
+            if client_uuid not in lease["holders"]:
+                continue
+            lease["holders"].discard(client_uuid)
+            if not lease["holders"]:
+                del self.leases[key]
+                if lease["claimant"] == client_uuid and lease["expires_at"]:
+                    orphaned.setdefault(key[0], []).append(key[1])
+
+        for model_id, duty_ids in orphaned.items():
+            try:
+                requeued = await self.release_duties(model_id, client_uuid, duty_ids)
+                logging.info(
+                    f"Re-queued {requeued} duties of model {model_id} held by client {client_uuid}"
+                )
+            except aiohttp.ClientError as e:
+                logging.error(f"Failed to release duties of client {client_uuid}: {e}")
+
+    # reap_expired_leases()
+    # Periodically re-queues duties whose lease ran out. The slow holder keeps
+    # working on it, and its result is still accepted if it arrives first.
+    async def reap_expired_leases(self):
+        while True:
+            await asyncio.sleep(min(10, duty_lease_seconds))
+            now = time.monotonic()
+            for (model_id, duty_id), lease in list(self.leases.items()):
+                if lease["expires_at"] is None or lease["expires_at"] > now:
+                    continue
+                lease["expires_at"] = None
+                try:
+                    if await self.release_duties(model_id, lease["claimant"], [duty_id]):
+                        logging.info(
+                            f"Lease on duty {duty_id} of model {model_id} expired; re-queued"
+                        )
+                except aiohttp.ClientError as e:
+                    logging.error(f"Failed to re-queue expired duty {duty_id}: {e}")
+
+    # pick_speculative_duty()
+    # Picks the oldest outstanding duty of the given models this client is not already
+    # working on, as long as it has fewer than 1 + speculative_copies holders.
+    def pick_speculative_duty(self, client_uuid, models):
+        for lease in self.leases.values():
+            if (
+                lease["duty"]["model_id"] in models
+                and client_uuid not in lease["holders"]
+                and len(lease["holders"]) <= speculative_copies
+            ):
+                return lease["duty"]
+        return None
+
+    # send_duty()
+    # Sends up to `count` dispatches to the client, one DUTY frame each. A dispatch is a
+    # single split, or a batch of batch_size() splits of one model when batching is on.
+    # The scheduler decides which models' duties the client gets, and may hand it fewer
+    # than it asked for. Clients are only sent duties of models they hold the binary of.
+    # When the ledger has no duties left, outstanding duties may be duplicated
+    # to the idle client to cut down tail latency.
+    # If no duties are available at all, sends a "NONE" message.
+    # The duties' input data travels as the frame body, everything else as metadata.
+    async def send_duty(self, client_uuid, conn, count=1):
+        batch_size = self.batch_size(client_uuid)
+        wanted = count * batch_size
+        models = self.runnable_models(client_uuid)
+        duties = []
+        try:
+            # Models whose ledger runs dry drop out of the plan, so plan again
+            # for the rest until the client is served or nothing is left
+            while len(duties) < wanted:
+                plan = self.scheduler.plan(
+                    client_uuid, wanted - len(duties), batch_size, models
+                )
+                if not plan:
+                    break
+                for model_id, splits in plan:
+                    claimed, replicated, pending = await self.claim_duties(
+                        model_id, client_uuid, splits
+                    )
+                    self.scheduler.claimed(model_id, len(claimed), splits, pending)
+                    if len(claimed) < splits:
+                        # Whatever is left of the model is not for this client
+                        # (e.g. replicas of splits it ran itself)
+                        models.discard(model_id)
+                    if replicated:
+                        asyncio.create_task(
+                            self.requeue_duties(model_id, replicated, client_uuid)
+                        )
+                    for duty in claimed:
+                        self.track_lease(client_uuid, duty, claimed=True)
+                    duties.extend(claimed)
+        except aiohttp.ClientError as e:
+            logging.error(f"Failed to claim a duty for client {client_uuid}: {e}")
+
+        while (
+            len(duties) < wanted
+            and speculative_copies > 0
+            and not self.scheduler.has_work(models)
+        ):
+            duty = self.pick_speculative_duty(client_uuid, models)
+            if duty is None:
+                break
+            logging.info(
+                f"Speculatively sending duty {duty['id']} to client {client_uuid}"
+            )
+            self.track_lease(client_uuid, duty, claimed=False)
+            duties.append(duty)
+
+        if not duties:
+            await conn.send(MessageType.NONE)
             logging.info(
                 f"Tried to send a duty to a client, but no duties are available."
             )
+            return
+
+        if batch_size == 1:
+            for duty in duties:
+                duty_meta = {key: value for key, value in duty.items() if key != "data"}
+                duty_meta["mode"] = self.scheduler.model_mode(duty["model_id"])
+                duty_data = json.dumps(duty["data"]).encode("utf-8")
+                await conn.send(MessageType.DUTY, duty_meta, duty_data)
+            return
+
+        # Spread each model's duties evenly over its dispatches
+        by_model = {}
+        for duty in duties:
+            by_model.setdefault(duty["model_id"], []).append(duty)
+        for model_id, model_duties in by_model.items():
+            dispatches = math.ceil(len(model_duties) / batch_size)
+            for i in range(dispatches):
+                await self.send_batch(conn, model_id, model_duties[i::dispatches])
+
+    # send_batch()
+    # Sends several splits of a model to a client as a single dispatch.
+    async def send_batch(self, conn, model_id, batch):
+        batch_meta = {
+            "model_id": model_id,
+            "mode": self.scheduler.model_mode(model_id),
+            "batch": [
+                {key: value for key, value in duty.items() if key != "data"}
+                for duty in batch
+            ],
+        }
+        batch_data = json.dumps([duty["data"] for duty in batch]).encode("utf-8")
+        await conn.send(MessageType.DUTY, batch_meta, batch_data)
 
     # handle_results()
     # Handles results received from the client.
-    # It parses the results and sends them to the middleware server.
-    def handle_results(self, client_uuid, message):
+    # A batched dispatch comes back as one compound RESULTS frame, which is unbundled
+    # into one result per split. The results are handed to the result uploader, which
+    # sends them to the middleware server in batches.
+    async def handle_results(self, client_uuid, meta, body):
         # Handle results from the client
-        results_raw = message.split(" ")[1:]
-        results = {
-            "client_uuid": client_uuid,
-            "id": results_raw[0],
-            "model_id": results_raw[1],
-            "data": json.loads(" ".join(results_raw[2:])),
-        }
+        try:
+            model_id = meta["model_id"]
+            data = json.loads(body.decode("utf-8"))
+            if "batch" in meta:
+                outputs = list(zip(meta["batch"], data))
+            else:
+                outputs = [(meta["id"], data)]
+        except (KeyError, TypeError, ValueError) as e:
+            logging.error(f"Malformed results from client {client_uuid}: {e}")
+            return
 
-        logging.info(f"Results received from client: {results}")
+        if meta.get("seconds") is not None:
+            self.scheduler.record_duty_time(client_uuid, meta["seconds"] / len(outputs))
 
-        # Send the results to the middleware
-        try:
-            response = requests.post(
-                f"{middleware_url}/upload_result/{results['model_id']}", json=results
+        failed = []
+        for duty_id, output in outputs:
+            # Splits that failed on the citizen come back empty
+            if output is None:
+                logging.warning(f"Client {client_uuid} failed duty {duty_id}")
+                key = (int(model_id), int(duty_id))
+                lease = self.leases.get(key)
+                if lease and client_uuid in lease["holders"]:
+                    lease["holders"].discard(client_uuid)
+                    self.scheduler.release(client_uuid)
+                    # Hand it out again right away unless another client is on it
+                    if not lease["holders"]:
+                        del self.leases[key]
+                        if lease["claimant"] == client_uuid and lease["expires_at"]:
+                            failed.append(key[1])
+                continue
+            await self.record_result(client_uuid, model_id, duty_id, output)
+
+        if failed:
+            try:
+                await self.release_duties(int(model_id), client_uuid, failed)
+            except aiohttp.ClientError as e:
+                logging.error(f"Failed to release failed duties of client {client_uuid}: {e}")
+
+    # handle_upload_summary()
+    # Handles the middleware's summary of an uploaded batch of results. Splits whose
+    # replicas disagree are re-issued by the middleware as new duties, which are put
+    # back into the model's queue and sent to idle clients.
+    async def handle_upload_summary(self, model_id, summary):
+        if summary.get("validated"):
+            logging.info(
+                f"Validated {summary['validated']} replicated splits of model {model_id}"
             )
-            response.raise_for_status()
-        except requests.RequestException as e:
-            logging.error(f"Failed to upload results for client {client_uuid}: {e}")
+        if summary.get("disputed"):
+            logging.warning(
+                f"{summary['disputed']} replicated splits of model {model_id} have disputed "
+                f"results, {summary.get('reissued', 0)} re-issued"
+            )
+        if summary.get("reissued"):
+            await self.requeue_duties(int(model_id), summary["reissued"])
+
+    # handle_dropped_results()
+    # Forgets results the uploader had to drop and returns their duties to the ledger,
+    # so they are run again and the next results are accepted. Duties that cannot be
+    # released now (e.g. the middleware is down) are handed out once their lease expires.
+    async def handle_dropped_results(self, model_id, results):
+        by_client = {}
+        for result in results:
+            self.completed.pop((int(model_id), int(result["id"])), None)
+            by_client.setdefault(result["claimant"], []).append(int(result["id"]))
+        for client_uuid, duty_ids in by_client.items():
+            try:
+                await self.release_duties(int(model_id), client_uuid, duty_ids)
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                logging.error(
+                    f"Failed to release dropped duties of client {client_uuid}: {e}"
+                )
+
+    # requeue_duties()
+    # Puts duties the middleware added to a model's ledger (re-issued or replicated
+    # splits) into the model's queue, and sends them to idle clients that can run
+    # them, other than `exclude`.
+    async def requeue_duties(self, model_id, count, exclude=None):
+        self.scheduler.requeued(model_id, count)
+        for client_uuid in self.scheduler.order(list(self.clients)):
+            if client_uuid != exclude and model_id in self.runnable_models(client_uuid):
+                await self.top_up_client(client_uuid)
+
+    # record_result()
+    # Records the result of a single duty and queues it for upload.
+    async def record_result(self, client_uuid, model_id, duty_id, data):
+        # The first result for a duty wins; later copies are discarded
+        key = (int(model_id), int(duty_id))
+        if key in self.completed:
+            logging.info(
+                f"Discarding duplicate result for duty {duty_id} from client {client_uuid}"
+            )
+            lease = self.leases.get(key)
+            if lease and client_uuid in lease["holders"]:
+                lease["holders"].discard(client_uuid)
+                self.scheduler.release(client_uuid)
+            return
+        lease = self.leases.pop(key, None)
+        claimant = client_uuid
+        if lease:
+            for holder in lease["holders"]:
+                self.scheduler.release(holder)
+            claimant = lease["claimant"] or client_uuid
+        self.completed[key] = True
+        if len(self.completed) > completed_history_size:
+            self.completed.popitem(last=False)
+
+        logging.info(f"Results received from client {client_uuid} for duty {duty_id}")
+
+        # Queue the results for upload to the middleware
+        await self.uploader.put(
+            {
+                "client_uuid": client_uuid,
+                "id": duty_id,
+                "model_id": model_id,
+                "data": data,
+                "claimant": claimant,
+            }
+        )
+
+    # batch_size()
+    # Returns how many splits to pack into one dispatch to a client, so a dispatch
+    # takes about duty_batch_seconds there. Batching is off when duty_batch_seconds
+    # is 0, and a client is sent single splits until its speed is known.
+    def batch_size(self, client_uuid):
+        seconds = self.scheduler.duty_seconds(client_uuid)
+        if duty_batch_seconds <= 0 or not seconds:
+            return 1
+        return max(1, min(duty_batch_max, round(duty_batch_seconds / seconds)))
 
 
 # main()
 # Main function to start the server using curses
 # It initializes the server and handles cleanup on exit.
+# Signal handlers are installed on the event loop by CIVICServer.serve().
 def main(stdscr):
     server = CIVICServer(stdscr)
-    signal.signal(signal.SIGINT, server.safe_exit)
-    signal.signal(signal.SIGTERM, server.safe_exit)
     server.start()
 
 
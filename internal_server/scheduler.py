@@ -0,0 +1,252 @@
+import math
+import os
+
+# Memory a running duty needs on a citizen, in bytes. Citizens are sent no more
+# duties at once than their memory allows (0 disables the check).
+duty_memory = int(os.getenv("CIVIC_DUTY_MEMORY", "0"))
+
+
+# Scheduler
+# Decides which models' duties a citizen is handed, and how many. The server keeps the
+# scheduler up to date on the connected citizens, the models whose duties are being
+# handed out and the duties each citizen holds, and asks it for a plan whenever a
+# citizen wants work. Each model has its own queue (its duties in the ledger), and a
+# citizen is only planned duties of the models it holds the binary of.
+# This base scheduler hands out the oldest model's duties first, as many as the
+# citizen asks for, in the order citizens ask.
+class Scheduler:
+    def __init__(self):
+        # Connected citizens:
+        # {uuid: {"slots", "prefetch", "cpus", "memory", "seconds", "outstanding"}}
+        self.clients = {}
+        # Models whose duties are being handed out, oldest first:
+        # {model_id: {"mode", "sha256", "priority", "remaining", "dispatched", "drained"}}
+        self.models = {}
+
+    # add_client()
+    # Registers a citizen with the resources it reported in its handshake.
+    def add_client(self, client_uuid, slots, prefetch, cpus=None, memory=None):
+        self.clients[client_uuid] = {
+            "slots": slots,
+            "prefetch": prefetch,
+            "cpus": cpus,
+            "memory": memory,
+            "seconds": None,  # moving average of the wall time one split takes
+            "outstanding": 0,  # splits the citizen is working on
+        }
+
+    # remove_client()
+    # Forgets a disconnected citizen.
+    def remove_client(self, client_uuid):
+        self.clients.pop(client_uuid, None)
+
+    # record_duty_time()
+    # Updates a citizen's moving average of the wall time a single split takes.
+    def record_duty_time(self, client_uuid, seconds):
+        client = self.clients.get(client_uuid)
+        if client is None:
+            return
+        if client["seconds"] is None:
+            client["seconds"] = seconds
+        else:
+            client["seconds"] = 0.8 * client["seconds"] + 0.2 * seconds
+
+    # duty_seconds()
+    # Returns a citizen's average split time, or None while it is unknown.
+    def duty_seconds(self, client_uuid):
+        client = self.clients.get(client_uuid)
+        return client["seconds"] if client else None
+
+    # capacity()
+    # Returns the number of dispatches kept in flight at a citizen: one per slot plus
+    # its prefetch backlog, as far as its memory allows.
+    def capacity(self, client_uuid):
+        client = self.clients.get(client_uuid)
+        if client is None:
+            return 1
+        capacity = client["slots"] + client["prefetch"]
+        if duty_memory > 0 and client["memory"]:
+            capacity = min(capacity, max(1, client["memory"] // duty_memory))
+        return capacity
+
+    # free_dispatches()
+    # Returns how many more dispatches of `batch_size` splits a citizen has room for.
+    def free_dispatches(self, client_uuid, batch_size):
+        outstanding = self.clients.get(client_uuid, {}).get("outstanding", 0)
+        return max(0, self.capacity(client_uuid) - math.ceil(outstanding / batch_size))
+
+    # throughput()
+    # Estimates the splits per second a citizen gets through. Citizens whose speed is
+    # not known yet are assumed to be as fast per slot as the rest of the fleet.
+    def throughput(self, client_uuid):
+        client = self.clients.get(client_uuid)
+        if client is None:
+            return 0
+        seconds = client["seconds"]
+        if not seconds:
+            known = [c["seconds"] for c in self.clients.values() if c["seconds"]]
+            seconds = sum(known) / len(known) if known else 1.0
+        return min(client["slots"], self.capacity(client_uuid)) / seconds
+
+    # hold() / release()
+    # Counts splits handed to and given back by a citizen.
+    def hold(self, client_uuid, count=1):
+        if client_uuid in self.clients:
+            self.clients[client_uuid]["outstanding"] += count
+
+    def release(self, client_uuid, count=1):
+        if client_uuid in self.clients:
+            client = self.clients[client_uuid]
+            client["outstanding"] = max(0, client["outstanding"] - count)
+
+    # add_model()
+    # Starts (or resumes) handing out a model's duties. `remaining` is the number of
+    # its duties waiting in the ledger, and `sha256` the binary they are run with.
+    # The priority is the model's weight: models get dispatches in proportion to it.
+    # A model joining late starts level with the others, rather than being served
+    # alone until it has caught up.
+    def add_model(self, model_id, mode="file", priority=1, remaining=0, sha256=None):
+        passes = [
+            model["dispatched"] / model["priority"]
+            for model in self.models.values()
+            if not model["drained"]
+        ]
+        model = self.models.setdefault(model_id, {"dispatched": 0})
+        model["mode"] = mode
+        model["sha256"] = sha256
+        model["priority"] = max(priority, 0.001)
+        model["remaining"] = remaining
+        model["drained"] = False
+        model["dispatched"] = max(
+            model["dispatched"], min(passes, default=0) * model["priority"]
+        )
+
+    # set_priority()
+    # Changes the share of dispatches a model gets relative to the other models.
+    def set_priority(self, model_id, priority):
+        model = self.models[model_id]
+        model["dispatched"] *= max(priority, 0.001) / model["priority"]
+        model["priority"] = max(priority, 0.001)
+
+    # model_mode()
+    # Returns how citizens run a model's binary.
+    def model_mode(self, model_id):
+        return self.models.get(model_id, {}).get("mode", "file")
+
+    # model_binary() / set_model_binary()
+    # The digest of the binary a model's duties are run with (None if not known).
+    def model_binary(self, model_id):
+        return self.models.get(model_id, {}).get("sha256")
+
+    def set_model_binary(self, model_id, sha256):
+        if model_id in self.models:
+            self.models[model_id]["sha256"] = sha256
+
+    # eligible_models()
+    # Returns the models that may still have duties waiting, limited to `models`
+    # (the ones a citizen can run) when given: [(model_id, model), ...].
+    def eligible_models(self, models=None):
+        return [
+            (model_id, model)
+            for model_id, model in self.models.items()
+            if not model["drained"] and (models is None or model_id in models)
+        ]
+
+    # claimed()
+    # Records that `count` of `requested` duties of a model were leased from the ledger,
+    # leaving `pending` duties in it. The model is drained once nothing is pending;
+    # when the ledger does not say, a short claim means it has run dry.
+    def claimed(self, model_id, count, requested, pending=None):
+        model = self.models.get(model_id)
+        if model is None:
+            return
+        if pending is not None:
+            model["remaining"] = pending
+            model["drained"] = pending == 0
+        else:
+            model["remaining"] = max(0, model["remaining"] - count)
+            if count < requested:
+                model["drained"] = True
+                model["remaining"] = 0
+
+    # requeued()
+    # Records that duties of a model went back to the ledger, to be handed out again.
+    def requeued(self, model_id, count):
+        model = self.models.get(model_id)
+        if model is None:
+            return
+        model["remaining"] += count
+        model["drained"] = False
+
+    # has_work()
+    # Whether any model (of `models`, when given) may still have duties waiting
+    # in the ledger.
+    def has_work(self, models=None):
+        return bool(self.eligible_models(models))
+
+    # order()
+    # Returns the order in which citizens are handed their first duties.
+    def order(self, client_uuids):
+        return list(client_uuids)
+
+    # plan()
+    # Returns how many splits of which models to claim for a citizen that wants up to
+    # `wanted` splits, sent in dispatches of `batch_size`: [(model_id, splits), ...].
+    # `models` limits the plan to the models the citizen can run.
+    def plan(self, client_uuid, wanted, batch_size, models=None):
+        for model_id, model in self.eligible_models(models):
+            model["dispatched"] += wanted
+            return [(model_id, wanted)]
+        return []
+
+
+# FairShareScheduler
+# Weighted fair share between models and between citizens.
+# Models are served in proportion to their priority: each dispatch goes to the model
+# that has had the fewest dispatches for its priority (stride scheduling).
+# Citizens get work in proportion to their throughput (slots over average split time):
+# a citizen holds at most its share of the duties still waiting, so the fast members
+# of a mixed fleet are not left idle at the end of a run while the slow ones work
+# through a backlog. The fastest citizens are also handed work first.
+class FairShareScheduler(Scheduler):
+    def order(self, client_uuids):
+        return sorted(client_uuids, key=self.throughput, reverse=True)
+
+    def plan(self, client_uuid, wanted, batch_size, models=None):
+        models = self.eligible_models(models)
+        if not models:
+            return []
+
+        # Cap the citizen at its share of the remaining duties
+        remaining = sum(model["remaining"] for _, model in models)
+        fleet = sum(self.throughput(uuid) for uuid in self.clients)
+        if remaining > 0 and fleet > 0:
+            share = math.ceil(remaining * self.throughput(client_uuid) / fleet)
+            outstanding = self.clients.get(client_uuid, {}).get("outstanding", 0)
+            wanted = min(wanted, max(0, share - outstanding))
+
+        # Split the dispatches between the models by priority
+        plan = {}
+        while wanted > 0:
+            model_id, model = min(
+                models, key=lambda item: item[1]["dispatched"] / item[1]["priority"]
+            )
+            splits = min(batch_size, wanted)
+            model["dispatched"] += splits
+            plan[model_id] = plan.get(model_id, 0) + splits
+            wanted -= splits
+        return list(plan.items())
+
+
+SCHEDULERS = {"fifo": Scheduler, "fair": FairShareScheduler}
+
+
+# create_scheduler()
+# Creates the scheduler named by CIVIC_SCHEDULER (fair by default).
+def create_scheduler(name=None):
+    name = name or os.getenv("CIVIC_SCHEDULER", "fair")
+    if name not in SCHEDULERS:
+        raise ValueError(
+            f"Unknown scheduler {name!r}, expected one of {', '.join(SCHEDULERS)}"
+        )
+    return SCHEDULERS[name]()
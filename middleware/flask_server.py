@@ -18,23 +18,41 @@ Flask API Routes:
       - Request JSON: {"status": int}
     - `POST /create_model`
       - Creates a new model in the database.
-      - Request JSON: {"name": str, "display_name": str, "description": str}
+      - Request JSON: {"name": str, "display_name": str, "description": str, "execution_mode": "file" | "pipe" | "resident" (optional),
+                       "validation_quorum": int, "validation_comparator": "exact" | "json" | "numeric", "validation_tolerance": float (optional)}
 
 3. Model Binaries:
     - `GET /get_model_binaries/<int:model_id>`
-      - Retrieves all binaries for a specific model, ordered by version.
+      - Retrieves the metadata of all binaries for a specific model, ordered by version.
     - `GET /download_binary/<int:model_id>`
-      - Downloads the latest binary for a specific model.
+      - Streams the latest binary for a specific model.
+      - The `ETag` is the binary's SHA-256; `If-None-Match` returns 304 and single `Range` requests return 206.
     - `POST /upload_model_binary/<int:model_id>`
       - Uploads a binary for a specific model.
       - Request JSON: {"version": str, "encoded_data": str (base64)}
+    - `POST /upload_model_binary_stream/<int:model_id>?version=`
+      - Uploads a binary for a specific model from a raw `application/octet-stream` body (may be chunked),
+        or from the `binary` file field of a `multipart/form-data` body (with an optional `version` field).
+      - The body is streamed into a large object while its SHA-256 is computed; `version` defaults to the next version.
+      - Bodies are limited to `WAITRESS_MAX_BODY` bytes (64 GiB by default).
+      - Response JSON: {"id": int, "model_id": int, "version": int, "size": int, "sha256": str}
 
 4. Datasets:
     - `GET /dataset/<int:model_id>`
       - Retrieves the dataset for a specific model.
+    - `GET /dataset/<int:model_id>/stream?after_id=&limit=&format=`
+      - Streams the dataset in id order from a server-side cursor, as NDJSON (default) or a JSON array.
+      - `after_id` and `limit` allow keyset pagination.
     - `POST /create_dataset/<int:model_id>`
-      - Creates a dataset for a specific model.
+      - Creates a dataset for a specific model, loading it with COPY.
       - Request JSON: {"type": str, "data": list, "split": int, "replication": bool, "replication_percentage": int, "shuffle": bool}
+      - Replicas point back at their original split (`replica_of`), and their results are validated against each other.
+      - Response JSON: {"splits": int, "rows": int, "seconds": float, "rows_per_second": float}
+    - `POST /create_dataset_stream/<int:model_id>?type=&split=&replication=&replication_percentage=&shuffle=`
+      - Creates a dataset from an NDJSON request body (one data entry per line, may be chunked).
+      - Bodies are limited to `WAITRESS_MAX_BODY` bytes (64 GiB by default).
+      - The body is split and loaded incrementally with bounded memory; shuffling uses a bounded window.
+      - Response JSON: same as `/create_dataset`
 
 5. Clients:
     - `GET /clients`
@@ -50,24 +68,65 @@ Flask API Routes:
 6. Results:
     - `GET /results/<int:model_id>`
       - Retrieves results for a specific model.
+    - `GET /results/<int:model_id>/stream?after_id=&limit=&format=`
+      - Streams results in id order from a server-side cursor, as NDJSON (default) or a JSON array.
+      - `after_id` and `limit` allow keyset pagination.
     - `POST /upload_result/<int:model_id>`
-      - Uploads a result for a specific model.
+      - Uploads a result for a specific model and marks its duty as done.
       - Request JSON: {"client_uuid": str, "id": int, "data": dict}
+    - `POST /upload_results/<int:model_id>`
+      - Uploads a batch of results in one statement and marks their duties as done.
+      - A client has one result per split; results it already uploaded are ignored (and not counted as inserted).
+      - A batch with a result Postgres cannot store (e.g. a \\u0000 in its JSON) is rejected with 400.
+      - Results of replicated splits are compared with those of the other copies as they arrive.
+      - Request JSON: [{"client_uuid": str, "id": int, "data": dict}, ...]
+      - Response JSON: {"inserted": int, "validated": int, "disputed": int, "reissued": int}
+    - `GET /validations/<int:model_id>`
+      - Retrieves the number of replicated splits that are pending, validated and disputed for a specific model.
+    - `GET /validations/<int:model_id>/disputed`
+      - Lists the disputed splits of a specific model. Disputed splits are re-issued automatically.
+    - `GET /trust`
+      - Lists every client's trust score: results checked against a validated result, disagreements,
+        recent agreement rate and the share of its duties replicated.
+
+7. Duties:
+    - `GET /duties/<int:model_id>`
+      - Retrieves the number of duties in each state for a specific model; duties whose lease ran out count as pending.
+    - `POST /duties/<int:model_id>/claim`
+      - Atomically leases up to `count` pending (or lease-expired) duties to a client.
+      - A client is never leased two copies of a replicated split.
+      - Some of the leased splits are replicated as a new duty for another client, depending on the client's trust score.
+      - Returns the leased dataset splits. The `X-Replicated-Duties` header holds the number of replicas created,
+        and `X-Pending-Duties` the number of duties still pending.
+      - Request JSON: {"client_uuid": str, "count": int, "lease_seconds": int}
+    - `PUT /duties/<int:model_id>/release`
+      - Returns duties leased to a client to the pending state (e.g. the client disconnected),
+        or marks them as failed once they have been leased `DUTY_MAX_ATTEMPTS` times.
+      - Response JSON: [{"data_split_id": int, "state": int}, ...]
+      - Request JSON: {"client_uuid": str, "ids": list[int] (data split IDs)}
 """
 
 import base64
+import hashlib
+import math
 import os
 import json
 from waitress import serve
-from flask import Flask, Response, request
+from flask import Flask, Response, g, request
 from flask_cors import CORS, cross_origin
 import logging
 import psycopg2
+import psycopg2.errors
+import psycopg2.extensions
+from psycopg2.extras import execute_values
+from psycopg2.pool import ThreadedConnectionPool
 
 # from psycopg2 import sql
 import signal
 import sys
 import random
+import threading
+import time
 
 app = Flask(__name__)
 CORS(app)
@@ -75,7 +134,52 @@ app.config["CORS_HEADERS"] = "Content-Type"
 
 logging.basicConfig(level=logging.DEBUG)
 
-db = None
+db_pool = None
+
+# Connection pool size; the pool should be at least as large as the number of
+# waitress threads so every request can run against Postgres in parallel
+POSTGRES_POOL_MIN = int(os.getenv("POSTGRES_POOL_MIN", "2"))
+POSTGRES_POOL_MAX = int(os.getenv("POSTGRES_POOL_MAX", "16"))
+WAITRESS_THREADS = int(os.getenv("WAITRESS_THREADS", str(POSTGRES_POOL_MAX)))
+# Largest request body waitress accepts, in bytes. Its own default of 1 GiB would
+# reject large streamed datasets and container-sized model binaries with 413. Waitress buffers a body to a temporary
+# file before the request is handled, so the disk must have room for it.
+WAITRESS_MAX_BODY = int(os.getenv("WAITRESS_MAX_BODY", str(64 * 1024**3)))
+# Connections idle for longer than this are pinged before being handed out
+POSTGRES_POOL_PING_SECONDS = float(os.getenv("POSTGRES_POOL_PING_SECONDS", "30"))
+
+# Last time each pooled connection was returned, keyed by id(connection)
+db_last_used = {}
+db_last_used_lock = threading.Lock()
+
+# Number of rows fetched per round trip by streaming (server-side cursor) endpoints
+STREAM_FETCH_SIZE = int(os.getenv("STREAM_FETCH_SIZE", "2000"))
+
+# Size of the slices used when streaming model binaries in and out of Postgres
+BINARY_CHUNK_SIZE = int(os.getenv("BINARY_CHUNK_SIZE", str(1024 * 1024)))
+
+# Number of rows held in memory when shuffling a streamed dataset
+DATASET_SHUFFLE_WINDOW = int(os.getenv("DATASET_SHUFFLE_WINDOW", "100000"))
+
+# Number of times a duty may be leased before it is marked as failed
+DUTY_MAX_ATTEMPTS = int(os.getenv("DUTY_MAX_ATTEMPTS", "3"))
+
+# Duties that can be claimed: pending, or leased with the lease run out
+CLAIMABLE_DUTY = "(state = 0 OR (state = 1 AND lease_expires_at < CURRENT_TIMESTAMP))"
+
+# Most copies of a replicated split handed out while its results are disputed
+VALIDATION_MAX_REPLICAS = int(os.getenv("VALIDATION_MAX_REPLICAS", "5"))
+
+# Replication of duties as they are claimed, based on how often each client's results
+# agree with validated results (see replication_rate()). Clients with fewer than
+# TRUST_MIN_CHECKS checked results have every duty replicated; the rest are replicated
+# less the closer their agreement rate (over roughly their last TRUST_WINDOW checked
+# results) is to 1, from every duty at TRUST_TARGET down to REPLICATION_MIN_RATE.
+ADAPTIVE_REPLICATION = os.getenv("ADAPTIVE_REPLICATION", "true").lower() == "true"
+TRUST_MIN_CHECKS = int(os.getenv("TRUST_MIN_CHECKS", "10"))
+TRUST_WINDOW = int(os.getenv("TRUST_WINDOW", "100"))
+TRUST_TARGET = float(os.getenv("TRUST_TARGET", "0.95"))
+REPLICATION_MIN_RATE = float(os.getenv("REPLICATION_MIN_RATE", "0.02"))
 
 
 @app.route("/")
@@ -140,9 +244,10 @@ def change_model_status(model_id):
 @cross_origin()
 def get_model_binaries(model_id):
     # Get all binaries for the model
-    query = (
-        f"SELECT * FROM model_binaries WHERE model_id = {model_id} ORDER BY version;"
-    )
+    query = f"""
+        SELECT id, model_id, version, size, sha256, created_at
+        FROM model_binaries WHERE model_id = {model_id} ORDER BY version;
+    """
     return db_query(query)
 
 
@@ -176,17 +281,70 @@ def activate_client(client_uuid):
 @app.route("/download_binary/<int:model_id>", methods=["GET"])
 @cross_origin()
 def download_binary(model_id):
-    query = f"SELECT binary_data FROM model_binaries WHERE model_id = {model_id} ORDER BY version DESC LIMIT 1;"
+    db = get_db()
     cur = db.cursor()
-    app.logger.info(f"Executing query: {query}")
-    cur.execute(query)
-    binary_data = cur.fetchone()
+    cur.execute(
+        "SELECT id, size, sha256 FROM model_binaries WHERE model_id = %s ORDER BY version DESC LIMIT 1;",
+        (model_id,),
+    )
+    binary = cur.fetchone()
     cur.close()
+    db.rollback()
 
-    if binary_data:
-        return Response(binary_data[0], mimetype="application/octet-stream")
-    else:
+    if not binary:
         return Response("Binary not found", status=404)
+    binary_id, size, sha256 = binary
+
+    # The SHA-256 digest is a strong validator for the binary's contents
+    if request.if_none_match.contains_weak(sha256):
+        response = Response(status=304)
+        response.set_etag(sha256)
+        return response
+
+    # Serve a single byte range if one was requested (and the binary is still the
+    # one the client has part of), otherwise the whole binary
+    start, stop = 0, size
+    status = 200
+    if request.range and (
+        "If-Range" not in request.headers or request.if_range.etag == sha256
+    ):
+        byte_range = request.range.range_for_length(size)
+        if byte_range is None:
+            response = Response("Requested range not satisfiable", status=416)
+            response.headers["Content-Range"] = f"bytes */{size}"
+            return response
+        start, stop = byte_range
+        status = 206
+
+    def generate():
+        cur = db.cursor()
+        offset = start
+        while offset < stop:
+            length = min(BINARY_CHUNK_SIZE, stop - offset)
+            cur.execute(
+                """
+                SELECT CASE WHEN binary_oid IS NOT NULL
+                    THEN lo_get(binary_oid, %s, %s)
+                    ELSE substring(binary_data FROM %s + 1 FOR %s) END
+                FROM model_binaries WHERE id = %s;
+                """,
+                (offset, length, offset, length, binary_id),
+            )
+            chunk = cur.fetchone()[0]
+            if not chunk:
+                break
+            offset += len(chunk)
+            yield bytes(chunk)
+        cur.close()
+        db.rollback()
+
+    response = Response(generate(), status=status, mimetype="application/octet-stream")
+    response.set_etag(sha256)
+    response.headers["Accept-Ranges"] = "bytes"
+    response.headers["Content-Length"] = str(stop - start)
+    if status == 206:
+        response.headers["Content-Range"] = f"bytes {start}-{stop - 1}/{size}"
+    return detach_db(response)
 
 
 @app.route("/dataset/<int:model_id>", methods=["GET"])
@@ -196,17 +354,41 @@ def get_dataset(model_id):
     return db_query(query)
 
 
+@app.route("/dataset/<int:model_id>/stream", methods=["GET"])
+@cross_origin()
+def stream_dataset(model_id):
+    return stream_table(f"model_{model_id}_data", "Dataset not found")
+
+
 @app.route("/create_model", methods=["POST"])
 @cross_origin()
 def create_model():
+    db = get_db()
     try:
         # Parse request data
         model_name = request.json.get("name")
         model_display_name = request.json.get("name")
         model_description = request.json.get("description")
+        model_execution_mode = request.json.get("execution_mode", "file")
+        try:
+            model_validation_quorum = int(request.json.get("validation_quorum", 2))
+            model_validation_tolerance = float(
+                request.json.get("validation_tolerance", 1e-6)
+            )
+        except (TypeError, ValueError):
+            return Response("Invalid model payload", status=400)
+        model_validation_comparator = request.json.get("validation_comparator", "json")
 
         if not model_name or not model_display_name or not model_description:
             return Response("Invalid model payload", status=400)
+        if model_execution_mode not in ["file", "pipe", "resident"]:
+            return Response("Invalid model payload", status=400)
+        if (
+            model_validation_quorum < 1
+            or model_validation_tolerance < 0
+            or model_validation_comparator not in ["exact", "json", "numeric"]
+        ):
+            return Response("Invalid model payload", status=400)
 
         # Get the next model_id
         cur = db.cursor()
@@ -218,8 +400,21 @@ def create_model():
 
         # Insert the model into the database
         cur.execute(
-            "INSERT INTO models (model_id, name, display_name, description) VALUES (%s, %s, %s, %s) RETURNING model_id;",
-            (model_id, model_name, model_display_name, model_description),
+            """
+            INSERT INTO models (model_id, name, display_name, description, execution_mode,
+                                validation_quorum, validation_comparator, validation_tolerance)
+            VALUES (%s, %s, %s, %s, %s, %s, %s, %s) RETURNING model_id;
+            """,
+            (
+                model_id,
+                model_name,
+                model_display_name,
+                model_description,
+                model_execution_mode,
+                model_validation_quorum,
+                model_validation_comparator,
+                model_validation_tolerance,
+            ),
         )
         model_id = cur.fetchone()[0]
         app.logger.info(f"Model created with ID: {model_id}")
@@ -245,6 +440,7 @@ def create_model():
 @app.route("/upload_model_binary/<int:model_id>", methods=["POST"])
 @cross_origin()
 def upload_binary(model_id):
+    db = get_db()
     # Parse the request data
     try:
         version = request.json.get("version")
@@ -253,7 +449,6 @@ def upload_binary(model_id):
         if not encoded_data:
             return Response("Invalid binary payload", status=400)
 
-        app.logger.info(f"{encoded_data}")
         # Convert binary data in base64 to bytes
         binary_data = base64.b64decode(encoded_data)
 
@@ -288,9 +483,76 @@ def upload_binary(model_id):
         return Response(f"Error uploading binary: {e}", status=500)
 
 
+@app.route("/upload_model_binary_stream/<int:model_id>", methods=["POST"])
+@cross_origin()
+def upload_binary_stream(model_id):
+    db = get_db()
+    try:
+        if request.mimetype == "multipart/form-data":
+            stream = request.files.get("binary")
+            version = request.form.get("version", None, type=int)
+        else:
+            stream = request.stream
+            version = request.args.get("version", None, type=int)
+
+        if stream is None:
+            return Response("Invalid binary payload", status=400)
+
+        cur = db.cursor()
+        if version is None:
+            cur.execute(
+                "SELECT COALESCE(MAX(version), 0) + 1 FROM model_binaries WHERE model_id = %s;",
+                (model_id,),
+            )
+            version = cur.fetchone()[0]
+
+        # Copy the body into a large object slice by slice, hashing it on the way;
+        # the large object is only kept if the transaction commits
+        digest = hashlib.sha256()
+        size = 0
+        binary_object = db.lobject(0, "wb")
+        while True:
+            chunk = stream.read(BINARY_CHUNK_SIZE)
+            if not chunk:
+                break
+            binary_object.write(chunk)
+            digest.update(chunk)
+            size += len(chunk)
+        binary_object.close()
+
+        if size == 0:
+            db.rollback()
+            return Response("Invalid binary payload", status=400)
+
+        cur.execute(
+            """
+            INSERT INTO model_binaries (model_id, version, binary_oid, size, sha256)
+            VALUES (%s, %s, %s, %s, %s)
+            RETURNING id, model_id, version, size, sha256;
+            """,
+            (model_id, version, binary_object.oid, size, digest.hexdigest()),
+        )
+        col_names = [desc[0] for desc in cur.description]
+        response = dict(zip(col_names, cur.fetchone()))
+
+        db.commit()
+        cur.close()
+
+        app.logger.info(f"Binary response: {response}")
+        return Response(
+            json.dumps(response, default=str),
+            mimetype="application/json",
+            status=201,
+        )
+    except Exception as e:
+        app.logger.error(f"Error uploading binary: {e}")
+        return Response(f"Error uploading binary: {e}", status=500)
+
+
 @app.route("/create_dataset/<int:model_id>", methods=["POST"])
 @cross_origin()
 def create_dataset(model_id):
+    db = get_db()
     try:
         # Parse the request data
         dataset_type = request.json.get("type")
@@ -300,45 +562,230 @@ def create_dataset(model_id):
         replication_percentage = int(request.json.get("replication_percentage", 10))
         shuffle = request.json.get("shuffle", False)
 
-        if not dataset_type or not data:
+        if not dataset_type or not data or split < 1:
             return Response("Invalid dataset payload", status=400)
 
         # Shuffle the dataset if required
         if shuffle:
             random.shuffle(data)
 
-        # Split the dataset
-        splits = [data[i : i + split] for i in range(0, len(data), split)]
+        # Split the dataset lazily; splits are produced as COPY consumes them
+        splits = (data[start : start + split] for start in range(0, len(data), split))
+
+        # Create a cursor
+        cur = db.cursor()
+        # Check if the table has existing data and delete it (user chose to overwrite)
+        clear_dataset(cur, model_id)
+
+        # Stream the dataset into the table and open a duty for every split
+        start_time = time.monotonic()
+        stats = copy_splits(cur, model_id, splits)
 
         # Handle replication if enabled
         if replication:
-            replication_count = max(1, (len(splits) * replication_percentage) // 100)
-            replicated_splits = random.sample(splits, replication_count)
-            splits.extend(replicated_splits)
+            replicate_splits(cur, model_id, stats, replication_percentage)
+
+        create_duties(cur, model_id)
+        finish_dataset_stats(stats, start_time)
+
+        db.commit()
+        cur.close()
+
+        app.logger.info(
+            f"Dataset for model {model_id} created: {stats['splits']} splits, {stats['rows']} rows "
+            f"in {stats['seconds']:.2f}s ({stats['rows_per_second']:.0f} rows/s)"
+        )
+        return Response(json.dumps(stats), mimetype="application/json", status=201)
+    except Exception as e:
+        app.logger.error(f"Error creating dataset: {e}")
+        return Response(f"Error creating dataset: {e}", status=500)
+
+
+@app.route("/create_dataset_stream/<int:model_id>", methods=["POST"])
+@cross_origin()
+def create_dataset_stream(model_id):
+    db = get_db()
+    try:
+        # Parse the request parameters; the data itself is the NDJSON request body
+        dataset_type = request.args.get("type")
+        split = int(request.args.get("split", 5))
+        replication = request.args.get("replication", "false").lower() == "true"
+        replication_percentage = int(request.args.get("replication_percentage", 10))
+        shuffle = request.args.get("shuffle", "false").lower() == "true"
+
+        if not dataset_type or split < 1:
+            return Response("Invalid dataset payload", status=400)
+
+        # Rows are parsed, shuffled and split as the body streams in
+        rows = (json.loads(line) for line in request.stream if line.strip())
+        if shuffle:
+            rows = shuffle_window(rows, DATASET_SHUFFLE_WINDOW)
+        splits = split_rows(rows, split)
 
-        # Define the table name
-        table_name = f"model_{model_id}_data"
-        # Create a cursor
         cur = db.cursor()
         # Check if the table has existing data and delete it (user chose to overwrite)
-        cur.execute(f"DELETE FROM {table_name};")
+        clear_dataset(cur, model_id)
 
-        # Insert the dataset into the table
-        for split_index, split_data in enumerate(splits):
-            cur.execute(
-                f"INSERT INTO {table_name} (model_id, data) VALUES (%s, %s);",
-                (model_id, json.dumps(split_data)),
-            )
+        start_time = time.monotonic()
+        stats = copy_splits(cur, model_id, splits)
+        if not stats["rows"]:
+            db.rollback()
+            return Response("Invalid dataset payload", status=400)
+
+        # Handle replication if enabled
+        if replication:
+            replicate_splits(cur, model_id, stats, replication_percentage)
+
+        create_duties(cur, model_id)
+        finish_dataset_stats(stats, start_time)
 
         db.commit()
         cur.close()
 
-        return Response("Dataset created successfully", status=201)
+        app.logger.info(
+            f"Dataset for model {model_id} streamed: {stats['splits']} splits, {stats['rows']} rows "
+            f"in {stats['seconds']:.2f}s ({stats['rows_per_second']:.0f} rows/s)"
+        )
+        return Response(json.dumps(stats), mimetype="application/json", status=201)
     except Exception as e:
         app.logger.error(f"Error creating dataset: {e}")
         return Response(f"Error creating dataset: {e}", status=500)
 
 
+# shuffle_window()
+# Shuffles an iterator of rows using a bounded buffer of `window` rows.
+# Rows can move anywhere within the window, which keeps memory bounded at the
+# cost of a less than perfect shuffle for datasets larger than the window.
+def shuffle_window(rows, window):
+    buffer = []
+    for row in rows:
+        if len(buffer) < window:
+            buffer.append(row)
+            continue
+        index = random.randrange(window)
+        yield buffer[index]
+        buffer[index] = row
+    random.shuffle(buffer)
+    yield from buffer
+
+
+# split_rows()
+# Groups an iterator of rows into splits of `split` rows.
+def split_rows(rows, split):
+    chunk = []
+    for row in rows:
+        chunk.append(row)
+        if len(chunk) == split:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+# CopyStream
+# File-like adapter that feeds an iterator of text lines to cursor.copy_expert(),
+# so rows are encoded only as fast as Postgres consumes them.
+class CopyStream:
+    def __init__(self, lines):
+        self.lines = lines
+        self.buffer = b""
+
+    def read(self, size=-1):
+        while size < 0 or len(self.buffer) < size:
+            line = next(self.lines, None)
+            if line is None:
+                break
+            self.buffer += line.encode("utf-8")
+        if size < 0:
+            size = len(self.buffer)
+        chunk, self.buffer = self.buffer[:size], self.buffer[size:]
+        return chunk
+
+
+# copy_splits()
+# Loads dataset splits into model_<model_id>_data with COPY ... FROM STDIN.
+# Returns the number of splits and data rows loaded.
+def copy_splits(cur, model_id, splits):
+    stats = {"splits": 0, "rows": 0}
+
+    def copy_lines():
+        for split_data in splits:
+            stats["splits"] += 1
+            stats["rows"] += len(split_data)
+            # COPY text format: backslash is the escape character. json.dumps
+            # already escapes tabs and newlines, so only backslashes need doubling.
+            encoded = json.dumps(split_data).replace("\\", "\\\\")
+            yield f"{model_id}\t{encoded}\n"
+
+    cur.copy_expert(
+        f"COPY model_{model_id}_data (model_id, data) FROM STDIN;",
+        CopyStream(copy_lines()),
+        size=65536,
+    )
+    return stats
+
+
+# clear_dataset()
+# Deletes a model's dataset along with its duties and validation state.
+def clear_dataset(cur, model_id):
+    cur.execute("DELETE FROM duties WHERE model_id = %s;", (model_id,))
+    cur.execute("DELETE FROM validations WHERE model_id = %s;", (model_id,))
+    cur.execute(f"DELETE FROM model_{model_id}_data;")
+
+
+# replicate_splits()
+# Copies a random `percentage` of a model's splits (at least one) as replicas that
+# point back at their original split, and adds them to the stats of copy_splits().
+# Replicas are copied inside Postgres so the dataset never has to be held in memory here.
+def replicate_splits(cur, model_id, stats, percentage):
+    table_name = f"model_{model_id}_data"
+    replication_count = max(1, (stats["splits"] * percentage) // 100)
+    cur.execute(
+        f"""
+        WITH replicas AS (
+            INSERT INTO {table_name} (model_id, data, replica_of)
+            SELECT model_id, data, id FROM {table_name} ORDER BY random() LIMIT %s
+            RETURNING data
+        )
+        SELECT COUNT(*), COALESCE(SUM(jsonb_array_length(data)), 0) FROM replicas;
+        """,
+        (replication_count,),
+    )
+    replica_splits, replica_rows = cur.fetchone()
+    stats["splits"] += replica_splits
+    stats["rows"] += int(replica_rows)
+
+
+# create_duties()
+# Creates a pending duty in the ledger for every split of a model's dataset, and a
+# pending validation for every split that has replicas.
+def create_duties(cur, model_id):
+    cur.execute(
+        f"""
+        INSERT INTO duties (model_id, data_split_id, priority)
+        SELECT model_id, id, CASE WHEN replica_of IS NULL THEN 1 ELSE 0 END
+        FROM model_{model_id}_data;
+        """
+    )
+    cur.execute(
+        f"""
+        INSERT INTO validations (model_id, data_split_id, replicas)
+        SELECT %s, replica_of, COUNT(*) + 1 FROM model_{model_id}_data
+        WHERE replica_of IS NOT NULL
+        GROUP BY replica_of;
+        """,
+        (model_id,),
+    )
+
+
+# finish_dataset_stats()
+# Adds the elapsed time and load rate to the stats returned by copy_splits().
+def finish_dataset_stats(stats, start_time):
+    stats["seconds"] = time.monotonic() - start_time
+    stats["rows_per_second"] = stats["rows"] / stats["seconds"] if stats["seconds"] else 0
+    return stats
+
+
 @app.route("/clients", methods=["GET"])
 @cross_origin()
 def get_clients():
@@ -352,9 +799,68 @@ def get_results(model_id):
     return db_query(query)
 
 
+@app.route("/results/<int:model_id>/stream", methods=["GET"])
+@cross_origin()
+def stream_results(model_id):
+    return stream_table(f"model_{model_id}_results", "Results not found")
+
+
+# stream_table()
+# Streams the rows of a per-model table in id order, using a server-side (named)
+# cursor so only STREAM_FETCH_SIZE rows are held in memory at a time.
+# Query parameters:
+#   after_id - only return rows with an id greater than this (keyset pagination)
+#   limit    - maximum number of rows to return
+#   format   - "ndjson" (default, one JSON object per line) or "json" (a JSON array)
+def stream_table(table_name, not_found_message):
+    after_id = request.args.get("after_id", 0, type=int)
+    limit = request.args.get("limit", None, type=int)
+    output_format = request.args.get("format", "ndjson")
+
+    if output_format not in ["ndjson", "json"] or (limit is not None and limit < 0):
+        return Response("Invalid stream parameters", status=400)
+
+    query = f"SELECT * FROM {table_name} WHERE id > %s ORDER BY id"
+    params = [after_id]
+    if limit is not None:
+        query += " LIMIT %s"
+        params.append(limit)
+
+    db = get_db()
+    cur = db.cursor(name=f"stream_{table_name}")
+    cur.itersize = STREAM_FETCH_SIZE
+    app.logger.info(f"Streaming query: {query} {params}")
+    try:
+        cur.execute(query, params)
+    except psycopg2.errors.UndefinedTable:
+        db.rollback()
+        return Response(not_found_message, status=404)
+
+    def generate():
+        col_names = None
+        separator = ""
+        if output_format == "json":
+            yield "["
+        for row in cur:
+            if col_names is None:
+                col_names = [desc[0] for desc in cur.description]
+            line = json.dumps(dict(zip(col_names, row)), default=str)
+            if output_format == "json":
+                yield separator + line
+                separator = ","
+            else:
+                yield line + "\n"
+        if output_format == "json":
+            yield "]"
+
+    mimetype = "application/x-ndjson" if output_format == "ndjson" else "application/json"
+    return detach_db(Response(generate(), mimetype=mimetype))
+
+
 @app.route("/upload_result/<int:model_id>", methods=["POST"])
 @cross_origin()
 def upload_result(model_id):
+    db = get_db()
     # Parse the request data
     try:
         client_uuid = request.json.get("client_uuid")
@@ -367,12 +873,25 @@ def upload_result(model_id):
         # Define the table name
         table_name = f"model_{model_id}_results"
 
-        # Insert the result into the table
+        # Insert the result into the table; a client's re-upload of a split is ignored
         cur = db.cursor()
         cur.execute(
-            f"INSERT INTO {table_name} (data_split_id, model_id, client_uuid, result) VALUES (%s, %s, %s, %s);",
+            f"""
+            INSERT INTO {table_name} (data_split_id, model_id, client_uuid, result) VALUES (%s, %s, %s, %s)
+            ON CONFLICT (data_split_id, client_uuid) DO NOTHING
+            RETURNING data_split_id;
+            """,
             (data_split_id, model_id, client_uuid, json.dumps(result_data)),
         )
+        inserted = cur.fetchall()
+        # Mark the duty as done in the ledger
+        cur.execute(
+            "UPDATE duties SET state = 2, lease_expires_at = NULL, updated_at = CURRENT_TIMESTAMP WHERE model_id = %s AND data_split_id = %s;",
+            (model_id, data_split_id),
+        )
+        # Compare the result with those of the split's replicas
+        if inserted:
+            validate_results(cur, model_id, [data_split_id])
         db.commit()
         cur.close()
 
@@ -382,9 +901,555 @@ def upload_result(model_id):
         return Response(f"Error uploading result: {e}", status=500)
 
 
+@app.route("/duties/<int:model_id>", methods=["GET"])
+@cross_origin()
+def get_duties(model_id):
+    # Duties whose lease ran out count as pending: they are handed out again
+    query = f"""
+        SELECT
+            COUNT(*) FILTER (WHERE {CLAIMABLE_DUTY}) AS pending,
+            COUNT(*) FILTER (WHERE state = 1 AND NOT {CLAIMABLE_DUTY}) AS leased,
+            COUNT(*) FILTER (WHERE state = 2) AS done,
+            COUNT(*) FILTER (WHERE state = 3) AS failed
+        FROM duties
+        WHERE model_id = %s;
+    """
+    return db_query(query, (model_id,))
+
+
+@app.route("/duties/<int:model_id>/claim", methods=["POST"])
+@cross_origin()
+def claim_duties(model_id):
+    db = get_db()
+    client_uuid = request.json.get("client_uuid")
+    count = int(request.json.get("count", 1))
+    lease_seconds = int(request.json.get("lease_seconds", 300))
+
+    if not client_uuid or count < 1:
+        return Response("Invalid claim payload", status=400)
+
+    try:
+        cur = db.cursor()
+        # Give up on duties whose lease ran out too many times
+        cur.execute(
+            """
+            UPDATE duties
+            SET state = 3, lease_expires_at = NULL, updated_at = CURRENT_TIMESTAMP
+            WHERE model_id = %s AND state = 1
+              AND lease_expires_at < CURRENT_TIMESTAMP AND attempts >= %s;
+            """,
+            (model_id, DUTY_MAX_ATTEMPTS),
+        )
+        # Lease pending or expired duties, replicas first so clients' trust scores
+        # build up early; rows locked by a concurrent claim are skipped
+        cur.execute(
+            f"""
+            WITH claimable AS (
+                SELECT duties.id FROM duties
+                JOIN model_{model_id}_data data ON data.id = duties.data_split_id
+                WHERE duties.model_id = %s
+                  AND {CLAIMABLE_DUTY}
+                  -- Skip copies of splits the client already has another copy of
+                  AND NOT EXISTS (
+                      SELECT 1 FROM model_{model_id}_data copy
+                      JOIN duties held
+                        ON held.model_id = duties.model_id AND held.data_split_id = copy.id
+                      WHERE (copy.id = COALESCE(data.replica_of, data.id)
+                             OR copy.replica_of = COALESCE(data.replica_of, data.id))
+                        AND copy.id <> data.id AND held.client_uuid = %s
+                  )
+                ORDER BY duties.priority, duties.id
+                LIMIT %s
+                FOR UPDATE OF duties SKIP LOCKED
+            ), claimed AS (
+                UPDATE duties
+                SET state = 1,
+                    client_uuid = %s,
+                    lease_expires_at = CURRENT_TIMESTAMP + make_interval(secs => %s),
+                    attempts = attempts + 1,
+                    updated_at = CURRENT_TIMESTAMP
+                FROM claimable
+                WHERE duties.id = claimable.id
+                RETURNING duties.data_split_id, duties.attempts
+            )
+            SELECT data.id, data.model_id, data.data, data.created_at, claimed.attempts
+            FROM claimed
+            JOIN model_{model_id}_data data ON data.id = claimed.data_split_id
+            ORDER BY data.id;
+            """,
+            (model_id, client_uuid, count, client_uuid, lease_seconds),
+        )
+        col_names = [desc[0] for desc in cur.description]
+        rows = cur.fetchall()
+        # Replicate some of the splits for another client to check
+        replicated = 0
+        if rows and ADAPTIVE_REPLICATION:
+            rate = replication_rate(cur, client_uuid)
+            chosen = [row[0] for row in rows if random.random() < rate]
+            if chosen:
+                replicated = replicate_duties(cur, model_id, chosen)
+        # Duties left for other clients, counted like the claim above
+        cur.execute(
+            f"SELECT COUNT(*) FROM duties WHERE model_id = %s AND {CLAIMABLE_DUTY};",
+            (model_id,),
+        )
+        pending = cur.fetchone()[0]
+        db.commit()
+        cur.close()
+    except Exception as e:
+        db.rollback()
+        app.logger.error(f"Error claiming duties: {e}")
+        return Response(f"Error claiming duties: {e}", status=500)
+
+    app.logger.info(
+        f"Leased {len(rows)} duties of model {model_id} to {client_uuid}, {replicated} replicated"
+    )
+    result = [dict(zip(col_names, row)) for row in rows]
+    response = Response(json.dumps(result, default=str), mimetype="application/json")
+    response.headers["X-Replicated-Duties"] = str(replicated)
+    response.headers["X-Pending-Duties"] = str(pending)
+    return response
+
+
+@app.route("/duties/<int:model_id>/release", methods=["PUT"])
+@cross_origin()
+def release_duties(model_id):
+    client_uuid = request.json.get("client_uuid")
+    data_split_ids = request.json.get("ids")
+
+    if not client_uuid or not data_split_ids or not isinstance(data_split_ids, list):
+        return Response("Invalid release payload", status=400)
+
+    # Duties that used up their attempts are failed instead of handed out again
+    query = """
+        UPDATE duties
+        SET state = CASE WHEN attempts >= %s THEN 3 ELSE 0 END,
+            client_uuid = NULL, lease_expires_at = NULL, updated_at = CURRENT_TIMESTAMP
+        WHERE model_id = %s AND state = 1 AND client_uuid = %s AND data_split_id = ANY(%s)
+        RETURNING data_split_id, state;
+    """
+    return db_query(query, (DUTY_MAX_ATTEMPTS, model_id, client_uuid, data_split_ids))
+
+
+@app.route("/upload_results/<int:model_id>", methods=["POST"])
+@cross_origin()
+def upload_results(model_id):
+    db = get_db()
+    results = request.json
+
+    if not isinstance(results, list) or not results:
+        return Response("Invalid results payload", status=400)
+
+    try:
+        rows = [
+            (result["id"], model_id, result["client_uuid"], json.dumps(result["data"]))
+            for result in results
+        ]
+    except (KeyError, TypeError):
+        return Response("Invalid results payload", status=400)
+
+    try:
+        cur = db.cursor()
+        # Insert the whole batch as a single multi-row INSERT. Results a client already
+        # uploaded (e.g. a batch retried after a timeout) are ignored
+        inserted = execute_values(
+            cur,
+            f"""
+            INSERT INTO model_{model_id}_results (data_split_id, model_id, client_uuid, result) VALUES %s
+            ON CONFLICT (data_split_id, client_uuid) DO NOTHING
+            RETURNING data_split_id;
+            """,
+            rows,
+            page_size=len(rows),
+            fetch=True,
+        )
+        # Mark the duties as done in the ledger
+        cur.execute(
+            "UPDATE duties SET state = 2, lease_expires_at = NULL, updated_at = CURRENT_TIMESTAMP WHERE model_id = %s AND data_split_id = ANY(%s);",
+            (model_id, [row[0] for row in rows]),
+        )
+        # Compare the new results with those of the splits' replicas
+        validation = validate_results(cur, model_id, [row[0] for row in inserted])
+        db.commit()
+        cur.close()
+    except (psycopg2.DataError, psycopg2.IntegrityError) as e:
+        # Results Postgres will not store (e.g. a \u0000 in JSON, an unknown client)
+        db.rollback()
+        app.logger.error(f"Rejected results: {e}")
+        return Response(f"Invalid results: {e}", status=400)
+    except Exception as e:
+        db.rollback()
+        app.logger.error(f"Error uploading results: {e}")
+        return Response(f"Error uploading results: {e}", status=500)
+
+    app.logger.info(
+        f"Uploaded {len(inserted)} results for model {model_id} ({len(rows) - len(inserted)} already uploaded)"
+    )
+    return Response(
+        json.dumps({"inserted": len(inserted), **validation}),
+        mimetype="application/json",
+        status=201,
+    )
+
+
+@app.route("/validations/<int:model_id>", methods=["GET"])
+@cross_origin()
+def get_validations(model_id):
+    query = """
+        SELECT
+            COUNT(*) FILTER (WHERE state = 0) AS pending,
+            COUNT(*) FILTER (WHERE state = 1) AS validated,
+            COUNT(*) FILTER (WHERE state = 2) AS disputed
+        FROM validations
+        WHERE model_id = %s;
+    """
+    return db_query(query, (model_id,))
+
+
+@app.route("/validations/<int:model_id>/disputed", methods=["GET"])
+@cross_origin()
+def get_disputed_validations(model_id):
+    query = """
+        SELECT data_split_id, replicas, results, agreeing, updated_at
+        FROM validations
+        WHERE model_id = %s AND state = 2
+        ORDER BY data_split_id;
+    """
+    return db_query(query, (model_id,))
+
+
+@app.route("/trust", methods=["GET"])
+@cross_origin()
+def get_trust():
+    col_names, rows = db_execute(
+        """
+        SELECT client_uuid, checked, disagreed, agreement, updated_at FROM client_trust
+        ORDER BY agreement DESC, checked DESC;
+        """
+    )
+
+    result = []
+    for row in rows:
+        client = dict(zip(col_names, row))
+        client["replication_rate"] = trust_replication_rate(
+            client["checked"], client["agreement"]
+        )
+        result.append(client)
+    return Response(json.dumps(result, default=str), mimetype="application/json")
+
+
+# validate_results()
+# Compares newly uploaded results of replicated splits with the results of the other
+# copies of the split. Only the replica groups of the given splits are looked at, so
+# each result is checked once, on arrival. A split is validated once
+# validation_quorum different clients agree on its result, and disputed when every
+# copy has a result without a quorum. A disputed split is issued once more, to get
+# another vote, until it has VALIDATION_MAX_REPLICAS copies.
+# Once a split is validated, every result of it (including ones arriving later) is
+# checked against the accepted result to update the trust scores of the clients.
+# Returns the number of splits validated, disputed and re-issued.
+def validate_results(cur, model_id, data_split_ids):
+    summary = {"validated": 0, "disputed": 0, "reissued": 0}
+    data_table = f"model_{model_id}_data"
+
+    # Lock the validations of the splits' replica groups
+    cur.execute(
+        f"""
+        SELECT data_split_id, state, replicas, result_id FROM validations
+        WHERE model_id = %s AND data_split_id IN (
+            SELECT COALESCE(replica_of, id) FROM {data_table} WHERE id = ANY(%s)
+        )
+        ORDER BY data_split_id
+        FOR UPDATE;
+        """,
+        (model_id, data_split_ids),
+    )
+    groups = {
+        row[0]: {"state": row[1], "replicas": row[2], "result_id": row[3]}
+        for row in cur.fetchall()
+    }
+    if not groups:
+        return summary
+
+    cur.execute(
+        "SELECT validation_quorum, validation_comparator, validation_tolerance FROM models WHERE model_id = %s;",
+        (model_id,),
+    )
+    quorum, comparator, tolerance = cur.fetchone()
+
+    # Get every result of the groups
+    cur.execute(
+        f"""
+        SELECT COALESCE(data.replica_of, data.id), results.id, results.data_split_id,
+               results.client_uuid, results.result
+        FROM {data_table} data
+        JOIN model_{model_id}_results results ON results.data_split_id = data.id
+        WHERE data.id = ANY(%s) OR data.replica_of = ANY(%s)
+        ORDER BY results.id;
+        """,
+        (list(groups), list(groups)),
+    )
+    group_results = {}
+    for group_id, result_id, data_split_id, client_uuid, result in cur.fetchall():
+        group_results.setdefault(group_id, []).append(
+            (result_id, data_split_id, client_uuid, result)
+        )
+
+    uploaded = set(data_split_ids)
+    outcomes = []
+    for group_id, group in groups.items():
+        results = group_results.get(group_id, [])
+        reported = len({result[1] for result in results})
+        if group["state"] == 1:
+            # Already validated; only the new results are left to check
+            accepted = next(
+                (result for result in results if result[0] == group["result_id"]),
+                None,
+            )
+            # The accepted result may be gone (e.g. removed as a duplicate by a
+            # migration); there is then nothing to check new results against
+            if accepted is not None:
+                outcomes += check_results(
+                    [result for result in results if result[1] in uploaded],
+                    accepted[3],
+                    comparator,
+                    tolerance,
+                )
+            cur.execute(
+                "UPDATE validations SET results = %s, updated_at = CURRENT_TIMESTAMP WHERE model_id = %s AND data_split_id = %s;",
+                (reported, model_id, group_id),
+            )
+            continue
+
+        agreeing, result_id = find_agreement(results, comparator, tolerance)
+        state, replicas = group["state"], group["replicas"]
+        if agreeing >= quorum:
+            state = 1
+            summary["validated"] += 1
+            accepted = next(
+                (result for result in results if result[0] == result_id), None
+            )
+            if accepted is not None:
+                outcomes += check_results(results, accepted[3], comparator, tolerance)
+        elif reported >= replicas:
+            state = 2
+            summary["disputed"] += 1
+            result_id = None
+            if replicas < VALIDATION_MAX_REPLICAS:
+                reissue_split(cur, model_id, group_id)
+                replicas += 1
+                summary["reissued"] += 1
+        else:
+            result_id = None
+        cur.execute(
+            """
+            UPDATE validations
+            SET state = %s, replicas = %s, results = %s, agreeing = %s, result_id = %s,
+                updated_at = CURRENT_TIMESTAMP
+            WHERE model_id = %s AND data_split_id = %s;
+            """,
+            (state, replicas, reported, agreeing, result_id, model_id, group_id),
+        )
+
+    record_trust(cur, outcomes)
+    if summary["disputed"]:
+        app.logger.warning(
+            f"{summary['disputed']} splits of model {model_id} have disputed results, "
+            f"{summary['reissued']} re-issued"
+        )
+    return summary
+
+
+# find_agreement()
+# Groups results (result_id, data_split_id, client_uuid, result) that agree with each
+# other. Returns the number of different clients behind the largest group and the id
+# of its first result.
+def find_agreement(results, comparator, tolerance):
+    groups = []
+    for result_id, _, client_uuid, result in results:
+        for group in groups:
+            if results_agree(group["result"], result, comparator, tolerance):
+                group["clients"].add(client_uuid)
+                break
+        else:
+            groups.append(
+                {"id": result_id, "result": result, "clients": {client_uuid}}
+            )
+    if not groups:
+        return 0, None
+    best = max(groups, key=lambda group: len(group["clients"]))
+    return len(best["clients"]), best["id"]
+
+
+# check_results()
+# Checks results (result_id, data_split_id, client_uuid, result) against the accepted
+# result of their split. Returns [(client_uuid, agreed), ...].
+def check_results(results, accepted, comparator, tolerance):
+    return [
+        (client_uuid, results_agree(result, accepted, comparator, tolerance))
+        for _, _, client_uuid, result in results
+    ]
+
+
+# record_trust()
+# Adds checked results [(client_uuid, agreed), ...] to the clients' trust scores.
+# The agreement rate is a plain average over a client's first TRUST_WINDOW checked
+# results, and a moving average over about the last TRUST_WINDOW after that, so a
+# client that starts returning bad results loses its trust quickly.
+def record_trust(cur, outcomes):
+    counts = {}
+    for client_uuid, agreed in outcomes:
+        checked, agreeing = counts.get(str(client_uuid), (0, 0))
+        counts[str(client_uuid)] = (checked + 1, agreeing + int(agreed))
+    if not counts:
+        return
+
+    # Rows are upserted in a fixed order so concurrent uploads cannot deadlock
+    rows = [
+        (client_uuid, checked, checked - agreeing, agreeing / checked)
+        for client_uuid, (checked, agreeing) in sorted(counts.items())
+    ]
+    # Weight of the old agreement rate against the new results
+    kept = f"""LEAST(
+        client_trust.checked::float / (client_trust.checked + EXCLUDED.checked),
+        power(1 - 1.0 / {max(TRUST_WINDOW, 1)}, EXCLUDED.checked)
+    )"""
+    execute_values(
+        cur,
+        f"""
+        INSERT INTO client_trust (client_uuid, checked, disagreed, agreement) VALUES %s
+        ON CONFLICT (client_uuid) DO UPDATE SET
+            checked = client_trust.checked + EXCLUDED.checked,
+            disagreed = client_trust.disagreed + EXCLUDED.disagreed,
+            agreement = client_trust.agreement * {kept} + EXCLUDED.agreement * (1 - {kept}),
+            updated_at = CURRENT_TIMESTAMP;
+        """,
+        rows,
+        page_size=len(rows),
+    )
+
+
+# trust_replication_rate()
+# Returns the share of a client's duties to replicate, given the number of its results
+# checked so far and its agreement rate.
+def trust_replication_rate(checked, agreement):
+    if not ADAPTIVE_REPLICATION:
+        return 0.0
+    if checked < TRUST_MIN_CHECKS:
+        return 1.0
+    distrust = (1 - agreement) / max(1 - TRUST_TARGET, 1e-9)
+    return min(1.0, max(REPLICATION_MIN_RATE, distrust))
+
+
+# replication_rate()
+# Looks up the share of a client's duties to replicate as they are claimed.
+def replication_rate(cur, client_uuid):
+    cur.execute(
+        "SELECT checked, agreement FROM client_trust WHERE client_uuid = %s;",
+        (client_uuid,),
+    )
+    row = cur.fetchone()
+    return trust_replication_rate(*row) if row else trust_replication_rate(0, 0.0)
+
+
+# replicate_duties()
+# Adds a replica, with a pending duty and a validation, of each of the given splits
+# that is not replicated yet. Returns the number of replicas created.
+def replicate_duties(cur, model_id, data_split_ids):
+    table_name = f"model_{model_id}_data"
+    cur.execute(
+        f"""
+        WITH originals AS (
+            SELECT data.id, data.model_id, data.data FROM {table_name} data
+            WHERE data.id = ANY(%s) AND data.replica_of IS NULL
+              AND NOT EXISTS (
+                  SELECT 1 FROM validations
+                  WHERE validations.model_id = data.model_id
+                    AND validations.data_split_id = data.id
+              )
+        ), replicas AS (
+            INSERT INTO {table_name} (model_id, data, replica_of)
+            SELECT model_id, data, id FROM originals
+            RETURNING model_id, id, replica_of
+        ), replica_duties AS (
+            INSERT INTO duties (model_id, data_split_id, priority)
+            SELECT model_id, id, 0 FROM replicas
+        )
+        INSERT INTO validations (model_id, data_split_id, replicas)
+        SELECT model_id, replica_of, 2 FROM replicas;
+        """,
+        (data_split_ids,),
+    )
+    return cur.rowcount
+
+
+# results_agree()
+# Compares two results with a model's validation comparator.
+def results_agree(a, b, comparator, tolerance):
+    if comparator == "exact":
+        return json.dumps(a) == json.dumps(b)
+    if comparator == "numeric":
+        return values_close(a, b, tolerance)
+    return canonical_json(a) == canonical_json(b)
+
+
+# canonical_json()
+# Serialises a result with sorted keys and whole floats written as integers.
+def canonical_json(value):
+    def normalize(value):
+        if isinstance(value, float) and value.is_integer():
+            return int(value)
+        if isinstance(value, dict):
+            return {key: normalize(item) for key, item in value.items()}
+        if isinstance(value, list):
+            return [normalize(item) for item in value]
+        return value
+
+    return json.dumps(normalize(value), sort_keys=True, separators=(",", ":"))
+
+
+# values_close()
+# Compares two results structurally, allowing numbers to differ by `tolerance`,
+# relative to their size or absolute.
+def values_close(a, b, tolerance):
+    numbers = (int, float)
+    if isinstance(a, numbers) and isinstance(b, numbers):
+        if isinstance(a, bool) or isinstance(b, bool):
+            return a is b
+        return math.isclose(a, b, rel_tol=tolerance, abs_tol=tolerance)
+    if isinstance(a, dict) and isinstance(b, dict):
+        return a.keys() == b.keys() and all(
+            values_close(a[key], b[key], tolerance) for key in a
+        )
+    if isinstance(a, list) and isinstance(b, list):
+        return len(a) == len(b) and all(
+            values_close(x, y, tolerance) for x, y in zip(a, b)
+        )
+    return a == b
+
+
+# reissue_split()
+# Adds one more replica of a split, with a pending duty, so another client runs it.
+def reissue_split(cur, model_id, data_split_id):
+    cur.execute(
+        f"""
+        WITH replica AS (
+            INSERT INTO model_{model_id}_data (model_id, data, replica_of)
+            SELECT model_id, data, id FROM model_{model_id}_data WHERE id = %s
+            RETURNING model_id, id
+        )
+        INSERT INTO duties (model_id, data_split_id, priority)
+        SELECT model_id, id, 0 FROM replica;
+        """,
+        (data_split_id,),
+    )
+
+
 def conn_db():
-    global db
-    db = psycopg2.connect(
+    global db_pool
+    db_pool = ThreadedConnectionPool(
+        POSTGRES_POOL_MIN,
+        POSTGRES_POOL_MAX,
         dbname=os.getenv("POSTGRES_DB", "civic_db"),
         user=os.getenv("POSTGRES_USER", "civic_db_admin"),
         password="passwd",
@@ -393,15 +1458,106 @@ def conn_db():
     )
 
 
-def db_query(query):
-    global db
+# db_healthy()
+# Checks a pooled connection before it is handed to a request.
+# Connections that have been idle for a while are pinged, since Postgres (or the
+# network in between) may have dropped them.
+def db_healthy(conn):
+    if conn.closed:
+        return False
+    with db_last_used_lock:
+        last_used = db_last_used.get(id(conn), 0)
+    if time.monotonic() - last_used < POSTGRES_POOL_PING_SECONDS:
+        return True
+    try:
+        with conn.cursor() as cur:
+            cur.execute("SELECT 1;")
+        conn.rollback()
+        return True
+    except psycopg2.Error:
+        return False
+
+
+# get_db()
+# Returns the database connection of the current request, checking one out of
+# the pool on first use. Broken connections are discarded and replaced.
+def get_db():
+    if "db" not in g:
+        for _ in range(POSTGRES_POOL_MAX + 1):
+            conn = db_pool.getconn()
+            if db_healthy(conn):
+                break
+            app.logger.warning("Discarding broken database connection")
+            with db_last_used_lock:
+                db_last_used.pop(id(conn), None)
+            db_pool.putconn(conn, close=True)
+        else:
+            raise psycopg2.OperationalError("No healthy database connection")
+        g.db = conn
+    return g.db
+
+
+# discard_db()
+# Closes the current request's connection and removes it from the pool.
+def discard_db():
+    conn = g.pop("db")
+    with db_last_used_lock:
+        db_last_used.pop(id(conn), None)
+    db_pool.putconn(conn, close=True)
+    app.logger.warning("Discarding broken database connection")
+
+
+# release_db()
+# Returns the request's connection to the pool once the request has finished.
+@app.teardown_appcontext
+def release_db(exception):
+    conn = g.pop("db", None)
+    if conn is not None:
+        put_db(conn)
+
+
+# detach_db()
+# Hands the request's connection over to a streamed response. The request context
+# is torn down before the body is sent, so the connection is returned to the pool
+# once the response has been sent (or abandoned by the client) instead.
+def detach_db(response):
+    conn = g.pop("db")
+    response.call_on_close(lambda: put_db(conn))
+    return response
+
+
+# put_db()
+# Returns a connection to the pool. Uncommitted work is rolled back, and
+# connections that broke while in use are closed instead of reused.
+def put_db(conn):
+    broken = bool(conn.closed)
+    if not broken:
+        status = conn.get_transaction_status()
+        if status == psycopg2.extensions.TRANSACTION_STATUS_UNKNOWN:
+            broken = True
+        elif status != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+            try:
+                conn.rollback()
+            except psycopg2.Error:
+                broken = True
+    with db_last_used_lock:
+        if broken:
+            db_last_used.pop(id(conn), None)
+        else:
+            db_last_used[id(conn)] = time.monotonic()
+    db_pool.putconn(conn, close=broken)
+
+
+# db_execute()
+# Runs a single statement on the request's connection and commits it.
+def db_execute(query, params=None):
+    db = get_db()
 
     # Create db cursor
     cur = db.cursor()
 
     # Execute query
-    app.logger.info(f"Executing query: {query}")
-    cur.execute(query)
+    cur.execute(query, params)
     col_names = [desc[0] for desc in cur.description] if cur.description else []
     rows = cur.fetchall() if cur.description else []
 
@@ -410,6 +1566,20 @@ def db_query(query):
 
     # Commit the transaction
     db.commit()
+    return col_names, rows
+
+
+def db_query(query, params=None):
+    app.logger.info(f"Executing query: {query}")
+    try:
+        col_names, rows = db_execute(query, params)
+    except (psycopg2.OperationalError, psycopg2.InterfaceError):
+        # The connection died under us; nothing was committed, so retry once
+        # on a fresh connection
+        if not g.db.closed:
+            raise
+        discard_db()
+        col_names, rows = db_execute(query, params)
 
     # Combine column names and rows into a list of dicts
     result = []
@@ -417,14 +1587,14 @@ def db_query(query):
         result.append(dict(zip(col_names, row)))
 
     # Return result
+    app.logger.info(f"Query returned {len(result)} rows")
     result = json.dumps(result, sort_keys=False, default=str)
-    app.logger.info(f"Query result: {result}")
     return Response(result, mimetype="application/json")
 
 
 def safe_exit(*_):
-    if db:
-        db.close()
+    if db_pool:
+        db_pool.closeall()
     app.logger.info("Exiting...")
     sys.exit(0)
 
@@ -434,4 +1604,10 @@ if __name__ == "__main__":
     signal.signal(signal.SIGTERM, safe_exit)
 
     conn_db()
-    serve(app, host="0.0.0.0", port=5000)
+    serve(
+        app,
+        host="0.0.0.0",
+        port=5000,
+        threads=WAITRESS_THREADS,
+        max_request_body_size=WAITRESS_MAX_BODY,
+    )
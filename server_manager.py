@@ -1,4 +1,4 @@
-import base64
+import hashlib
 import os
 import json
 import requests
@@ -605,6 +605,57 @@ def create_model():
     ).strip()
     if not model_description:
         model_description = "n/a"
+    while True:
+        model_execution_mode = (
+            input(
+                "Enter the execution mode of the model, file, pipe or resident (optional, default file): "
+            )
+            .strip()
+            .lower()
+        )
+        if not model_execution_mode:
+            model_execution_mode = "file"
+        if model_execution_mode not in ["file", "pipe", "resident"]:
+            print_error("Execution mode must be file, pipe or resident.")
+        else:
+            break
+    # Results of replicated splits are compared with this comparator
+    while True:
+        model_validation_comparator = (
+            input(
+                "Enter how results of replicated splits are compared, exact, json or numeric (optional, default json): "
+            )
+            .strip()
+            .lower()
+        )
+        if not model_validation_comparator:
+            model_validation_comparator = "json"
+        if model_validation_comparator not in ["exact", "json", "numeric"]:
+            print_error("Comparator must be exact, json or numeric.")
+        else:
+            break
+    model_validation_tolerance = 1e-6
+    if model_validation_comparator == "numeric":
+        while True:
+            tolerance = input(
+                "Enter the tolerance numbers may differ by (optional, default 1e-6): "
+            ).strip()
+            try:
+                model_validation_tolerance = float(tolerance) if tolerance else 1e-6
+                break
+            except ValueError:
+                print_error("Tolerance must be a number.")
+    while True:
+        quorum = input(
+            "Enter the number of clients that must agree on a replicated result (optional, default 2): "
+        ).strip()
+        if not quorum:
+            model_validation_quorum = 2
+            break
+        if quorum.isdigit() and int(quorum) >= 1:
+            model_validation_quorum = int(quorum)
+            break
+        print_error("Quorum must be a whole number of at least 1.")
 
     while True:
         model_init_binary_path = input(
@@ -614,51 +665,34 @@ def create_model():
             print_error("Model binary not found.")
         else:
             # Check if the file is a valid binary
-            with open(model_init_binary_path, "rb") as f:
-                binary_data = f.read()
-                if not binary_data:
-                    print_error("Model binary is empty.")
-                else:
-                    break
+            if os.path.getsize(model_init_binary_path) == 0:
+                print_error("Model binary is empty.")
+            else:
+                break
 
     # Create the model payload
     model_payload = {
         "name": model_name,
         "display_name": model_display_name,
         "description": model_description,
+        "execution_mode": model_execution_mode,
+        "validation_quorum": model_validation_quorum,
+        "validation_comparator": model_validation_comparator,
+        "validation_tolerance": model_validation_tolerance,
     }
-    # Create model binary payload
-    # Read and encode binary file
-    with open(model_init_binary_path, "rb") as f:
-        binary_data = f.read()
-        encoded_data = base64.b64encode(binary_data).decode("utf-8")
-    model_binary_payload = {
-        "version": 1,
-        "encoded_data": encoded_data,
-    }
-
     # Send the model payload to the server
     print("Creating model...")
     response = requests.post(f"{middleware_url}/create_model", json=model_payload)
     response.raise_for_status()
     if response.status_code == 201:
         print_success("Model created successfully.")
-        # Append the returned model ID to the payload
-        model_binary_payload["model_id"] = response.json()["model_id"]
+        model_id = response.json()["model_id"]
     else:
         print_error("Failed to create model.")
+        return
 
-    # Send the model binary payload to the server
-    print("Uploading model binary...")
-    response = requests.post(
-        f"{middleware_url}/upload_model_binary/{model_binary_payload['model_id']}",
-        json=model_binary_payload,
-    )
-    response.raise_for_status()
-    if response.status_code == 201:
-        print_success("Model binary uploaded successfully.")
-    else:
-        print_error("Failed to upload model binary.")
+    # Stream the model binary to the server
+    upload_binary_file(model_id, model_init_binary_path, 1)
 
     return
 
@@ -807,7 +841,7 @@ def list_model_binaries():
 
 # upload_model_binary()
 # Uploads a new model binary by prompting the user for the new model binary path.
-# Encodes the binary file in base64 and sends it to the API middleware.
+# The binary file is streamed to the API middleware.
 def upload_model_binary():
     # Select model
     model = select_model(print_selection=False)
@@ -845,34 +879,47 @@ def upload_model_binary():
             print_error("Model binary not found.")
         else:
             # Check if the file is a valid binary
-            with open(model_binary_path, "rb") as f:
-                binary_data = f.read()
-                if not binary_data:
-                    print_error("Model binary is empty.")
-                else:
+            if os.path.getsize(model_binary_path) == 0:
+                print_error("Model binary is empty.")
+            else:
+                break
+    # Stream the model binary to the server
+    upload_binary_file(model[0]["model_id"], model_binary_path, latest_version)
+    return
+
+
+# upload_binary_file()
+# Streams a model binary file to the API middleware as a raw request body.
+# The file is read in chunks and never held in memory as a whole; its SHA-256 is
+# computed along the way and checked against the digest stored by the middleware.
+def upload_binary_file(model_id, binary_path, version, chunk_size=1024 * 1024):
+    digest = hashlib.sha256()
+
+    def read_chunks():
+        with open(binary_path, "rb") as f:
+            while True:
+                chunk = f.read(chunk_size)
+                if not chunk:
                     break
-    # Create the model binary payload
-    # Read and encode binary file
-    with open(model_binary_path, "rb") as f:
-        binary_data = f.read()
-        encoded_data = base64.b64encode(binary_data).decode("utf-8")
-    model_binary_payload = {
-        "version": latest_version,
-        "encoded_data": encoded_data,
-    }
-    # Send the model binary payload to the server
-    print("Uploading model binary...")
+                digest.update(chunk)
+                yield chunk
 
+    print("Uploading model binary...")
     response = requests.post(
-        f"{middleware_url}/upload_model_binary/{model[0]['model_id']}",
-        json=model_binary_payload,
+        f"{middleware_url}/upload_model_binary_stream/{model_id}",
+        params={"version": version},
+        data=read_chunks(),
+        headers={"Content-Type": "application/octet-stream"},
     )
     response.raise_for_status()
-    if response.status_code == 201:
-        print_success("Model binary uploaded successfully.")
-    else:
+    if response.status_code != 201:
         print_error("Failed to upload model binary.")
-    return
+    elif response.json()["sha256"] != digest.hexdigest():
+        print_error("Model binary checksum mismatch after upload.")
+    else:
+        print_success(
+            f"Model binary uploaded successfully ({response.json()['size']} bytes, sha256 {digest.hexdigest()})."
+        )
 
 
 # create_dataset()
@@ -884,10 +931,12 @@ def create_dataset():
         "Enter the ID of the model you want to create the dataset for: "
     ).strip()
 
-    # Check if there is a dataset for the model
-    response = requests.get(f"{middleware_url}/dataset/{model_id}")
+    # Check if there is a dataset for the model (fetching at most one split)
+    response = requests.get(
+        f"{middleware_url}/dataset/{model_id}/stream", params={"limit": 1}
+    )
     if response.status_code == 200:
-        if len(response.json()) > 0:
+        if response.text.strip():
             print_error("Dataset already exists for this model.")
             override = (
                 input("Do you want to override the existing dataset? [y/N]: ")
@@ -910,16 +959,21 @@ def create_dataset():
             return
 
         # Open the dataset file
+        # CSV datasets are streamed to the middleware later on, so only count the entries here
+        dataset = None
         try:
-            with open(dataset_path, "r") as f:
-                dataset = f.read()
-                match dataset_type:
-                    case "csv":
-                        dataset = list(csv.DictReader(dataset.splitlines()))
-                    case "json":
-                        pass  # TODO
-                    case "txt":
-                        pass  # TODO
+            match dataset_type:
+                case "csv":
+                    with open(dataset_path, "r", newline="") as f:
+                        dataset_size = sum(1 for _ in csv.DictReader(f))
+                case "json":
+                    with open(dataset_path, "r") as f:
+                        dataset = f.read()  # TODO
+                    dataset_size = len(dataset)
+                case "txt":
+                    with open(dataset_path, "r") as f:
+                        dataset = f.read()  # TODO
+                    dataset_size = len(dataset)
         except Exception as e:
             print_error(f"Failed to read the dataset: {e}")
             return
@@ -940,7 +994,7 @@ def create_dataset():
             "It is suggested to keep splits small to prevent overloading the clients, and for a better distribution of work.\n"
         )
         split = input(
-            f"The imported dataset has a total of {len(dataset)} entries. Enter the number of splits (default 5/{len(dataset)}): "
+            f"The imported dataset has a total of {dataset_size} entries. Enter the number of splits (default 5/{dataset_size}): "
         ).strip()
         split = int(split) if split else 5
 
@@ -950,7 +1004,10 @@ def create_dataset():
         print(
             "For example, if 10% replication is specified, 10% of the dataset splits will be duplicated at random."
         )
-        print("This can be useful for validating the results of the citizens.\n")
+        print("This can be useful for validating the results of the citizens.")
+        print(
+            "Splits are also replicated as they are handed out to clients that are new or whose results disagree.\n"
+        )
         replication = input(f"Enable replication? [y/N]: ").strip().lower()
         replication = replication == "y"
         replication_percentage = 0
@@ -967,24 +1024,43 @@ def create_dataset():
         shuffle = input("Should the dataset be shuffled? [y/N]: ").strip().lower()
         shuffle = shuffle == "y"
 
-        # Create dataset payload
-        dataset_payload = {
-            "type": dataset_type,
-            "data": dataset,
-            "split": split,
-            "replication": replication,
-            "replication_percentage": replication_percentage,
-            "shuffle": shuffle,
-        }
-
-        # Send the dataset payload to the server
+        # Send the dataset to the server
         print("Creating dataset...")
-        response = requests.post(
-            f"{middleware_url}/create_dataset/{model_id}", json=dataset_payload
-        )
+        if dataset_type == "csv":
+            # Stream the CSV as NDJSON using chunked transfer encoding
+            dataset_params = {
+                "type": dataset_type,
+                "split": split,
+                "replication": str(replication).lower(),
+                "replication_percentage": replication_percentage,
+                "shuffle": str(shuffle).lower(),
+            }
+            response = requests.post(
+                f"{middleware_url}/create_dataset_stream/{model_id}",
+                params=dataset_params,
+                data=stream_csv_dataset(dataset_path),
+                headers={"Content-Type": "application/x-ndjson"},
+            )
+        else:
+            # Create dataset payload
+            dataset_payload = {
+                "type": dataset_type,
+                "data": dataset,
+                "split": split,
+                "replication": replication,
+                "replication_percentage": replication_percentage,
+                "shuffle": shuffle,
+            }
+            response = requests.post(
+                f"{middleware_url}/create_dataset/{model_id}", json=dataset_payload
+            )
         response.raise_for_status()
         if response.status_code == 201:
-            print_success("Dataset created successfully.")
+            stats = response.json()
+            print_success(
+                f"Dataset created successfully: {stats['splits']} splits, {stats['rows']} rows "
+                f"in {stats['seconds']:.2f}s ({stats['rows_per_second']:.0f} rows/s)."
+            )
         else:
             print_error("Failed to create dataset.")
 
@@ -994,6 +1070,21 @@ def create_dataset():
         return
 
 
+# stream_csv_dataset()
+# Reads a CSV dataset row by row and yields it as NDJSON in chunks of `chunk_rows` rows.
+# Passed to requests as the request body, so the file is never held in memory.
+def stream_csv_dataset(dataset_path, chunk_rows=1000):
+    with open(dataset_path, "r", newline="") as f:
+        chunk = []
+        for row in csv.DictReader(f):
+            chunk.append(json.dumps(row))
+            if len(chunk) >= chunk_rows:
+                yield ("\n".join(chunk) + "\n").encode("utf-8")
+                chunk = []
+        if chunk:
+            yield ("\n".join(chunk) + "\n").encode("utf-8")
+
+
 # safe_exit()
 # Helper function to safely exit the program
 def safe_exit():
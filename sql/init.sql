@@ -14,17 +14,55 @@ CREATE TABLE models (
     name VARCHAR(255) NOT NULL,
     display_name VARCHAR(255) NOT NULL,
     description TEXT,
-    status INTEGER NOT NULL DEFAULT 1 -- 0: inactive, 1: active
+    status INTEGER NOT NULL DEFAULT 1, -- 0: inactive, 1: active
+    -- How citizens run the binary. file: one process per duty, reading an input file and
+    -- writing an output file; pipe: like file, but the input file is /dev/stdin, so it
+    -- must be read front to back; resident: one long-running process per duty slot, fed
+    -- length-delimited JSON duties on stdin and answering on stdout
+    execution_mode VARCHAR(16) NOT NULL DEFAULT 'file' CHECK (execution_mode IN ('file', 'pipe', 'resident')),
+    -- How results of replicated splits are validated: the number of clients that must
+    -- agree on a result, and how results are compared. exact: identical JSON; json:
+    -- identical after canonicalisation (key order, 1 vs 1.0); numeric: numbers may
+    -- differ by validation_tolerance (relative or absolute)
+    validation_quorum INTEGER NOT NULL DEFAULT 2 CHECK (validation_quorum >= 1),
+    validation_comparator VARCHAR(16) NOT NULL DEFAULT 'json' CHECK (validation_comparator IN ('exact', 'json', 'numeric')),
+    validation_tolerance DOUBLE PRECISION NOT NULL DEFAULT 1e-6 CHECK (validation_tolerance >= 0)
 ); 
 
 CREATE TABLE model_binaries (
     id SERIAL PRIMARY KEY,
     model_id INTEGER NOT NULL REFERENCES models(model_id),
     version INTEGER NOT NULL,
-    binary_data bytea NOT NULL,
-    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    -- Binaries are stored inline (binary_data) or, when streamed in, as a large object (binary_oid)
+    binary_data bytea,
+    binary_oid OID,
+    size BIGINT NOT NULL, -- filled in from binary_data by set_model_binary_digest()
+    sha256 TEXT NOT NULL, -- hex digest, used as the binary's ETag
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    CHECK (binary_data IS NOT NULL OR binary_oid IS NOT NULL)
 );
 
+-- Inline binaries are sliced for ranged downloads; keep them uncompressed so a
+-- slice does not have to detoast the whole value
+ALTER TABLE model_binaries ALTER COLUMN binary_data SET STORAGE EXTERNAL;
+
+CREATE INDEX model_binaries_sha256_idx ON model_binaries (sha256);
+
+CREATE OR REPLACE FUNCTION set_model_binary_digest() RETURNS TRIGGER AS $$
+BEGIN
+    IF NEW.binary_data IS NOT NULL THEN
+        NEW.size = octet_length(NEW.binary_data);
+        NEW.sha256 = encode(sha256(NEW.binary_data), 'hex');
+    END IF;
+    RETURN NEW;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER before_model_binary_write
+BEFORE INSERT OR UPDATE OF binary_data ON model_binaries
+FOR EACH ROW
+EXECUTE FUNCTION set_model_binary_digest();
+
 CREATE TABLE clients (
     id SERIAL PRIMARY KEY,
     client_uuid UUID UNIQUE DEFAULT gen_random_uuid(),
@@ -35,6 +73,54 @@ CREATE TABLE clients (
     last_connected_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
 );
 
+-- Duty ledger: one row per dataset split, tracking who is working on it.
+-- Rows are created by /create_dataset and claimed by the internal server with
+-- FOR UPDATE SKIP LOCKED, so progress survives internal server restarts.
+CREATE TABLE duties (
+    id SERIAL PRIMARY KEY,
+    model_id INTEGER NOT NULL REFERENCES models(model_id),
+    data_split_id INTEGER NOT NULL, -- id in model_<model_id>_data
+    state INTEGER NOT NULL DEFAULT 0, -- 0: pending, 1: leased, 2: done, 3: failed
+    client_uuid UUID REFERENCES clients(client_uuid), -- citizen holding the lease
+    lease_expires_at TIMESTAMP,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    -- Claimed lowest first: 0 for replicas, whose results build up the clients' trust
+    -- scores, 1 for original splits
+    priority SMALLINT NOT NULL DEFAULT 1,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    UNIQUE (model_id, data_split_id)
+);
+
+-- Claims only ever look at pending or leased duties, in priority order
+CREATE INDEX duties_claimable_idx ON duties (model_id, priority, id) WHERE state IN (0, 1);
+
+-- Replica validation: one row per replicated split, keyed by the id of the original
+-- split (replicas point at it with model_<model_id>_data.replica_of). Results are
+-- compared as they are uploaded; a disputed split is issued to one more client.
+CREATE TABLE validations (
+    model_id INTEGER NOT NULL REFERENCES models(model_id),
+    data_split_id INTEGER NOT NULL, -- id of the original split in model_<model_id>_data
+    state INTEGER NOT NULL DEFAULT 0, -- 0: pending, 1: validated, 2: disputed
+    replicas INTEGER NOT NULL, -- number of copies of the split (original included)
+    results INTEGER NOT NULL DEFAULT 0, -- copies with a result
+    agreeing INTEGER NOT NULL DEFAULT 0, -- clients behind the most agreed-on result
+    result_id INTEGER, -- the accepted result in model_<model_id>_results, once validated
+    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    PRIMARY KEY (model_id, data_split_id)
+);
+
+-- Client trust: how often a client's results agree with the accepted result of a
+-- validated split. Duties claimed by clients with little or poor history are
+-- replicated more often, so another client checks them.
+CREATE TABLE client_trust (
+    client_uuid UUID PRIMARY KEY REFERENCES clients(client_uuid),
+    checked INTEGER NOT NULL DEFAULT 0, -- results compared with a validated result
+    disagreed INTEGER NOT NULL DEFAULT 0, -- of which did not agree with it
+    agreement DOUBLE PRECISION NOT NULL DEFAULT 0, -- recent agreement rate (0 to 1)
+    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
+
 CREATE OR REPLACE FUNCTION update_last_connected_at() RETURNS TRIGGER AS $$
 BEGIN
     IF NEW.status = 1 THEN
@@ -57,9 +143,14 @@ BEGIN
             id SERIAL PRIMARY KEY,
             model_id INTEGER NOT NULL REFERENCES models(model_id),
             data JSONB NOT NULL,
+            replica_of INTEGER REFERENCES model_%1$s_data(id), -- original split of a replica
             created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
         )', NEW.model_id);
 
+    EXECUTE format('
+        CREATE INDEX model_%s_data_replica_of_idx ON model_%1$s_data (replica_of)
+        WHERE replica_of IS NOT NULL', NEW.model_id);
+
     EXECUTE format('
         CREATE TABLE model_%s_results (
             id SERIAL PRIMARY KEY,
@@ -67,9 +158,20 @@ BEGIN
             model_id INTEGER NOT NULL REFERENCES models(model_id),
             client_uuid UUID NOT NULL REFERENCES clients(client_uuid),
             result JSONB NOT NULL,
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            -- One result per split and client, so re-uploads are no-ops. Also serves
+            -- lookups of a split''s results and of splits without a result
+            UNIQUE (data_split_id, client_uuid)
         )', NEW.model_id);
 
+    EXECUTE format('
+        CREATE INDEX model_%s_results_client_uuid_idx ON model_%1$s_results (client_uuid)', NEW.model_id);
+
+    -- Results are appended in time order, so a BRIN index covers time range queries
+    -- at a fraction of the size of a btree
+    EXECUTE format('
+        CREATE INDEX model_%s_results_created_at_idx ON model_%1$s_results USING brin (created_at)', NEW.model_id);
+
     RETURN NEW;
 END;
 $$ LANGUAGE plpgsql;
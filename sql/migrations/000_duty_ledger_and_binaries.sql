@@ -0,0 +1,93 @@
+-- Brings a database created from the original init.sql up to the schema the later
+-- migrations build on: the duty ledger, streamed (large-object) and content-addressed
+-- (SHA-256) model binaries, and the execution modes of resident workers. New
+-- databases get all of this from init.sql.
+-- Run before 001_result_validation.sql. Safe to run more than once:
+--   psql -U civic_db_admin -f sql/migrations/000_duty_ledger_and_binaries.sql
+
+\connect civic_db;
+
+-- Execution modes: binaries run per split on files or pipes, or as resident workers
+ALTER TABLE models
+    ADD COLUMN IF NOT EXISTS execution_mode VARCHAR(16) NOT NULL DEFAULT 'file' CHECK (execution_mode IN ('file', 'pipe', 'resident'));
+
+-- Model binaries: inline (binary_data) or large object (binary_oid), with their
+-- size and SHA-256 filled in for the binaries already stored inline
+ALTER TABLE model_binaries
+    ALTER COLUMN binary_data DROP NOT NULL,
+    ADD COLUMN IF NOT EXISTS binary_oid OID,
+    ADD COLUMN IF NOT EXISTS size BIGINT,
+    ADD COLUMN IF NOT EXISTS sha256 TEXT;
+
+UPDATE model_binaries
+SET size = octet_length(binary_data), sha256 = encode(sha256(binary_data), 'hex')
+WHERE binary_data IS NOT NULL AND (size IS NULL OR sha256 IS NULL);
+
+ALTER TABLE model_binaries
+    ALTER COLUMN size SET NOT NULL,
+    ALTER COLUMN sha256 SET NOT NULL;
+
+DO $$
+BEGIN
+    IF NOT EXISTS (
+        SELECT 1 FROM pg_constraint WHERE conname = 'model_binaries_check'
+    ) THEN
+        ALTER TABLE model_binaries
+            ADD CONSTRAINT model_binaries_check CHECK (binary_data IS NOT NULL OR binary_oid IS NOT NULL);
+    END IF;
+END $$;
+
+-- Inline binaries are sliced for ranged downloads; keep them uncompressed so a
+-- slice does not have to detoast the whole value (applies to values written from now on)
+ALTER TABLE model_binaries ALTER COLUMN binary_data SET STORAGE EXTERNAL;
+
+CREATE INDEX IF NOT EXISTS model_binaries_sha256_idx ON model_binaries (sha256);
+
+CREATE OR REPLACE FUNCTION set_model_binary_digest() RETURNS TRIGGER AS $$
+BEGIN
+    IF NEW.binary_data IS NOT NULL THEN
+        NEW.size = octet_length(NEW.binary_data);
+        NEW.sha256 = encode(sha256(NEW.binary_data), 'hex');
+    END IF;
+    RETURN NEW;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS before_model_binary_write ON model_binaries;
+CREATE TRIGGER before_model_binary_write
+BEFORE INSERT OR UPDATE OF binary_data ON model_binaries
+FOR EACH ROW
+EXECUTE FUNCTION set_model_binary_digest();
+
+-- Duty ledger
+CREATE TABLE IF NOT EXISTS duties (
+    id SERIAL PRIMARY KEY,
+    model_id INTEGER NOT NULL REFERENCES models(model_id),
+    data_split_id INTEGER NOT NULL, -- id in model_<model_id>_data
+    state INTEGER NOT NULL DEFAULT 0, -- 0: pending, 1: leased, 2: done, 3: failed
+    client_uuid UUID REFERENCES clients(client_uuid), -- citizen holding the lease
+    lease_expires_at TIMESTAMP,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    UNIQUE (model_id, data_split_id)
+);
+
+CREATE INDEX IF NOT EXISTS duties_claimable_idx ON duties (model_id, id) WHERE state IN (0, 1);
+
+-- Existing datasets: open a duty for every split, done if it already has a result
+DO $$
+DECLARE
+    model RECORD;
+BEGIN
+    FOR model IN SELECT model_id FROM models LOOP
+        EXECUTE format('
+            INSERT INTO duties (model_id, data_split_id, state)
+            SELECT data.model_id, data.id,
+                CASE WHEN EXISTS (
+                    SELECT 1 FROM model_%s_results results WHERE results.data_split_id = data.id
+                ) THEN 2 ELSE 0 END
+            FROM model_%1$s_data data
+            ON CONFLICT (model_id, data_split_id) DO NOTHING', model.model_id);
+    END LOOP;
+END $$;
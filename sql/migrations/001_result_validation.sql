@@ -0,0 +1,86 @@
+-- Adds replica validation to a database created before it existed.
+-- Run after 000_duty_ledger_and_binaries.sql, which it builds on.
+-- New databases get all of this from init.sql. Safe to run more than once:
+--   psql -U civic_db_admin -f sql/migrations/001_result_validation.sql
+
+\connect civic_db;
+
+ALTER TABLE models
+    ADD COLUMN IF NOT EXISTS validation_quorum INTEGER NOT NULL DEFAULT 2 CHECK (validation_quorum >= 1),
+    ADD COLUMN IF NOT EXISTS validation_comparator VARCHAR(16) NOT NULL DEFAULT 'json' CHECK (validation_comparator IN ('exact', 'json', 'numeric')),
+    ADD COLUMN IF NOT EXISTS validation_tolerance DOUBLE PRECISION NOT NULL DEFAULT 1e-6 CHECK (validation_tolerance >= 0);
+
+CREATE TABLE IF NOT EXISTS validations (
+    model_id INTEGER NOT NULL REFERENCES models(model_id),
+    data_split_id INTEGER NOT NULL, -- id of the original split in model_<model_id>_data
+    state INTEGER NOT NULL DEFAULT 0, -- 0: pending, 1: validated, 2: disputed
+    replicas INTEGER NOT NULL, -- number of copies of the split (original included)
+    results INTEGER NOT NULL DEFAULT 0, -- copies with a result
+    agreeing INTEGER NOT NULL DEFAULT 0, -- clients behind the most agreed-on result
+    result_id INTEGER, -- the accepted result in model_<model_id>_results, once validated
+    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    PRIMARY KEY (model_id, data_split_id)
+);
+
+CREATE OR REPLACE FUNCTION create_model_related_tables() RETURNS TRIGGER AS $$
+BEGIN
+    EXECUTE format('
+        CREATE TABLE model_%s_data (
+            id SERIAL PRIMARY KEY,
+            model_id INTEGER NOT NULL REFERENCES models(model_id),
+            data JSONB NOT NULL,
+            replica_of INTEGER REFERENCES model_%1$s_data(id), -- original split of a replica
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )', NEW.model_id);
+
+    EXECUTE format('
+        CREATE INDEX model_%s_data_replica_of_idx ON model_%1$s_data (replica_of)
+        WHERE replica_of IS NOT NULL', NEW.model_id);
+
+    EXECUTE format('
+        CREATE TABLE model_%s_results (
+            id SERIAL PRIMARY KEY,
+            data_split_id INTEGER NOT NULL REFERENCES model_%1$s_data(id),
+            model_id INTEGER NOT NULL REFERENCES models(model_id),
+            client_uuid UUID NOT NULL REFERENCES clients(client_uuid),
+            result JSONB NOT NULL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )', NEW.model_id);
+
+    RETURN NEW;
+END;
+$$ LANGUAGE plpgsql;
+
+-- Existing datasets: replicas made before replica_of existed are identical copies of
+-- a split, so the lowest id with the same data is taken as the original. Their
+-- validations are evaluated as further results of the split arrive.
+DO $$
+DECLARE
+    model RECORD;
+BEGIN
+    FOR model IN SELECT model_id FROM models LOOP
+        EXECUTE format('
+            ALTER TABLE model_%s_data
+            ADD COLUMN IF NOT EXISTS replica_of INTEGER REFERENCES model_%1$s_data(id)', model.model_id);
+
+        EXECUTE format('
+            CREATE INDEX IF NOT EXISTS model_%s_data_replica_of_idx ON model_%1$s_data (replica_of)
+            WHERE replica_of IS NOT NULL', model.model_id);
+
+        EXECUTE format('
+            UPDATE model_%s_data replica SET replica_of = original.id
+            FROM (
+                SELECT data, MIN(id) AS id FROM model_%1$s_data
+                GROUP BY data HAVING COUNT(*) > 1
+            ) original
+            WHERE replica.data = original.data AND replica.id > original.id
+              AND replica.replica_of IS NULL', model.model_id);
+
+        EXECUTE format('
+            INSERT INTO validations (model_id, data_split_id, replicas)
+            SELECT %s, replica_of, COUNT(*) + 1 FROM model_%1$s_data
+            WHERE replica_of IS NOT NULL
+            GROUP BY replica_of
+            ON CONFLICT DO NOTHING', model.model_id);
+    END LOOP;
+END $$;
@@ -0,0 +1,14 @@
+-- Adds client trust scores, used to replicate duties as they are claimed, to a
+-- database created before they existed. Run after 001_result_validation.sql.
+-- New databases get this from init.sql. Safe to run more than once:
+--   psql -U civic_db_admin -f sql/migrations/002_client_trust.sql
+
+\connect civic_db;
+
+CREATE TABLE IF NOT EXISTS client_trust (
+    client_uuid UUID PRIMARY KEY REFERENCES clients(client_uuid),
+    checked INTEGER NOT NULL DEFAULT 0, -- results compared with a validated result
+    disagreed INTEGER NOT NULL DEFAULT 0, -- of which did not agree with it
+    agreement DOUBLE PRECISION NOT NULL DEFAULT 0, -- recent agreement rate (0 to 1)
+    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
@@ -0,0 +1,83 @@
+-- Adds the indexes and the one-result-per-split-and-client constraint of the
+-- model_<model_id>_results tables to a database created before they existed.
+-- Run after 002_client_trust.sql. New databases get this from init.sql.
+-- Safe to run more than once:
+--   psql -U civic_db_admin -f sql/migrations/003_results_indexes.sql
+-- Building the indexes locks each results table against writes while it runs; on
+-- very large tables, run it while no duties are being handed out.
+
+\connect civic_db;
+
+CREATE OR REPLACE FUNCTION create_model_related_tables() RETURNS TRIGGER AS $$
+BEGIN
+    EXECUTE format('
+        CREATE TABLE model_%s_data (
+            id SERIAL PRIMARY KEY,
+            model_id INTEGER NOT NULL REFERENCES models(model_id),
+            data JSONB NOT NULL,
+            replica_of INTEGER REFERENCES model_%1$s_data(id), -- original split of a replica
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )', NEW.model_id);
+
+    EXECUTE format('
+        CREATE INDEX model_%s_data_replica_of_idx ON model_%1$s_data (replica_of)
+        WHERE replica_of IS NOT NULL', NEW.model_id);
+
+    EXECUTE format('
+        CREATE TABLE model_%s_results (
+            id SERIAL PRIMARY KEY,
+            data_split_id INTEGER NOT NULL REFERENCES model_%1$s_data(id),
+            model_id INTEGER NOT NULL REFERENCES models(model_id),
+            client_uuid UUID NOT NULL REFERENCES clients(client_uuid),
+            result JSONB NOT NULL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            -- One result per split and client, so re-uploads are no-ops. Also serves
+            -- lookups of a split''s results and of splits without a result
+            UNIQUE (data_split_id, client_uuid)
+        )', NEW.model_id);
+
+    EXECUTE format('
+        CREATE INDEX model_%s_results_client_uuid_idx ON model_%1$s_results (client_uuid)', NEW.model_id);
+
+    -- Results are appended in time order, so a BRIN index covers time range queries
+    -- at a fraction of the size of a btree
+    EXECUTE format('
+        CREATE INDEX model_%s_results_created_at_idx ON model_%1$s_results USING brin (created_at)', NEW.model_id);
+
+    RETURN NEW;
+END;
+$$ LANGUAGE plpgsql;
+
+-- Existing results tables: a client that uploaded the same split more than once keeps
+-- its first result, which is the one validation looked at.
+DO $$
+DECLARE
+    model RECORD;
+BEGIN
+    FOR model IN SELECT model_id FROM models LOOP
+        IF NOT EXISTS (
+            SELECT 1 FROM pg_constraint
+            WHERE conname = format('model_%s_results_data_split_id_client_uuid_key', model.model_id)
+        ) THEN
+            EXECUTE format('
+                DELETE FROM model_%s_results duplicate
+                USING model_%1$s_results first
+                WHERE duplicate.data_split_id = first.data_split_id
+                  AND duplicate.client_uuid = first.client_uuid
+                  AND duplicate.id > first.id', model.model_id);
+
+            EXECUTE format('
+                ALTER TABLE model_%s_results
+                ADD CONSTRAINT model_%1$s_results_data_split_id_client_uuid_key
+                UNIQUE (data_split_id, client_uuid)', model.model_id);
+        END IF;
+
+        EXECUTE format('
+            CREATE INDEX IF NOT EXISTS model_%s_results_client_uuid_idx
+            ON model_%1$s_results (client_uuid)', model.model_id);
+
+        EXECUTE format('
+            CREATE INDEX IF NOT EXISTS model_%s_results_created_at_idx
+            ON model_%1$s_results USING brin (created_at)', model.model_id);
+    END LOOP;
+END $$;
@@ -0,0 +1,25 @@
+-- Lets replica duties be claimed before original splits, so clients' trust scores
+-- build up early in a run. Run after 003_results_indexes.sql.
+-- New databases get this from init.sql. Safe to run more than once:
+--   psql -U civic_db_admin -f sql/migrations/004_duty_priority.sql
+
+\connect civic_db;
+
+ALTER TABLE duties ADD COLUMN IF NOT EXISTS priority SMALLINT NOT NULL DEFAULT 1;
+
+-- Existing replica duties go first
+DO $$
+DECLARE
+    model RECORD;
+BEGIN
+    FOR model IN SELECT model_id FROM models LOOP
+        EXECUTE format('
+            UPDATE duties SET priority = 0
+            FROM model_%s_data data
+            WHERE duties.model_id = %1$s AND duties.data_split_id = data.id
+              AND data.replica_of IS NOT NULL AND duties.priority <> 0', model.model_id);
+    END LOOP;
+END $$;
+
+DROP INDEX IF EXISTS duties_claimable_idx;
+CREATE INDEX duties_claimable_idx ON duties (model_id, priority, id) WHERE state IN (0, 1);